@@ -0,0 +1,251 @@
+#!./venv/bin/python3
+"""
+Benchmark of the refresh cycle on a synthetic flowd log (see flowd_generator).
+
+Every cycle appends one refresh interval of flows to the log and runs the stages of a refresh:
+parse (decode the new records), aggregate (flow2conn.get_last_connections, which decodes as well),
+update (StatusDB.apply_connections), enrich (StatusDB.drain_enrich_backlog / Connection.enrich) and
+emit (syslog output of all connections, to a temporary file).
+
+Results are compared with a stored baseline, a stage that got slower than the tolerance fails the run.
+"""
+import argparse
+import atexit
+import contextlib
+import io
+import json
+import os
+import pickle
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# syslog output of the emit stage goes to a temporary file, set before syslog_sender reads its config
+_syslog_dir = tempfile.mkdtemp(prefix='netmon-benchmark-')
+atexit.register(shutil.rmtree, _syslog_dir, True)
+os.environ['SYSLOG_PROTOCOL'] = 'file'
+os.environ['SYSLOG_FILE'] = os.path.join(_syslog_dir, 'syslog.log')
+
+import flow2conn
+from flow_tail import FlowLogTail
+from flowd_decoder import FlowdDecoder, map_file
+from flowd_generator import FlowGenerator
+from status_db import StatusDB
+from syslog_sender import get_sender
+from main import emit_connections
+
+BASELINE_FILE = 'benchmark_baseline.json'
+STAGES = ['parse', 'aggregate', 'update', 'enrich', 'emit', 'cycle']
+# parameters that have to match for a baseline comparison
+SCENARIO_PARAMETERS = ['rate', 'interval', 'cardinality', 'ipv6_ratio', 'pareto_alpha', 'seed']
+
+
+def percentile(values: list[float], p: float) -> float:
+    """
+    Nearest rank percentile
+    :param values: samples
+    :param p: percentile (0..100)
+    :return: float
+    """
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, -(-len(ordered) * p // 100) - 1))] if ordered else 0.0
+
+
+def reset_state():
+    StatusDB.active_connections = {}
+    StatusDB.idle_connections = {}
+    StatusDB.closed_connections = {}
+    StatusDB.idle_expiry = []
+    StatusDB.enrich_backlog = []
+    StatusDB.enrich_queued_at = {}
+    StatusDB.log_position = None
+
+
+def decode_range(filename: str, start: int, end: int) -> int:
+    """
+    Decode the records in a byte range of the log
+    :return: number of records
+    """
+    mm = map_file(filename)
+    try:
+        with memoryview(mm) as mv:
+            return sum(1 for _ in FlowdDecoder().decode(mv, start, end))
+    finally:
+        mm.close()
+
+
+def bytes_per_connection() -> float:
+    """
+    Memory held by the tracked connections (objects, keys and table entries) per connection
+    :return: float
+    """
+    tables = (StatusDB.active_connections, StatusDB.idle_connections)
+    count = sum(len(table) for table in tables)
+    if count == 0:
+        return 0.0
+    data = pickle.dumps(tables, protocol=pickle.HIGHEST_PROTOCOL)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    copy = pickle.loads(data)
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del copy
+    return size / count
+
+
+def run(log_file: str, rate: int, interval: int, cycles: int, warmup: int, cardinality: int, ipv6_ratio: float,
+        pareto_alpha: float, seed: int) -> dict:
+    """
+    Run the benchmark
+    :param log_file: flowd log to write the synthetic flows to (replaced)
+    :param rate: flows per second
+    :param interval: seconds of traffic per cycle (refresh interval)
+    :param cycles: measured cycles
+    :param warmup: cycles run before measuring (caches and connection tables fill up)
+    :param cardinality: distinct conversations
+    :param ipv6_ratio: share of IPv6 conversations
+    :param pareto_alpha: shape of the octets distribution
+    :param seed: random seed of the generator
+    :return: dict with the parameters, per stage p50/p99 (seconds) and flows per second, bytes per connection
+    """
+    generator = FlowGenerator(cardinality, ipv6_ratio, pareto_alpha, seed=seed)
+    flows = rate * interval
+    open(log_file, 'wb').close()
+    flow2conn.flow_tail = FlowLogTail(log_file)
+    reset_state()
+
+    timings = {stage: [] for stage in STAGES}
+    for cycle in range(warmup + cycles):
+        start = os.path.getsize(log_file)
+        now = time.time()
+        generator.write(log_file, flows, now - interval, now)
+        end = os.path.getsize(log_file)
+
+        stage_times = {}
+        t0 = time.perf_counter()
+        decode_range(log_file, start, end)
+        stage_times['parse'] = time.perf_counter() - t0
+
+        # get_last_connections reports progress on stdout
+        with contextlib.redirect_stdout(io.StringIO()):
+            t0 = time.perf_counter()
+            connections, log_position = StatusDB.fetch_connections()
+            stage_times['aggregate'] = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        StatusDB.apply_connections(connections, log_position)
+        stage_times['update'] = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        StatusDB.drain_enrich_backlog()
+        stage_times['enrich'] = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        emit_connections(StatusDB())
+        get_sender().flush()
+        stage_times['emit'] = time.perf_counter() - t0
+        # parse is part of aggregate already
+        stage_times['cycle'] = sum(stage_times[stage] for stage in ('aggregate', 'update', 'enrich', 'emit'))
+
+        if cycle >= warmup:
+            for stage, seconds in stage_times.items():
+                timings[stage].append(seconds)
+
+    return {
+        'parameters': {'rate': rate, 'interval': interval, 'cardinality': cardinality, 'ipv6_ratio': ipv6_ratio,
+                       'pareto_alpha': pareto_alpha, 'seed': seed, 'cycles': cycles, 'warmup': warmup},
+        'environment': {'python': platform.python_version(), 'machine': platform.machine(),
+                        'cpus': os.cpu_count(), 'flow_workers': flow2conn.FLOW_WORKERS,
+                        'columnar': flow2conn.aggregate_connections is not None, 'biflow': flow2conn.BIFLOW},
+        'stages': {
+            stage: {
+                'p50': percentile(samples, 50),
+                'p99': percentile(samples, 99),
+                'flows_per_sec': flows / percentile(samples, 50) if percentile(samples, 50) > 0 else 0.0,
+            }
+            for stage, samples in timings.items()
+        },
+        'connections': len(StatusDB.active_connections) + len(StatusDB.idle_connections),
+        'bytes_per_connection': bytes_per_connection(),
+    }
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Compare a result with a baseline
+    :param result: result of run()
+    :param baseline: stored result of run()
+    :param tolerance: allowed slowdown of the p50 (0.2: 20% slower)
+    :return: list of regressions (empty when none)
+    """
+    regressions = []
+    for parameter in SCENARIO_PARAMETERS:
+        if result['parameters'][parameter] != baseline['parameters'].get(parameter):
+            print(f"Warning: baseline was measured with {parameter}={baseline['parameters'].get(parameter)}",
+                  file=sys.stderr)
+    for stage in STAGES:
+        current = result['stages'][stage]['p50']
+        reference = baseline['stages'].get(stage, {}).get('p50')
+        if not reference:
+            continue
+        if current > reference * (1 + tolerance):
+            regressions.append(f"{stage}: p50 {current * 1000:.1f} ms, baseline {reference * 1000:.1f} ms "
+                               f"(+{(current / reference - 1) * 100:.0f}%)")
+    reference = baseline.get('bytes_per_connection')
+    if reference and result['bytes_per_connection'] > reference * (1 + tolerance):
+        regressions.append(f"bytes per connection: {result['bytes_per_connection']:.0f}, "
+                           f"baseline {reference:.0f}")
+    return regressions
+
+
+def print_result(result: dict, baseline: dict = None):
+    print(f"{'stage':<10} {'p50 ms':>10} {'p99 ms':>10} {'flows/s':>12} {'baseline p50':>14}")
+    for stage in STAGES:
+        stats = result['stages'][stage]
+        reference = baseline['stages'].get(stage, {}).get('p50') if baseline else None
+        print(f"{stage:<10} {stats['p50'] * 1000:>10.1f} {stats['p99'] * 1000:>10.1f} "
+              f"{stats['flows_per_sec']:>12.0f} "
+              f"{'' if reference is None else f'{reference * 1000:.1f}':>14}")
+    print(f"connections: {result['connections']}, bytes per connection: {result['bytes_per_connection']:.0f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the refresh cycle on a synthetic flowd log')
+    parser.add_argument('--rate', help='flows per second', type=int, default=1000)
+    parser.add_argument('--interval', help='seconds of traffic per cycle', type=int, default=StatusDB.REFRESH_INTERVAL)
+    parser.add_argument('--cycles', help='measured cycles', type=int, default=10)
+    parser.add_argument('--warmup', help='cycles before measuring', type=int, default=2)
+    parser.add_argument('--cardinality', help='distinct conversations', type=int, default=10000)
+    parser.add_argument('--ipv6-ratio', help='share of IPv6 conversations', type=float, default=0.2)
+    parser.add_argument('--pareto-alpha', help='octets distribution shape (heavy tail)', type=float, default=1.2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--log', help='synthetic flowd log (default: temporary file)')
+    parser.add_argument('--baseline', help='baseline to compare with', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', help='store the result as baseline', action='store_true')
+    parser.add_argument('--tolerance', help='allowed slowdown before failing', type=float, default=0.2)
+    parser.add_argument('--json', help='print the result as JSON', action='store_true')
+    cmd_args = parser.parse_args()
+
+    result = run(cmd_args.log or os.path.join(_syslog_dir, 'flowd.log'), cmd_args.rate, cmd_args.interval,
+                 cmd_args.cycles, cmd_args.warmup, cmd_args.cardinality, cmd_args.ipv6_ratio,
+                 cmd_args.pareto_alpha, cmd_args.seed)
+
+    baseline = None
+    if not cmd_args.save_baseline and os.path.isfile(cmd_args.baseline):
+        with open(cmd_args.baseline) as f:
+            baseline = json.load(f)
+
+    if cmd_args.json:
+        print(json.dumps(result, indent=4))
+    else:
+        print_result(result, baseline)
+
+    if cmd_args.save_baseline:
+        with open(cmd_args.baseline, 'w') as f:
+            json.dump(result, f, indent=4)
+        print(f"Baseline written to {cmd_args.baseline}")
+    elif baseline is not None:
+        regressions = compare(result, baseline, cmd_args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,65 @@
+from connection import Connection
+from services import get_services
+
+# ports from here on are assigned dynamically (RFC 6335), they're never the server side of a conversation
+EPHEMERAL_PORT_START = 49152
+
+
+def _server_rank(port: int, connection: Connection) -> int:
+    # lower: more likely to be the server port
+    known = get_services().get(port, connection.protocol) is not None
+    if known and port < 1024:
+        return 0
+    if known:
+        return 1
+    if port < EPHEMERAL_PORT_START:
+        return 2
+    return 3
+
+
+def server_side(connection: Connection):
+    """
+    Guess which side of a connection is the server from its ports: a well-known port, a port with a known
+    service or a non-ephemeral port is more likely to be the server port
+    :param connection: Connection
+    :return: 'src', 'dst' or None when both ports look alike
+    """
+    src_rank = _server_rank(connection.src_port, connection)
+    dst_rank = _server_rank(connection.dst_port, connection)
+    if src_rank < dst_rank:
+        return 'src'
+    if dst_rank < src_rank:
+        return 'dst'
+    return None
+
+
+def pair_connections(connections: list[Connection]) -> list[Connection]:
+    """
+    Collapse the two directions of every conversation into one connection from client to server, with the
+    server to client traffic in reply_octets / reply_packets. The client is chosen by port (see server_side),
+    or when the ports don't tell, the side that sent first. Replies whose request wasn't seen are reversed,
+    so every conversation gets the same key from one refresh to the next.
+    :param connections: connections in one direction (unpaired)
+    :return: list of connections, in the order of the input
+    """
+    by_id = {connection.get_id(): connection for connection in connections}
+    paired = set()
+    result = []
+    for connection in connections:
+        conn_id = connection.get_id()
+        if conn_id in paired:
+            continue
+        server = server_side(connection)
+        reply = by_id.get(connection.reverse_id())
+        if reply is not None and reply is not connection and reply.get_id() not in paired:
+            paired.add(conn_id)
+            paired.add(reply.get_id())
+            if server == 'src' or (server is None and reply.first_seen < connection.first_seen):
+                connection, reply = reply, connection
+            connection.merge_reply(reply)
+            result.append(connection)
+        elif server == 'src':
+            result.append(connection.reversed())
+        else:
+            result.append(connection)
+    return result
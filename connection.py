@@ -1,13 +1,24 @@
+import struct
+import sys
 import time
 
 from network_enums import *
+from functools import lru_cache
 from ipaddress import IPv4Address, IPv6Address
 import socket
-from geo_ip_data import get_country, get_asn, get_city
+from geo_ip_data import lookup
+from metrics import connections_enriched
+from reverse_dns import get_reverse_dns
+from services import get_services
 from typing import Union
 
 
 def get_domain_name(ip_address: Union[IPv4Address, IPv6Address, str]) -> str:
+    """
+    Blocking reverse DNS lookup, see reverse_dns.ReverseDNSResolver for the non-blocking, cached variant
+    :param ip_address: IP address
+    :return: str
+    """
     if not isinstance(ip_address, str):
         ip_address = str(ip_address)
     try:
@@ -35,37 +46,128 @@ def bps_to_human(bps: float) -> str:
 
 def get_app_protocol(port, protocol: Protocol) -> str:
     """
-    Get the application protocol based on the source and destination ports and the protocol
+    Get the application protocol based on the port and the protocol
     :param port: port number
     :param protocol: Protocol number
     :return: str
     """
+    name = get_services().get(port, protocol)
+    if name is None:
+        return f"{port} (Unknown)"
+    return name
+
+
+# packed IPv6 addresses carry this bit, so they never equal a packed IPv4 address
+IPV6_FLAG = 1 << 128
+IPV6_MASK = IPV6_FLAG - 1
+
+
+@lru_cache(maxsize=65536)
+def pack_ip(ip_address):
+    """
+    Pack an IP address into an int (IPv4: the address, IPv6: the address | IPV6_FLAG)
+    :param ip_address: IP address, values that aren't an IP address (None, the "other" bucket) are returned as is
+    :return: int
+    """
+    if not isinstance(ip_address, str):
+        return ip_address
     try:
-        return socket.getservbyport(port, protocol.name)
+        if ':' in ip_address:
+            return int.from_bytes(socket.inet_pton(socket.AF_INET6, ip_address), 'big') | IPV6_FLAG
+        return int.from_bytes(socket.inet_pton(socket.AF_INET, ip_address), 'big')
     except OSError:
-        return f"{port} (Unknown)"
+        return sys.intern(ip_address)
+
+
+def unpack_ip(packed) -> str:
+    """
+    Inverse of pack_ip
+    :param packed: packed IP address
+    :return: str
+    """
+    if not isinstance(packed, int):
+        return packed
+    if packed & IPV6_FLAG:
+        return socket.inet_ntop(socket.AF_INET6, (packed & IPV6_MASK).to_bytes(16, 'big'))
+    return socket.inet_ntop(socket.AF_INET, packed.to_bytes(4, 'big'))
+
+
+# fixed width part of a connection key: ports, protocol, then both addresses (see connection_key)
+# the protocol is stored unsigned, Protocol.unknown (-1) as 255 (reserved, never a known protocol)
+KEY_HEADER = struct.Struct('>HHB')
+KEY_ADDRESS_SIZE = 17
+# placeholder for an address that isn't an IP (the "other" bucket), its name is stored after the interfaces
+KEY_NAMED_ADDRESS = b'\x02' + bytes(KEY_ADDRESS_SIZE - 1)
+
+
+def connection_key(interface_in: str, interface_out: str, src_ip, dst_ip, src_port: int, dst_port: int,
+                   protocol: Protocol) -> bytes:
+    """
+    Canonical key of a connection: ports, protocol and packed addresses at fixed offsets, followed by the
+    NUL separated interface names. Unlike hash() it can't collide and is the same in every process, so it
+    can be sent to worker processes or persisted.
+    :param src_ip: packed source address (see pack_ip)
+    :param dst_ip: packed destination address (see pack_ip)
+    :return: bytes
+    """
+    header = KEY_HEADER.pack(src_port, dst_port, protocol.value & 0xff)
+    interfaces = f"{interface_in or ''}\0{interface_out or ''}"
+    if isinstance(src_ip, int) and isinstance(dst_ip, int):
+        return header + src_ip.to_bytes(KEY_ADDRESS_SIZE, 'big') + dst_ip.to_bytes(KEY_ADDRESS_SIZE, 'big') + \
+            interfaces.encode()
+    names = [interfaces]
+    addresses = []
+    for ip in (src_ip, dst_ip):
+        if isinstance(ip, int):
+            addresses.append(ip.to_bytes(KEY_ADDRESS_SIZE, 'big'))
+        else:
+            addresses.append(KEY_NAMED_ADDRESS)
+            names.append(ip or '')
+    return header + b''.join(addresses) + '\0'.join(names).encode()
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
 
 
 class Connection:
+    """
+    A connection (flows merged by interface, address, port and protocol).
+
+    Many thousands are kept in StatusDB, so the representation is compact: slots instead of a __dict__,
+    IP addresses packed into ints (see pack_ip), interface names and country codes interned, and the human
+    readable fields (bps_str, *_seen_str, app_protocol, src_data/dst_data) only built by as_dict.
+    """
+
+    __slots__ = ('first_seen', 'last_seen', 'interface_in', 'interface_out', '_src_ip', '_dst_ip', 'src_port',
+                 'dst_port', 'protocol', 'octets', 'packets', 'reply_octets', 'reply_packets', 'octets_error',
+                 'packets_error', 'src_country',
+                 'dst_country', 'src_domain', 'dst_domain', 'finished', 'duration', 'bps', '_id', 'is_enriched',
+                 'dirty')
+
     def __init__(self,
                  first_seen: int,
                  last_seen: int,
                  interface_in: str,
                  interface_out: str,
-                 src_ip: str,
-                 dst_ip: str,
+                 src_ip: Union[str, int],
+                 dst_ip: Union[str, int],
                  src_port: int,
                  dst_port: int,
                  transport_protocol: int,
                  octets: int,
                  packets: int
                  ):
+        """
+        :param src_ip: source address, as str or packed (see pack_ip)
+        :param dst_ip: destination address, as str or packed (see pack_ip)
+        """
         self.first_seen = first_seen
         self.last_seen = last_seen
-        self.interface_in = interface_in
-        self.interface_out = interface_out
-        self.src_ip = src_ip
-        self.dst_ip = dst_ip
+        self.interface_in = _intern(interface_in)
+        self.interface_out = _intern(interface_out)
+        self._src_ip = pack_ip(src_ip)
+        self._dst_ip = pack_ip(dst_ip)
         self.src_port = src_port
         self.dst_port = dst_port
         try:
@@ -74,10 +176,18 @@ class Connection:
             self.protocol = Protocol.unknown
         self.octets = octets
         self.packets = packets
+        # part of octets/packets that went from dst to src (the reply direction of a biflow, see biflow)
+        self.reply_octets = 0
+        self.reply_packets = 0
+        # upper bound of the undercount when only the top connections are tracked (see heavy_hitters)
+        self.octets_error = 0
+        self.packets_error = 0
 
-        self.src_data = {}
-        self.dst_data = {}
-        self.app_protocol = None
+        self.src_country = None
+        self.dst_country = None
+        # filled in by the reverse DNS resolver (when RESOLVE_DOMAINS is set)
+        self.src_domain = None
+        self.dst_domain = None
 
         self.finished = False
         self.duration = last_seen - first_seen
@@ -85,18 +195,113 @@ class Connection:
             self.bps = (octets * 8) / self.duration
         else:
             self.bps = 0
-        self.bps_str = None
-        self.first_seen_str = None
-        self.last_seen_str = None
         self._id = None
         self.is_enriched = False
+        # changed since it was last emitted (see StatusDB.get_connections)
+        self.dirty = True
+
+    def __getstate__(self):
+        # slot values only, keeps pickles (snapshots, worker results) small
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def __setstate__(self, state):
+        for slot, value in zip(self.__slots__, state):
+            setattr(self, slot, value)
 
-    def get_id(self):
+    @property
+    def src_ip(self) -> str:
+        return unpack_ip(self._src_ip)
+
+    @property
+    def dst_ip(self) -> str:
+        return unpack_ip(self._dst_ip)
+
+    @property
+    def src_data(self) -> dict:
+        return self._data(self.src_country, self.src_domain)
+
+    @property
+    def dst_data(self) -> dict:
+        return self._data(self.dst_country, self.dst_domain)
+
+    def _data(self, country, domain) -> dict:
+        if not self.is_enriched:
+            return {}
+        data = {'country': country}
+        if domain is not None:
+            data['domain'] = domain
+        return data
+
+    @property
+    def app_protocol(self):
+        if not self.is_enriched:
+            return None
+        return get_services().get_app_protocol(self.src_port, self.dst_port, self.protocol)
+
+    @property
+    def bps_str(self):
+        return bps_to_human(self.bps) if self.is_enriched else None
+
+    @property
+    def first_seen_str(self):
+        return time.ctime(self.first_seen) if self.is_enriched else None
+
+    @property
+    def last_seen_str(self):
+        return time.ctime(self.last_seen) if self.is_enriched else None
+
+    def get_id(self) -> bytes:
+        """
+        :return: connection key (see connection_key)
+        """
         if self._id is None:
-            self._id = hash((self.interface_in, self.interface_out, self.src_ip, self.dst_ip, self.src_port,
-                             self.dst_port, self.protocol))
+            self._id = connection_key(self.interface_in, self.interface_out, self._src_ip, self._dst_ip,
+                                      self.src_port, self.dst_port, self.protocol)
         return self._id
 
+    def reverse_id(self) -> bytes:
+        """
+        :return: key of the connection in the opposite direction
+        """
+        return connection_key(self.interface_out, self.interface_in, self._dst_ip, self._src_ip,
+                              self.dst_port, self.src_port, self.protocol)
+
+    def reversed(self) -> 'Connection':
+        """
+        Get the same traffic as a connection in the opposite direction (source and destination swapped, the
+        traffic of each direction moved to the other one)
+        :return: Connection
+        """
+        connection = Connection(self.first_seen, self.last_seen, self.interface_out, self.interface_in,
+                                self._dst_ip, self._src_ip, self.dst_port, self.src_port, self.protocol.value,
+                                self.octets, self.packets)
+        connection.reply_octets = self.octets - self.reply_octets
+        connection.reply_packets = self.packets - self.reply_packets
+        connection.duration = self.duration
+        connection.bps = self.bps
+        return connection
+
+    def merge_reply(self, reply: 'Connection') -> None:
+        """
+        Merge the connection in the opposite direction into this one, its traffic is counted as reply
+        traffic. Both directions of a conversation run concurrently, so the duration is the one of the
+        longest direction.
+        """
+        if self.get_id() != reply.reverse_id():
+            raise ValueError("Cannot merge connections that aren't each other's reply")
+        self.first_seen = min(self.first_seen, reply.first_seen)
+        self.last_seen = max(self.last_seen, reply.last_seen)
+        self.duration = max(self.duration, reply.duration)
+        self.octets += reply.octets
+        self.packets += reply.packets
+        self.reply_octets += reply.octets - reply.reply_octets
+        self.reply_packets += reply.packets - reply.reply_packets
+        if self.duration > 0:
+            self.bps = (self.octets * 8) / self.duration
+        else:
+            self.bps = 0
+        self.dirty = True
+
     def merge(self, new_connection: 'Connection') -> None:
         """
         Update the connection with new information
@@ -112,10 +317,13 @@ class Connection:
             self.duration = new_connection.last_seen - self.first_seen
         self.octets += new_connection.octets
         self.packets += new_connection.packets
+        self.reply_octets += new_connection.reply_octets
+        self.reply_packets += new_connection.reply_packets
         if self.duration > 0:
             self.bps = (self.octets * 8) / self.duration
         else:
             self.bps = 0
+        self.dirty = True
 
     def enrich(self):
         """
@@ -123,25 +331,24 @@ class Connection:
         """
         if self.is_enriched:
             raise ValueError("Connection is already enriched")
-        self.src_data = {
-            'country': get_country(self.src_ip),
-            # 'city': get_city(self.src_ip),
-            # 'asn': get_asn(self.src_ip),
-            # 'domain': get_domain_name(self.src_ip),
-        }
-        self.dst_data = {
-            'country': get_country(self.dst_ip),
-            # 'city': get_city(self.dst_ip),
-            # 'asn': get_asn(self.dst_ip),
-            # 'domain': get_domain_name(self.dst_ip),
-        }
-        self.app_protocol = get_app_protocol(self.dst_port, self.protocol)
-
-        self.bps_str = bps_to_human(self.bps)
-        self.first_seen_str = time.ctime(self.first_seen)
-        self.last_seen_str = time.ctime(self.last_seen)
+        src_ip = self.src_ip
+        dst_ip = self.dst_ip
+        # city and asn are available from lookup() as well
+        self.src_country = _intern(lookup(src_ip)['country'])
+        self.dst_country = _intern(lookup(dst_ip)['country'])
+        reverse_dns = get_reverse_dns()
+        if reverse_dns is not None:
+            # filled in by the resolver once known, the connection doesn't wait for it
+            reverse_dns.resolve(src_ip, lambda domain: self._set_domain('src_domain', domain))
+            reverse_dns.resolve(dst_ip, lambda domain: self._set_domain('dst_domain', domain))
 
         self.is_enriched = True
+        self.dirty = True
+        connections_enriched.inc()
+
+    def _set_domain(self, attribute: str, domain: str):
+        setattr(self, attribute, domain)
+        self.dirty = True
 
     def as_dict(self):
         return {
@@ -156,6 +363,10 @@ class Connection:
             'protocol': self.protocol.name,
             'octets': self.octets,
             'packets': self.packets,
+            'reply_octets': self.reply_octets,
+            'reply_packets': self.reply_packets,
+            'octets_error': self.octets_error,
+            'packets_error': self.packets_error,
             'src_data': self.src_data,
             'dst_data': self.dst_data,
             'app_protocol': self.app_protocol,
@@ -166,3 +377,38 @@ class Connection:
             'first_seen_str':  self.first_seen_str,
             'last_seen_str': self.last_seen_str,
         }
+
+
+def measure_memory(count: int = 100000) -> dict:
+    """
+    Memory benchmark: bytes allocated per connection, before and after enrichment. Connections differ by
+    source port, addresses come from a small pool (like real traffic) so address and GeoIP caches don't
+    dominate the result.
+    :param count: number of connections to create
+    :return: dict
+    """
+    import tracemalloc
+
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    connections = [
+        Connection(1700000000.0 + i, 1700000001.5 + i, 'em0', 'em1', f"10.0.{i >> 8 & 3}.{i & 255}",
+                   f"2001:db8::{i % 4096:x}" if i % 5 == 0 else f"93.184.{i >> 8 & 15}.{i & 255}",
+                   1024 + i % 60000, 443, 6, 1000 + i, 10)
+        for i in range(count)
+    ]
+    created = tracemalloc.get_traced_memory()[0]
+    for connection in connections:
+        connection.enrich()
+    enriched = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return {
+        'connections': len(connections),
+        'bytes_per_connection': (created - start) / count,
+        'bytes_per_enriched_connection': (enriched - start) / count,
+    }
+
+
+if __name__ == '__main__':
+    for key, value in measure_memory().items():
+        print(f"{key}: {value:.0f}")
@@ -1,73 +1,155 @@
 #!./venv/bin/python3
 import json
-import sys
-sys.path.append('/usr/local/opnsense/scripts/netflow/')
-
-import socket
 import time
-from lib.parse import parse_flow
+from typing import Literal
+from biflow import pair_connections
 from connection import Connection
-from cProfile import Profile
-from pstats import SortKey, Stats
+from flow_tail import FlowLogTail
+from flow_shards import ShardedAggregator, rank_connections
+from heavy_hitters import SpaceSaving
+from metrics import connections_aggregated, flows_parsed, log_bytes_read, stage_duration
+from flowd_decoder import (FLOW_RECV_SEC, FLOW_START, FLOW_END, FLOW_IF_IN, FLOW_IF_OUT, FLOW_SRC_ADDR,
+                           FLOW_DST_ADDR, FLOW_SRC_PORT, FLOW_DST_PORT, FLOW_PROTOCOL, FLOW_OCTETS, FLOW_PACKETS)
+from functools import partial
+from utils import getenv
+
+try:
+    from flow_columns import aggregate_connections, concat_columns, decode_columns
+except ImportError:
+    # numpy not available, fall back to merging flow by flow
+    aggregate_connections = None
 
 FLOWD_LOG_FILE = '/var/log/flowd.log'
+FLOWD_CHECKPOINT_FILE = '/var/db/netmon_flowd_checkpoint.json'
 
+# number of worker processes aggregating the log in parallel (0: aggregate in this process)
+FLOW_WORKERS = int(getenv("FLOW_WORKERS", "0"))
+# 1: merge the request and reply directions of a conversation into one connection
+BIFLOW = getenv("BIFLOW", "0") == "1"
 
-def flow_addr_byte_to_str(flow_record):
-    for key, value in flow_record.items():
-        if isinstance(value, bytes):
-            if 'addr4' in key:
-                flow_record[key] = socket.inet_ntop(socket.AF_INET, value)
-            elif 'addr6' in key:
-                flow_record[key] = socket.inet_ntop(socket.AF_INET6, value)
-            else:
-                raise ValueError(f'KEY: {key} is of type bytes! (not compatible with JSON)')
-    return flow_record
+# the daemon's position in the flowd log (see StatusDB), main() below uses a tail of its own
+flow_tail = FlowLogTail(FLOWD_LOG_FILE, FLOWD_CHECKPOINT_FILE)
+sharded_aggregator = ShardedAggregator(FLOW_WORKERS) if FLOW_WORKERS > 0 else None
 
 
-def get_last_connections(duration_in_seconds, max_hits) -> list[Connection]:
+def get_last_connections(duration_in_seconds, max_hits=None,
+                         value: Literal["octets", "packets"] = "octets") -> list[Connection]:
+    """
+    Get top connections from the flowd log, in BIFLOW mode both directions of a conversation are reported as
+    one connection (see biflow.pair_connections). When the aggregation fails the log position is moved back,
+    so the next call reads the same records again.
+    :param duration_in_seconds: Duration of the timeframe (seconds) from now to look for connections, only
+                                used on the first read of a log without checkpoint (see read_connections)
+    :param max_hits: Maximum number of hits to return (None for all), traffic of the remaining connections
+                     is reported in an "other" bucket appended to the list
+    :param value: field to rank connections on
+    :return: list
     """
-    Get top connections from a provider for a given timeframe\
-    :param duration_in_seconds: Duration of the timeframe (seconds) from now to look for connections
-    :param max_hits: Maximum number of hits to return
+    inode, offset = flow_tail.inode, flow_tail.offset
+    try:
+        with stage_duration.time('aggregate'):
+            if BIFLOW:
+                # pair before ranking, so the directions of a conversation are ranked together
+                connections = rank_connections(pair_connections(read_connections(duration_in_seconds, None, value)),
+                                               max_hits, value)
+            else:
+                connections = read_connections(duration_in_seconds, max_hits, value)
+    except Exception:
+        # nothing of the segment was aggregated, move the log position back so the next refresh reads it again
+        flow_tail.inode, flow_tail.offset = inode, offset
+        flow_tail.save_checkpoint()
+        raise
+    # after a rotation the remainder of the old log was read as well, only the new one is counted
+    log_bytes_read.inc(flow_tail.offset - offset if flow_tail.inode == inode else flow_tail.offset)
+    connections_aggregated.inc(len(connections))
+    return connections
+
+
+def read_connections(duration_in_seconds, max_hits=None,
+                     value: Literal["octets", "packets"] = "octets") -> list[Connection]:
+    """
+    Get top connections from the flowd log.
+    Only records appended since the previous call are read (see FlowLogTail). Records older than the timeframe
+    are only skipped when there is no log position yet (first start without checkpoint), once there is one
+    every unread record is aggregated: a late refresh or a restart must not drop flows the checkpoint
+    already moved past.
+    :param duration_in_seconds: Duration of the timeframe (seconds) from now to look for connections, only
+                                used on the first read of a log without checkpoint
+    :param max_hits: Maximum number of hits to return (None for all), traffic of the remaining connections
+                     is reported in an "other" bucket appended to the list
+    :param value: field to rank connections on
     :return: list
     """
-    connections: dict[str, Connection] = {}
-
-    timestamp = int(time.time()) - duration_in_seconds
-    print("Getting top connections for the following period:")
-    print(f"Start time: {time.ctime(timestamp)}")
-    for flow_record in parse_flow(timestamp, FLOWD_LOG_FILE):
-        if flow_record is not None:
-            flow_record = flow_addr_byte_to_str(flow_record)
+    connections: dict[bytes, Connection] = {}
+    top_connections = SpaceSaving(max_hits, value) if max_hits is not None else None
+
+    timestamp = int(time.time()) - duration_in_seconds if flow_tail.inode is None else 0
+    if timestamp:
+        print("Getting top connections for the following period:")
+        print(f"Start time: {time.ctime(timestamp)}")
+    else:
+        print(f"Getting top connections since {flow_tail.log_file} offset {flow_tail.offset}")
+    if sharded_aggregator is not None:
+        if max_hits is not None:
+            connections_list = sharded_aggregator.read_top(flow_tail, timestamp, max_hits, value)
+        else:
+            connections_list = rank_connections(sharded_aggregator.read_new(flow_tail, timestamp), value=value)
+        print("Connections found:", len(connections_list))
+        return connections_list
+
+    if aggregate_connections is not None:
+        columns = concat_columns(list(flow_tail.read_new(partial(decode_columns, flow_tail.decoder))))
+        recent = columns['recv_sec'] >= timestamp
+        flows_parsed.inc(int(recent.sum()))
+        connections_list = aggregate_connections({name: column[recent] for name, column in columns.items()},
+                                                 flow_tail.decoder, max_hits, value)
+        print("Connections found:", len(connections_list))
+        return connections_list
+
+    flow_count = 0
+    for flow in flow_tail.read_new():
+        if flow[FLOW_RECV_SEC] >= timestamp:
+            flow_count += 1
             connection = Connection(
-                first_seen=flow_record['flow_start'],
-                last_seen=flow_record['flow_end'],
-                interface_in=flow_record['if_in'],
-                interface_out=flow_record['if_out'],
-                src_ip=flow_record['src_addr'],
-                dst_ip=flow_record['dst_addr'],
-                src_port=flow_record['src_port'],
-                dst_port=flow_record['dst_port'],
-                transport_protocol=flow_record['protocol'],
-                octets=flow_record['octets'],
-                packets=flow_record['packets']
+                first_seen=flow[FLOW_START],
+                last_seen=flow[FLOW_END],
+                interface_in=flow[FLOW_IF_IN],
+                interface_out=flow[FLOW_IF_OUT],
+                src_ip=flow[FLOW_SRC_ADDR],
+                dst_ip=flow[FLOW_DST_ADDR],
+                src_port=flow[FLOW_SRC_PORT],
+                dst_port=flow[FLOW_DST_PORT],
+                transport_protocol=flow[FLOW_PROTOCOL],
+                octets=flow[FLOW_OCTETS],
+                packets=flow[FLOW_PACKETS]
             )
 
-            if connection.get_id() in connections:
+            if top_connections is not None:
+                top_connections.add(connection)
+            elif connection.get_id() in connections:
                 connections[connection.get_id()].merge(connection)
             else:
                 connections[connection.get_id()] = connection
 
-    # sort by octets
+    flows_parsed.inc(flow_count)
+    if top_connections is not None:
+        connections_list = top_connections.top()
+        print("Connections found:", len(connections_list))
+        return connections_list
+
+    # sort by value
     connections_list = list(connections.values())
     print("Connections found:", len(connections_list))
-    connections_list.sort(key=lambda c: c.octets, reverse=True)
+    connections_list.sort(key=lambda c: getattr(c, value), reverse=True)
 
     return connections_list
 
 
 def main():
+    global flow_tail
+    # without checkpoint: reads the last 60 seconds of the log, and running it doesn't move the daemon's
+    # checkpoint past flows it hasn't seen yet
+    flow_tail = FlowLogTail(FLOWD_LOG_FILE)
     print("Getting last connections...")
     conns = get_last_connections(60, 2)
     print(f"Found {len(conns)} connections")
@@ -80,13 +162,16 @@ def main():
 
 
 if __name__ == '__main__':
+    from cProfile import Profile
+    from pstats import SortKey, Stats
+
     with (Profile() as profile):
         main()
         Stats(profile).strip_dirs().sort_stats(SortKey.CALLS).print_stats()
 
 
 
-# parse_flow returns a dict with the following keys
+# flowd_decoder.parse_flow (and opnsense's lib.parse.parse_flow) returns a dict with the following keys
 # {
 #   "recv_time": [
 #     1713729856,
@@ -1,23 +1,34 @@
 #!./venv/bin/python3
-import sys
-sys.path.append('/usr/local/opnsense/scripts/netflow/')
-
-import socket
 import ujson
 import argparse
+import struct
+import sys
 from datetime import datetime, timedelta
-from lib.parse import parse_flow
+from flowd_decoder import parse_flow
+
+# msgpack and pyarrow are only imported for their output format (optional, slow to import)
+# records are serialized and written in batches of this size
+BATCH_SIZE = 10000
+WRITE_BUFFER_SIZE = 1 << 20
+ROW_GROUP_SIZE = 100000
+
+# length prefix of a msgpack record
+MSGPACK_LENGTH = struct.Struct('>I')
 
-def flow_addr4_byte_to_str(flow_record):
-    for key, value in flow_record.items():
-        if isinstance(value, bytes):
-            if 'addr4' in key:
-                flow_record[key] = socket.inet_ntop(socket.AF_INET, value)
-            elif 'addr6' in key:
-                flow_record[key] = socket.inet_ntop(socket.AF_INET6, value)
-            else:
-                raise ValueError(f'KEY: {key} is of type bytes! (not compatible with JSON)')
-    return flow_record
+# columns of a columnar export when no fields are selected (the address family independent fields)
+DEFAULT_COLUMNAR_FIELDS = ['recv_sec', 'recv_usec', 'flow_start', 'flow_end', 'duration_ms', 'if_in', 'if_out',
+                           'src_addr', 'dst_addr', 'src_port', 'dst_port', 'protocol', 'tcp_flags', 'tos',
+                           'octets', 'packets', 'agent_addr', 'gateway_addr', 'netflow_ver']
+
+# pyarrow types of the record fields, other fields are inferred
+COLUMN_TYPES = {
+    'recv_sec': 'uint32', 'recv': 'uint32', 'recv_usec': 'uint32', 'sys_uptime_ms': 'uint32',
+    'netflow_ver': 'uint16', 'flow_start': 'float64', 'flow_end': 'float64', 'flow_finish': 'uint32',
+    'duration_ms': 'int64', 'if_in': 'string', 'if_out': 'string', 'if_ndx_in': 'uint32', 'if_ndx_out': 'uint32',
+    'src_addr': 'string', 'dst_addr': 'string', 'agent_addr': 'string', 'gateway_addr': 'string',
+    'src_port': 'uint16', 'dst_port': 'uint16', 'protocol': 'uint8', 'tcp_flags': 'uint8', 'tos': 'uint8',
+    'octets': 'uint64', 'packets': 'uint64', 'tag': 'uint32',
+}
 
 
 def parse_time(time_str):
@@ -38,26 +49,192 @@ def parse_time(time_str):
 
 
 def get_timestamp(cmd_args):
-    if cmd_args.relative_time:
-        return cmd_args.relative_time
-    else:
+    # --relative-time has a default, an explicit --timestamp takes precedence
+    if cmd_args.timestamp is not None:
         return cmd_args.timestamp
+    return cmd_args.relative_time
+
+
+def get_end_timestamp(cmd_args):
+    if cmd_args.end_timestamp is not None:
+        return cmd_args.end_timestamp
+    return cmd_args.end_relative_time
+
+
+class NDJSONWriter:
+    """
+    One JSON document per line (indented when pretty, which is no longer NDJSON)
+    """
+
+    def __init__(self, out, pretty: bool = False):
+        self.out = out
+        self.indent = 4 if pretty else 0
+
+    def write_batch(self, records: list[dict]):
+        self.out.write(''.join(ujson.dumps(record, reject_bytes=False, indent=self.indent) + '\n'
+                               for record in records).encode())
+
+    def close(self):
+        self.out.flush()
+
+
+class MsgpackWriter:
+    """
+    Records as msgpack maps, each preceded by its length (4 bytes, big endian)
+    """
+
+    def __init__(self, out):
+        try:
+            import msgpack
+        except ImportError:
+            raise RuntimeError('msgpack output requires the msgpack package')
+        self.out = out
+        self._packer = msgpack.Packer()
+
+    def write_batch(self, records: list[dict]):
+        chunks = []
+        for record in records:
+            data = self._packer.pack(record)
+            chunks.append(MSGPACK_LENGTH.pack(len(data)))
+            chunks.append(data)
+        self.out.write(b''.join(chunks))
+
+    def close(self):
+        self.out.flush()
+
+
+class ParquetWriter:
+    """
+    Columnar (Parquet) output, records are collected per column and written in row groups
+    """
+
+    def __init__(self, out, fields: list[str], row_group_size: int = ROW_GROUP_SIZE):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError('parquet output requires the pyarrow package')
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self.out = out
+        self.fields = fields
+        self.row_group_size = row_group_size
+        self._columns = {field: [] for field in fields}
+        self._rows = 0
+        self._writer = None
+
+    def write_batch(self, records: list[dict]):
+        for field, column in self._columns.items():
+            column.extend(record.get(field) for record in records)
+        self._rows += len(records)
+        if self._rows >= self.row_group_size:
+            self._flush()
+
+    def _flush(self):
+        if self._rows == 0:
+            return
+        pa = self._pa
+        if self._writer is None:
+            # fixed types for the known fields, so a column that starts with nulls keeps its type
+            inferred = pa.Table.from_pydict(self._columns).schema
+            schema = pa.schema([
+                pa.field(field, getattr(pa, COLUMN_TYPES[field])() if field in COLUMN_TYPES
+                         else inferred.field(field).type)
+                for field in self.fields
+            ])
+            self._writer = self._pq.ParquetWriter(self.out, schema)
+        self._writer.write_table(pa.Table.from_pydict(self._columns, schema=self._writer.schema),
+                                 row_group_size=self.row_group_size)
+        self._columns = {field: [] for field in self.fields}
+        self._rows = 0
+
+    def close(self):
+        self._flush()
+        if self._writer is not None:
+            self._writer.close()
+        self.out.flush()
+
+
+def select_fields(records, fields: list[str]):
+    """
+    Keep only the given fields of every record
+    :param records: iterator of flow records
+    :param fields: field names, missing fields are None
+    :return: iterator of flow records
+    """
+    for record in records:
+        yield {field: record.get(field) for field in fields}
+
+
+def export(records, writer, batch_size: int = BATCH_SIZE) -> int:
+    """
+    Write records in batches
+    :param records: iterator of flow records
+    :param writer: NDJSONWriter, MsgpackWriter or ParquetWriter
+    :param batch_size: number of records per write
+    :return: number of records written
+    """
+    count = 0
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            writer.write_batch(batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        writer.write_batch(batch)
+        count += len(batch)
+    writer.close()
+    return count
+
+
+def flows_between(start_timestamp: int, end_timestamp: int, flowd_source: str):
+    """
+    Flow records received between start_timestamp and end_timestamp (inclusive, None for no end)
+    """
+    for record in parse_flow(start_timestamp, flowd_source):
+        if end_timestamp is None or record['recv_sec'] <= end_timestamp:
+            yield record
+
 
 if __name__ == '__main__':
     # parse arguments and load config
     parser = argparse.ArgumentParser()
     group = parser.add_mutually_exclusive_group()
-    parser.add_argument('-p', help='pretty print')
+    end_group = parser.add_mutually_exclusive_group()
+    parser.add_argument('-p', help='pretty print (ndjson)', action='store_true')
     parser.add_argument('--log', help='flowd log file', default='/var/log/flowd.log')
     group.add_argument('--timestamp', help='start timestamp (epoch)', type=int)
     group.add_argument('--relative-time', help='specify time relative to now (last hour/minute/second/day). Examples: "1h", "15m", "30s", "2d"', type=parse_time, default='1m')
+    end_group.add_argument('--end-timestamp', help='end timestamp (epoch)', type=int)
+    end_group.add_argument('--end-relative-time', help='end time relative to now, same format as --relative-time', type=parse_time)
+    parser.add_argument('--fields', help='comma separated fields to export (default: all)')
+    parser.add_argument('--format', help='output format', choices=['ndjson', 'msgpack', 'parquet'], default='ndjson')
+    parser.add_argument('--output', help='output file (default: stdout)')
+    parser.add_argument('--batch-size', help='records per write', type=int, default=BATCH_SIZE)
+    parser.add_argument('--row-group-size', help='rows per parquet row group', type=int, default=ROW_GROUP_SIZE)
     cmd_args = parser.parse_args()
 
-    timestamp = get_timestamp(cmd_args)
-    count = 0
-    for flow_record in parse_flow(timestamp, cmd_args.log):
-        if flow_record is not None:
-            flow_record = flow_addr4_byte_to_str(flow_record)
-            count += 1
-            #print(count)
-            print(ujson.dumps(flow_record, reject_bytes=False))
+    fields = cmd_args.fields.split(',') if cmd_args.fields else None
+    if fields is None and cmd_args.format == 'parquet':
+        fields = DEFAULT_COLUMNAR_FIELDS
+    out = open(cmd_args.output, 'wb', buffering=WRITE_BUFFER_SIZE) if cmd_args.output else \
+        open(sys.stdout.fileno(), 'wb', buffering=WRITE_BUFFER_SIZE, closefd=False)
+    try:
+        if cmd_args.format == 'msgpack':
+            writer = MsgpackWriter(out)
+        elif cmd_args.format == 'parquet':
+            writer = ParquetWriter(out, fields, cmd_args.row_group_size)
+        else:
+            writer = NDJSONWriter(out, cmd_args.p)
+    except RuntimeError as e:
+        parser.error(str(e))
+
+    records = flows_between(get_timestamp(cmd_args), get_end_timestamp(cmd_args), cmd_args.log)
+    if fields is not None:
+        records = select_fields(records, fields)
+    try:
+        export(records, writer, cmd_args.batch_size)
+    finally:
+        out.close()
@@ -0,0 +1,308 @@
+import socket
+from typing import Literal
+
+import numpy as np
+
+from connection import IPV6_FLAG, Connection
+from flowd_decoder import HEADER, FlowdDecoder, RecordLayout
+from heavy_hitters import other_connection
+from network_enums import Protocol
+
+# columns of a decoded flow batch, IP addresses are split into two 64 bit halves (IPv4: hi = 0, lo = address)
+COLUMNS = {
+    'recv_sec': np.int64,
+    'flow_start': np.float64,
+    'flow_end': np.float64,
+    'if_in': np.int64,
+    'if_out': np.int64,
+    'family': np.int64,
+    'src_hi': np.uint64,
+    'src_lo': np.uint64,
+    'dst_hi': np.uint64,
+    'dst_lo': np.uint64,
+    'src_port': np.int64,
+    'dst_port': np.int64,
+    'protocol': np.int64,
+    'octets': np.int64,
+    'packets': np.int64,
+}
+
+# fields that make up the connection key, same order as Connection.get_id()
+KEY_COLUMNS = ('if_in', 'if_out', 'family', 'src_hi', 'src_lo', 'dst_hi', 'dst_lo', 'src_port', 'dst_port',
+               'protocol')
+
+KNOWN_PROTOCOLS = np.array([p.value for p in Protocol if p != Protocol.unknown], dtype=np.int64)
+
+
+def empty_columns() -> dict[str, np.ndarray]:
+    return {name: np.zeros(0, dtype=dtype) for name, dtype in COLUMNS.items()}
+
+
+def concat_columns(batches: list[dict[str, np.ndarray]]) -> dict[str, np.ndarray]:
+    if not batches:
+        return empty_columns()
+    if len(batches) == 1:
+        return batches[0]
+    return {name: np.concatenate([batch[name] for batch in batches]) for name in COLUMNS}
+
+
+def _run_dtype(layout: RecordLayout, stride: int) -> np.dtype:
+    """
+    Structured dtype that maps every field a Connection needs for a run of records sharing one layout
+    :param layout: record layout (field offsets)
+    :param stride: record size including header
+    :return: np.dtype
+    """
+    fields = [('header', '>u8', 0)]
+
+    def add(name, fmt, offset):
+        if offset is not None:
+            fields.append((name, fmt, HEADER.size + offset))
+
+    add('recv_sec', '>u4', layout.recv_time)
+    add('sys_uptime_ms', '>u4', layout.agent_info)
+    if layout.flow_times is not None:
+        add('flow_start', '>u4', layout.flow_times)
+        add('flow_finish', '>u4', layout.flow_times + 4)
+    if layout.if_indices is not None:
+        add('if_in', '>u4', layout.if_indices)
+        add('if_out', '>u4', layout.if_indices + 4)
+    if layout.srcdst_port is not None:
+        add('src_port', '>u2', layout.srcdst_port)
+        add('dst_port', '>u2', layout.srcdst_port + 2)
+    if layout.proto_flags_tos is not None:
+        add('protocol', 'u1', layout.proto_flags_tos + 1)
+    add('octets', '>u8', layout.octets)
+    add('packets', '>u8', layout.packets)
+    for prefix in ('src', 'dst'):
+        offset = getattr(layout, prefix + '_addr')
+        if offset is None:
+            continue
+        if getattr(layout, prefix + '_family') == socket.AF_INET:
+            add(prefix + '_lo', '>u4', offset)
+        else:
+            add(prefix + '_hi', '>u8', offset)
+            add(prefix + '_lo', '>u8', offset + 8)
+    return np.dtype({
+        'names': [f[0] for f in fields],
+        'formats': [f[1] for f in fields],
+        'offsets': [f[2] for f in fields],
+        'itemsize': stride,
+    })
+
+
+def _decode_records(records: np.ndarray, layout: RecordLayout) -> dict[str, np.ndarray]:
+    """
+    Convert a structured array of records sharing one layout (see _run_dtype) into a column batch
+    :param records: structured array of records
+    :param layout: record layout (field offsets)
+    :return: column batch (see COLUMNS)
+    """
+    count = len(records)
+    names = records.dtype.names
+
+    def column(name, dtype):
+        if name in names:
+            return records[name].astype(dtype)
+        return np.zeros(count, dtype=dtype)
+
+    recv_sec = column('recv_sec', np.int64)
+    sys_uptime_ms = column('sys_uptime_ms', np.int64)
+    if 'flow_start' in names:
+        flow_start = column('flow_start', np.int64)
+        flow_finish = column('flow_finish', np.int64)
+    else:
+        flow_start = flow_finish = sys_uptime_ms
+    return {
+        'recv_sec': recv_sec,
+        'flow_start': recv_sec - (sys_uptime_ms - flow_start) / 1000.0,
+        'flow_end': recv_sec - (sys_uptime_ms - flow_finish) / 1000.0,
+        'if_in': column('if_in', np.int64),
+        'if_out': column('if_out', np.int64),
+        'family': np.full(count, 4 if layout.src_family == socket.AF_INET else 6, dtype=np.int64),
+        'src_hi': column('src_hi', np.uint64),
+        'src_lo': column('src_lo', np.uint64),
+        'dst_hi': column('dst_hi', np.uint64),
+        'dst_lo': column('dst_lo', np.uint64),
+        'src_port': column('src_port', np.int64),
+        'dst_port': column('dst_port', np.int64),
+        'protocol': column('protocol', np.int64),
+        'octets': column('octets', np.int64),
+        'packets': column('packets', np.int64),
+    }
+
+
+def _decode_uniform(decoder: FlowdDecoder, buf, start: int, end: int):
+    """
+    Fast path: decode buf[start:end] at once when every complete record in it carries the same header,
+    which is the common case for a flowd log that only sees IPv4 (or only IPv6) traffic.
+    :return: (end offset of the decoded records, column batch) or None when the headers differ
+    """
+    _, len_words, _, data_fields = HEADER.unpack_from(buf, start)
+    stride = HEADER.size + len_words * 4
+    layout = decoder.layout(data_fields)
+    count = (end - start) // stride
+    if not layout.valid or count == 0:
+        return None
+    records = np.frombuffer(buf, dtype=_run_dtype(layout, stride), count=count, offset=start)
+    if not (records['header'] == records['header'][0]).all():
+        return None
+    return start + count * stride, _decode_records(records, layout)
+
+
+def decode_columns(decoder: FlowdDecoder, buf, start: int = 0, end: int = None):
+    """
+    Vectorized counterpart of FlowdDecoder.decode, yields a column batch (see COLUMNS) instead of tuples.
+    Records are located with a cheap header-only scan, then all records sharing a header (so a layout and a
+    size) are gathered and decoded at once through a structured NumPy view. Log order is preserved.
+    The gather only copies the records of a group (through a view that has a record starting at every byte,
+    indexed by record offset), so memory stays around the size of the segment.
+    decoder.offset always points just after the last record consumed.
+    :param decoder: decoder holding the read position and cached layouts
+    :param buf: buffer (memoryview, mmap, bytes) containing flowd records
+    :param start: offset of the first record
+    :param end: end of the valid data in buf
+    :return: iterator column batches
+    """
+    if end is None:
+        end = len(buf)
+    decoder.offset = start
+    if start + HEADER.size > end:
+        return
+
+    uniform = _decode_uniform(decoder, buf, start, end)
+    if uniform is not None:
+        decoder.offset, batch = uniform
+        yield batch
+        return
+
+    # header scan, group record offsets per (field mask, size)
+    groups: dict[tuple[int, int], list[int]] = {}
+    header_unpack = HEADER.unpack_from
+    pos = start
+    while pos + HEADER.size <= end:
+        _, len_words, _, data_fields = header_unpack(buf, pos)
+        stride = HEADER.size + len_words * 4
+        if pos + stride > end:
+            # record still being written
+            break
+        offsets = groups.get((data_fields, stride))
+        if offsets is None:
+            offsets = groups[(data_fields, stride)] = []
+        offsets.append(pos)
+        pos += stride
+    decoder.offset = pos
+
+    batches = []
+    positions = []
+    for (data_fields, stride), offsets in groups.items():
+        layout = decoder.layout(data_fields)
+        if not layout.valid:
+            # incomplete (invalid) records, skip
+            continue
+        offsets = np.array(offsets, dtype=np.int64)
+        # overlapping view, element i is the record that would start at start + i (nothing is copied)
+        candidates = np.ndarray((pos - start - stride + 1,), dtype=_run_dtype(layout, stride), buffer=buf,
+                                offset=start, strides=(1,))
+        records = candidates[offsets - start]
+        # the view holds an export of buf (an mmap can't be closed while it exists), the records are a copy
+        del candidates
+        batches.append(_decode_records(records, layout))
+        positions.append(offsets)
+    if not batches:
+        return
+    batch = concat_columns(batches)
+    order = np.argsort(np.concatenate(positions), kind='stable')
+    yield {name: column[order] for name, column in batch.items()}
+
+
+def _pack_address(family: int, hi: int, lo: int) -> int:
+    # same encoding as connection.pack_ip
+    if family == 4:
+        return lo
+    return (hi << 64) | lo | IPV6_FLAG
+
+
+def aggregate_connections(columns: dict[str, np.ndarray], decoder: FlowdDecoder, max_hits: int = None,
+                          value: Literal["octets", "packets"] = "octets") -> list[Connection]:
+    """
+    Group flows by connection key with a stable sort and reduceat, and only create a Connection for every
+    resulting group. Matches merging the flows one by one with Connection.merge (in log order).
+
+    With max_hits the ranking is exact (no error bounds): the columns already hold every flow of the refresh,
+    the per connection arrays add a few dozen bytes per connection and Connection objects are only created
+    for the top max_hits. So unlike the heavy-hitter summary of the other paths (heavy_hitters.SpaceSaving),
+    memory follows the number of flows and connections rather than max_hits.
+    :param columns: column batch (see COLUMNS)
+    :param decoder: decoder used for (cached) interface name lookups
+    :param max_hits: only return the top max_hits connections, the rest is summed into an "other" bucket
+    :param value: field to rank connections on
+    :return: list of connections, sorted by value (descending)
+    """
+    count = len(columns['recv_sec'])
+    if count == 0:
+        return []
+    protocol = np.where(np.isin(columns['protocol'], KNOWN_PROTOCOLS), columns['protocol'], Protocol.unknown.value)
+    keys = {name: columns[name] for name in KEY_COLUMNS}
+    keys['protocol'] = protocol
+
+    # np.lexsort sorts on the last key first, and is stable so flows keep their log order within a group
+    order = np.lexsort([keys[name] for name in reversed(KEY_COLUMNS)])
+    is_start = np.zeros(count, dtype=bool)
+    is_start[0] = True
+    for name in KEY_COLUMNS:
+        sorted_key = keys[name][order]
+        is_start[1:] |= sorted_key[1:] != sorted_key[:-1]
+    starts = np.flatnonzero(is_start)
+    ends = np.append(starts[1:], count) - 1
+
+    flow_start = columns['flow_start'][order]
+    flow_end = columns['flow_end'][order]
+    duration = flow_end - flow_start
+
+    # Connection.merge: a flow with a positive duration extends the total duration, any other flow resets
+    # it to (flow end - first seen). Sum the durations per segment between resets, keep the last segment.
+    group_id = np.cumsum(is_start) - 1
+    first_seen = flow_start[starts]
+    reset = ~is_start & (duration <= 0)
+    contribution = np.where(reset, flow_end - first_seen[group_id], duration)
+    segment_starts = np.flatnonzero(is_start | reset)
+    segment_sums = np.add.reduceat(contribution, segment_starts)
+    total_duration = segment_sums[np.searchsorted(segment_starts, ends, side='right') - 1]
+
+    octets = np.add.reduceat(columns['octets'][order], starts)
+    packets = np.add.reduceat(columns['packets'][order], starts)
+
+    # sort by value, ties in order of first appearance (like a stable sort over an insertion ordered dict)
+    ranking = np.lexsort((order[starts], -(octets if value == 'octets' else packets)))
+
+    connections = []
+    if max_hits is not None and len(ranking) > max_hits:
+        tail = ranking[max_hits:]
+        ranking = ranking[:max_hits]
+        other = other_connection(float(first_seen[tail].min()), float(flow_end[ends[tail]].max()),
+                                 int(octets[tail].sum()), int(packets[tail].sum()))
+    else:
+        other = None
+    for idx in ranking.tolist():
+        first = int(order[starts[idx]])
+        family = int(columns['family'][first])
+        connection = Connection(
+            first_seen=float(first_seen[idx]),
+            last_seen=float(flow_end[ends[idx]]),
+            interface_in=decoder.interface_name(int(columns['if_in'][first])),
+            interface_out=decoder.interface_name(int(columns['if_out'][first])),
+            src_ip=_pack_address(family, int(columns['src_hi'][first]), int(columns['src_lo'][first])),
+            dst_ip=_pack_address(family, int(columns['dst_hi'][first]), int(columns['dst_lo'][first])),
+            src_port=int(columns['src_port'][first]),
+            dst_port=int(columns['dst_port'][first]),
+            transport_protocol=int(protocol[first]),
+            octets=int(octets[idx]),
+            packets=int(packets[idx])
+        )
+        connection.duration = float(total_duration[idx])
+        connection.bps = (connection.octets * 8) / connection.duration if connection.duration > 0 else 0
+        connections.append(connection)
+    if other is not None:
+        connections.append(other)
+    return connections
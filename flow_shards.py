@@ -0,0 +1,258 @@
+import os
+from concurrent.futures import Executor
+from functools import partial
+from typing import Literal
+
+from connection import Connection
+from flowd_decoder import (HEADER, FlowdDecoder, map_file, FLOW_RECV_SEC, FLOW_START, FLOW_END, FLOW_IF_IN,
+                           FLOW_IF_OUT, FLOW_SRC_ADDR, FLOW_DST_ADDR, FLOW_SRC_PORT, FLOW_DST_PORT, FLOW_PROTOCOL,
+                           FLOW_OCTETS, FLOW_PACKETS)
+from flow_tail import FlowLogTail
+from heavy_hitters import SpaceSaving, other_connection
+
+# segments smaller than this are aggregated in the calling process, a worker round trip isn't worth it
+MIN_SHARD_SIZE = 1 << 20
+
+
+def split_records(buf, start: int, end: int, parts: int) -> tuple[list[tuple[int, int]], int]:
+    """
+    Split buf[start:end] into at most parts byte ranges of about equal size, on record boundaries.
+    Only the record headers are read.
+    :param buf: buffer containing flowd records
+    :param start: offset of the first record
+    :param end: end of the valid data in buf
+    :param parts: number of ranges
+    :return: list of (start, end) ranges and the offset just after the last complete record
+    """
+    header_unpack = HEADER.unpack_from
+    shard_size = max((end - start) // parts, 1)
+    ranges = []
+    shard_start = pos = start
+    next_split = start + shard_size
+    while pos + HEADER.size <= end:
+        record_end = pos + HEADER.size + header_unpack(buf, pos)[1] * 4
+        if record_end > end:
+            # record still being written
+            break
+        pos = record_end
+        if pos >= next_split and len(ranges) < parts - 1:
+            ranges.append((shard_start, pos))
+            shard_start = pos
+            next_split = pos + shard_size
+    if pos > shard_start:
+        ranges.append((shard_start, pos))
+    return ranges, pos
+
+
+def _read_range(filename: str, start: int, end: int, timestamp: int):
+    """
+    Connections of the single flows in one byte range of a flowd log
+    :return: iterator Connection
+    """
+    decoder = FlowdDecoder()
+    mm = map_file(filename)
+    if mm is None:
+        return
+    try:
+        with memoryview(mm) as mv:
+            for flow in decoder.decode(mv, start, min(end, len(mv))):
+                if flow[FLOW_RECV_SEC] < timestamp:
+                    continue
+                yield Connection(
+                    first_seen=flow[FLOW_START],
+                    last_seen=flow[FLOW_END],
+                    interface_in=flow[FLOW_IF_IN],
+                    interface_out=flow[FLOW_IF_OUT],
+                    src_ip=flow[FLOW_SRC_ADDR],
+                    dst_ip=flow[FLOW_DST_ADDR],
+                    src_port=flow[FLOW_SRC_PORT],
+                    dst_port=flow[FLOW_DST_PORT],
+                    transport_protocol=flow[FLOW_PROTOCOL],
+                    octets=flow[FLOW_OCTETS],
+                    packets=flow[FLOW_PACKETS]
+                )
+    finally:
+        mm.close()
+
+
+def _track_duration(durations: dict[bytes, list], conn_id: bytes, connection: Connection, is_new: bool):
+    # [reset_end, duration_sum] of a connection, see aggregate_range
+    if is_new:
+        if connection.duration > 0:
+            durations[conn_id] = [None, connection.duration]
+        else:
+            durations[conn_id] = [connection.last_seen, 0]
+    elif connection.duration > 0:
+        durations[conn_id][1] += connection.duration
+    else:
+        durations[conn_id] = [connection.last_seen, 0]
+
+
+def aggregate_range(filename: str, start: int, end: int, timestamp: int) -> list[tuple[Connection, float, float]]:
+    """
+    Merge the flows of one byte range of a flowd log (runs in a worker process).
+
+    Besides the merged connection, the effect of the range on the duration of a connection seen in an
+    earlier range is returned, so the ranges can be combined with the same result as merging every flow
+    in log order (see merge_shards): Connection.merge adds the duration of a flow, unless it is not
+    positive, in which case the duration restarts at first_seen.
+    :param filename: flowd log
+    :param start: offset of the first record of the range
+    :param end: offset after the last record of the range
+    :param timestamp: skip flows received before this time
+    :return: list of (connection, reset_end, duration_sum), in order of first appearance. reset_end is the
+             flow end of the last duration reset in the range (None when there was none), duration_sum the
+             sum of the positive durations after it
+    """
+    connections: dict[bytes, Connection] = {}
+    durations: dict[bytes, list] = {}
+    for connection in _read_range(filename, start, end, timestamp):
+        conn_id = connection.get_id()
+        existing = connections.get(conn_id)
+        _track_duration(durations, conn_id, connection, existing is None)
+        if existing is None:
+            connections[conn_id] = connection
+        else:
+            existing.merge(connection)
+    return [(connection, *durations[conn_id]) for conn_id, connection in connections.items()]
+
+
+def top_range(filename: str, start: int, end: int, timestamp: int, max_hits: int,
+              value: Literal["octets", "packets"] = "octets") -> tuple[SpaceSaving, dict[bytes, tuple]]:
+    """
+    Heavy-hitter counterpart of aggregate_range (runs in a worker process): the flows of the range are
+    counted in a SpaceSaving summary, so the memory of the worker and the size of its result are bounded
+    by max_hits instead of the number of distinct connections
+    :param filename: flowd log
+    :param start: offset of the first record of the range
+    :param end: offset after the last record of the range
+    :param timestamp: skip flows received before this time
+    :param max_hits: number of connections to report
+    :param value: field to rank connections on
+    :return: summary, and (reset_end, duration_sum) of every monitored connection (see aggregate_range)
+    """
+    summary = SpaceSaving(max_hits, value)
+    durations: dict[bytes, list] = {}
+    for connection in _read_range(filename, start, end, timestamp):
+        conn_id = connection.get_id()
+        # a connection evicted from the summary starts over when it's seen again
+        _track_duration(durations, conn_id, connection, conn_id not in summary.connections)
+        summary.add(connection)
+        if len(durations) > 2 * summary.capacity:
+            durations = {conn_id: durations[conn_id] for conn_id in summary.connections}
+    return summary, {conn_id: tuple(durations[conn_id]) for conn_id in summary.connections}
+
+
+def merge_shards(shards: list[list[tuple[Connection, float, float]]]) -> dict[bytes, Connection]:
+    """
+    Combine the results of aggregate_range, in log order
+    :param shards: aggregate_range results, ordered by range
+    :return: dict connection id -> Connection
+    """
+    connections: dict[bytes, Connection] = {}
+    for shard in shards:
+        for connection, reset_end, duration_sum in shard:
+            existing = connections.get(connection.get_id())
+            if existing is None:
+                connections[connection.get_id()] = connection
+                continue
+            existing.last_seen = connection.last_seen
+            if reset_end is None:
+                existing.duration += duration_sum
+            else:
+                existing.duration = reset_end - existing.first_seen + duration_sum
+            existing.octets += connection.octets
+            existing.packets += connection.packets
+            if existing.duration > 0:
+                existing.bps = (existing.octets * 8) / existing.duration
+            else:
+                existing.bps = 0
+    return connections
+
+
+def rank_connections(connections: list[Connection], max_hits: int = None,
+                     value: Literal["octets", "packets"] = "octets") -> list[Connection]:
+    """
+    Sort connections by value, when max_hits is set the connections after the first max_hits are summed
+    into an "other" bucket
+    :param connections: connections
+    :param max_hits: number of connections to keep (None for all)
+    :param value: field to rank connections on
+    :return: list
+    """
+    connections = sorted(connections, key=lambda c: getattr(c, value), reverse=True)
+    if max_hits is None or len(connections) <= max_hits:
+        return connections
+    tail = connections[max_hits:]
+    other = other_connection(min(c.first_seen for c in tail), max(c.last_seen for c in tail),
+                             sum(c.octets for c in tail), sum(c.packets for c in tail))
+    return connections[:max_hits] + [other]
+
+
+class ShardedAggregator:
+    """
+    Aggregates the new part of the flowd log on a pool of worker processes: the segment is split into
+    byte ranges on record boundaries, every worker merges the flows of one range and the partial
+    connections are combined in log order, which gives the same connections as merging flow by flow.
+    """
+
+    def __init__(self, workers: int = None, executor: Executor = None):
+        """
+        :param workers: number of worker processes (default: number of CPUs)
+        :param executor: executor to use instead of a process pool of its own
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self._executor = executor
+
+    @property
+    def executor(self) -> Executor:
+        # created (and multiprocessing imported) on first use, so importing this module doesn't fork
+        if self._executor is None:
+            from concurrent.futures import ProcessPoolExecutor
+            self._executor = ProcessPoolExecutor(self.workers)
+        return self._executor
+
+    def _decode(self, flow_tail: FlowLogTail, timestamp: int, aggregate, buf, start: int, end: int):
+        if end - start < MIN_SHARD_SIZE:
+            ranges, offset = split_records(buf, start, end, 1)
+            shards = [aggregate(flow_tail.current_file, a, b, timestamp) for a, b in ranges]
+        else:
+            ranges, offset = split_records(buf, start, end, self.workers)
+            futures = [self.executor.submit(aggregate, flow_tail.current_file, a, b, timestamp)
+                       for a, b in ranges]
+            shards = [future.result() for future in futures]
+        flow_tail.decoder.offset = offset
+        yield from shards
+
+    def read_new(self, flow_tail: FlowLogTail, timestamp: int) -> list[Connection]:
+        """
+        Aggregate the flows appended to the log since the last call
+        :param flow_tail: log to read
+        :param timestamp: skip flows received before this time
+        :return: list of connections, in order of first appearance
+        """
+        shards = list(flow_tail.read_new(partial(self._decode, flow_tail, timestamp, aggregate_range)))
+        return list(merge_shards(shards).values())
+
+    def read_top(self, flow_tail: FlowLogTail, timestamp: int, max_hits: int,
+                 value: Literal["octets", "packets"] = "octets") -> list[Connection]:
+        """
+        Heavy-hitter counterpart of read_new: every range is summarized by top_range and the summaries are
+        combined (see SpaceSaving.combine)
+        :param flow_tail: log to read
+        :param timestamp: skip flows received before this time
+        :param max_hits: number of connections to report
+        :param value: field to rank connections on
+        :return: the top max_hits connections, followed by the "other" bucket (see SpaceSaving.top)
+        """
+        aggregate = partial(top_range, max_hits=max_hits, value=value)
+        results = list(flow_tail.read_new(partial(self._decode, flow_tail, timestamp, aggregate)))
+        shards = [[(summary.connections[conn_id], *durations[conn_id]) for conn_id in summary.connections]
+                  for summary, durations in results]
+        summaries = [summary for summary, _ in results]
+        return SpaceSaving.combine(summaries, merge_shards(shards), max_hits, value).top()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
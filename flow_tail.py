@@ -0,0 +1,99 @@
+import glob
+import json
+import os
+from flowd_decoder import FlowdDecoder, map_file
+
+
+class FlowLogTail:
+    """
+    Incremental reader for the flowd log.
+
+    Remembers the inode and byte offset of the last complete record it consumed (persisted in a small
+    checkpoint file), so every call only decodes records appended since the previous one.
+    Log rotation (inode change) and truncation (file shrunk below the offset) are detected on each read.
+    """
+
+    def __init__(self, log_file: str, checkpoint_file: str = None):
+        self.log_file = log_file
+        self.checkpoint_file = checkpoint_file
+        self.inode = None
+        self.offset = 0
+        self.decoder = FlowdDecoder()
+        # file being read (the rotated log or log_file), for decode functions that need to reopen it
+        self.current_file = None
+        self.load_checkpoint()
+
+    def load_checkpoint(self):
+        if self.checkpoint_file is None or not os.path.isfile(self.checkpoint_file):
+            return
+        try:
+            with open(self.checkpoint_file) as f:
+                checkpoint = json.load(f)
+            self.inode = checkpoint['inode']
+            self.offset = checkpoint['offset']
+        except (OSError, ValueError, KeyError):
+            self.inode = None
+            self.offset = 0
+
+    def save_checkpoint(self):
+        if self.checkpoint_file is None:
+            return
+        tmp_file = self.checkpoint_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'inode': self.inode, 'offset': self.offset}, f)
+        os.replace(tmp_file, self.checkpoint_file)
+
+    def _find_rotated(self, inode: int):
+        """
+        Find the file the previously tailed log was rotated to (flowd.log -> flowd.log.000001)
+        :param inode: inode of the previously tailed log
+        :return: str or None
+        """
+        for filename in glob.glob(f"{self.log_file}.*"):
+            try:
+                if os.stat(filename).st_ino == inode:
+                    return filename
+            except OSError:
+                continue
+        return None
+
+    def read_new(self, decode=None):
+        """
+        Yield the flow records appended to the log since the last call
+        :param decode: generator function (buf, start, end) that decodes records and advances self.decoder.offset,
+                       defaults to self.decoder.decode
+        :return: iterator flow tuples (see flowd_decoder.FLOW_*), or whatever decode yields
+        """
+        if decode is None:
+            decode = self.decoder.decode
+        try:
+            stat = os.stat(self.log_file)
+        except FileNotFoundError:
+            return
+
+        try:
+            if self.inode is not None and self.inode != stat.st_ino:
+                # log was rotated, finish the remainder of the old file before starting the new one
+                rotated = self._find_rotated(self.inode)
+                if rotated is not None:
+                    yield from self._read_file(rotated, decode)
+                self.offset = 0
+            elif stat.st_size < self.offset:
+                # log was truncated, start over
+                self.offset = 0
+            self.inode = stat.st_ino
+            yield from self._read_file(self.log_file, decode)
+        finally:
+            self.save_checkpoint()
+
+    def _read_file(self, filename: str, decode):
+        mm = map_file(filename)
+        if mm is None:
+            return
+        self.current_file = filename
+        try:
+            with memoryview(mm) as mv:
+                yield from decode(mv, self.offset, len(mv))
+        finally:
+            self.offset = self.decoder.offset
+            mm.close()
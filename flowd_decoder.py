@@ -0,0 +1,306 @@
+import glob
+import mmap
+import os
+import socket
+import struct
+
+# flowd record header: [version, len_words, reserved, fields]
+HEADER = struct.Struct('>BBHI')
+
+# flowd store fields in order of appearance, the bit position in the header field mask equals the index
+# (name, size in bytes, unpacker or None for raw address bytes)
+FIELD_DEFINITIONS = [
+    ('tag', 4, struct.Struct('>I')),
+    ('recv_time', 8, struct.Struct('>II')),
+    ('proto_flags_tos', 4, struct.Struct('>BBBB')),
+    ('agent_addr4', 4, None),
+    ('agent_addr6', 16, None),
+    ('src_addr4', 4, None),
+    ('src_addr6', 16, None),
+    ('dst_addr4', 4, None),
+    ('dst_addr6', 16, None),
+    ('gateway_addr4', 4, None),
+    ('gateway_addr6', 16, None),
+    ('srcdst_port', 4, struct.Struct('>HH')),
+    ('packets', 8, struct.Struct('>Q')),
+    ('octets', 8, struct.Struct('>Q')),
+    ('if_indices', 8, struct.Struct('>II')),
+    ('agent_info', 16, struct.Struct('>IIIHH')),
+    ('flow_times', 8, struct.Struct('>II')),
+    ('as_info', 12, struct.Struct('>IIBBH')),
+    ('flow_engine_info', 12, struct.Struct('>HHII')),
+]
+
+U8 = struct.Struct('>B')
+U32 = struct.Struct('>I')
+U64 = struct.Struct('>Q')
+U16_PAIR = struct.Struct('>HH')
+U32_PAIR = struct.Struct('>II')
+
+# positions in the flow tuples yielded by FlowdDecoder.decode
+FLOW_RECV_SEC = 0
+FLOW_START = 1
+FLOW_END = 2
+FLOW_IF_IN = 3
+FLOW_IF_OUT = 4
+FLOW_SRC_ADDR = 5
+FLOW_DST_ADDR = 6
+FLOW_SRC_PORT = 7
+FLOW_DST_PORT = 8
+FLOW_PROTOCOL = 9
+FLOW_OCTETS = 10
+FLOW_PACKETS = 11
+
+
+def get_interface_name(if_index: int) -> str:
+    """
+    Map a local interface index to its name (1 -> em0 for example)
+    :param if_index: interface index
+    :return: str
+    """
+    try:
+        return socket.if_indextoname(if_index)
+    except OSError:
+        return f"if{if_index}"
+
+
+def field_offsets(data_fields: int) -> dict[str, int]:
+    """
+    Calculate the offset of every field present in a record payload
+    :param data_fields: field bitmask, provided by the record header
+    :return: dict field name -> offset relative to the start of the payload
+    """
+    offsets = {}
+    offset = 0
+    for idx, (name, size, _) in enumerate(FIELD_DEFINITIONS):
+        if data_fields & (1 << idx):
+            offsets[name] = offset
+            offset += size
+    return offsets
+
+
+class RecordLayout:
+    """
+    Precomputed payload offsets of the fields a Connection needs, for one header field mask.
+    flowd writes the same field mask for (almost) every record, so layouts are cached per mask.
+    """
+
+    def __init__(self, data_fields: int):
+        offsets = field_offsets(data_fields)
+        self.valid = 'recv_time' in offsets and 'agent_info' in offsets
+        self.recv_time = offsets.get('recv_time')
+        self.agent_info = offsets.get('agent_info')
+        self.flow_times = offsets.get('flow_times')
+        self.proto_flags_tos = offsets.get('proto_flags_tos')
+        self.srcdst_port = offsets.get('srcdst_port')
+        self.packets = offsets.get('packets')
+        self.octets = offsets.get('octets')
+        self.if_indices = offsets.get('if_indices')
+        self.src_addr, self.src_family, self.src_size = self._address(offsets, 'src_addr')
+        self.dst_addr, self.dst_family, self.dst_size = self._address(offsets, 'dst_addr')
+
+    @staticmethod
+    def _address(offsets: dict[str, int], name: str):
+        if name + '4' in offsets:
+            return offsets[name + '4'], socket.AF_INET, 4
+        if name + '6' in offsets:
+            return offsets[name + '6'], socket.AF_INET6, 16
+        return None, None, 0
+
+
+class FlowdDecoder:
+    """
+    Decoder for flowd binary log records.
+
+    Reads only the fields a Connection needs with precompiled unpackers, directly from a buffer (typically
+    a memoryview over a memory mapped log), and yields plain tuples (see the FLOW_* positions).
+    """
+
+    def __init__(self):
+        self.offset = 0
+        self._layouts: dict[int, RecordLayout] = {}
+        self._interfaces: dict[int, str] = {}
+
+    def layout(self, data_fields: int) -> RecordLayout:
+        layout = self._layouts.get(data_fields)
+        if layout is None:
+            layout = self._layouts[data_fields] = RecordLayout(data_fields)
+        return layout
+
+    def interface_name(self, if_index: int) -> str:
+        name = self._interfaces.get(if_index)
+        if name is None:
+            name = self._interfaces[if_index] = get_interface_name(if_index)
+        return name
+
+    def decode(self, buf, start: int = 0, end: int = None):
+        """
+        Yield flow tuples for every complete record in buf[start:end].
+        self.offset always points just after the last record consumed, a trailing partial record is left
+        for the next call.
+        :param buf: buffer (memoryview, mmap, bytes) containing flowd records
+        :param start: offset of the first record
+        :param end: end of the valid data in buf
+        :return: iterator flow tuples
+        """
+        if end is None:
+            end = len(buf)
+        header_unpack = HEADER.unpack_from
+        u32_pair_unpack = U32_PAIR.unpack_from
+        u16_pair_unpack = U16_PAIR.unpack_from
+        u64_unpack = U64.unpack_from
+        u32_unpack = U32.unpack_from
+        u8_unpack = U8.unpack_from
+        inet_ntop = socket.inet_ntop
+        pos = start
+        self.offset = pos
+        while pos + HEADER.size <= end:
+            _, len_words, _, data_fields = header_unpack(buf, pos)
+            record_end = pos + HEADER.size + len_words * 4
+            if record_end > end:
+                # record still being written
+                break
+            base = pos + HEADER.size
+            pos = record_end
+            self.offset = pos
+            layout = self.layout(data_fields)
+            if not layout.valid:
+                # incomplete (invalid) record, skip
+                continue
+
+            recv_sec = u32_unpack(buf, base + layout.recv_time)[0]
+            sys_uptime_ms = u32_unpack(buf, base + layout.agent_info)[0]
+            if layout.flow_times is not None:
+                flow_start, flow_finish = u32_pair_unpack(buf, base + layout.flow_times)
+            else:
+                flow_start = flow_finish = sys_uptime_ms
+            if layout.if_indices is not None:
+                if_in, if_out = u32_pair_unpack(buf, base + layout.if_indices)
+            else:
+                if_in = if_out = 0
+            if layout.srcdst_port is not None:
+                src_port, dst_port = u16_pair_unpack(buf, base + layout.srcdst_port)
+            else:
+                src_port = dst_port = 0
+            if layout.src_addr is not None:
+                offset = base + layout.src_addr
+                src_addr = inet_ntop(layout.src_family, buf[offset:offset + layout.src_size])
+            else:
+                src_addr = None
+            if layout.dst_addr is not None:
+                offset = base + layout.dst_addr
+                dst_addr = inet_ntop(layout.dst_family, buf[offset:offset + layout.dst_size])
+            else:
+                dst_addr = None
+
+            yield (
+                recv_sec,
+                recv_sec - (sys_uptime_ms - flow_start) / 1000.0,
+                recv_sec - (sys_uptime_ms - flow_finish) / 1000.0,
+                self.interface_name(if_in),
+                self.interface_name(if_out),
+                src_addr,
+                dst_addr,
+                src_port,
+                dst_port,
+                u8_unpack(buf, base + layout.proto_flags_tos + 1)[0] if layout.proto_flags_tos is not None else 0,
+                u64_unpack(buf, base + layout.octets)[0] if layout.octets is not None else 0,
+                u64_unpack(buf, base + layout.packets)[0] if layout.packets is not None else 0,
+            )
+
+
+def map_file(filename: str):
+    """
+    Memory map a log file read-only
+    :param filename: file to map
+    :return: mmap or None when the file is empty
+    """
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def decode_record_dict(buf, base: int, data_fields: int, interfaces: FlowdDecoder) -> dict:
+    """
+    Decode every field of a record into a dict, shaped like the records of opnsense's lib.parse.parse_flow
+    :param buf: buffer containing the record
+    :param base: offset of the record payload (after the header)
+    :param data_fields: field bitmask, provided by the record header
+    :param interfaces: decoder used for (cached) interface name lookups
+    :return: dict
+    """
+    record = {}
+    offset = base
+    for idx, (name, size, unpacker) in enumerate(FIELD_DEFINITIONS):
+        if data_fields & (1 << idx):
+            if unpacker is None:
+                family = socket.AF_INET if size == 4 else socket.AF_INET6
+                record[name] = socket.inet_ntop(family, buf[offset:offset + size])
+            else:
+                content = unpacker.unpack_from(buf, offset)
+                record[name] = content[0] if len(content) == 1 else content
+            offset += size
+
+    record['recv_sec'] = record['recv_time'][0]
+    record['sys_uptime_ms'] = record['agent_info'][0]
+    record['netflow_ver'] = record['agent_info'][3]
+    record['recv'] = record['recv_sec']
+    record['recv_usec'] = record['recv_time'][1]
+    record['if_ndx_in'], record['if_ndx_out'] = record.get('if_indices', (0, 0))
+    record['src_port'], record['dst_port'] = record.get('srcdst_port', (0, 0))
+    proto_flags_tos = record.get('proto_flags_tos', (0, 0, 0, 0))
+    record['protocol'] = proto_flags_tos[1]
+    record['tcp_flags'] = proto_flags_tos[2]
+    record['tos'] = proto_flags_tos[3]
+    flow_start, flow_finish = record.get('flow_times', (record['sys_uptime_ms'], record['sys_uptime_ms']))
+    record['flow_start'] = flow_start
+    record['flow_finish'] = flow_finish
+    # concat ipv4/v6 fields into field without [4,6]
+    for name in ('agent_addr', 'src_addr', 'dst_addr', 'gateway_addr'):
+        for version in ('4', '6'):
+            if name + version in record:
+                record[name] = record[name + version]
+    record['duration_ms'] = flow_finish - flow_start
+    record['flow_start'] = record['recv_sec'] - (record['sys_uptime_ms'] - flow_start) / 1000.0
+    record['flow_end'] = record['recv_sec'] - (record['sys_uptime_ms'] - flow_finish) / 1000.0
+    record['if_in'] = interfaces.interface_name(record['if_ndx_in'])
+    record['if_out'] = interfaces.interface_name(record['if_ndx_out'])
+    return record
+
+
+def parse_flow(recv_stamp: int, flowd_source: str = '/var/log/flowd.log'):
+    """
+    Parse flowd logs (including rotated ones) and yield full records (dict type), newest file first.
+    Drop-in replacement for opnsense's lib.parse.parse_flow.
+    :param recv_stamp: only return records received at or after this timestamp
+    :param flowd_source: flowd logfile
+    :return: iterator flow details
+    """
+    decoder = FlowdDecoder()
+    parse_done = False
+    for filename in sorted(glob.glob('%s*' % flowd_source)):
+        if parse_done:
+            # previous log file already contained older data (recv_stamp), rotated ones are even older
+            break
+        mm = map_file(filename)
+        if mm is None:
+            continue
+        try:
+            with memoryview(mm) as mv:
+                pos = 0
+                while pos + HEADER.size <= len(mv):
+                    _, len_words, _, data_fields = HEADER.unpack_from(mv, pos)
+                    base = pos + HEADER.size
+                    pos = base + len_words * 4
+                    if pos > len(mv):
+                        break
+                    if not decoder.layout(data_fields).valid:
+                        continue
+                    record = decode_record_dict(mv, base, data_fields, decoder)
+                    if record['recv_sec'] < recv_stamp:
+                        parse_done = True
+                        continue
+                    yield record
+        finally:
+            mm.close()
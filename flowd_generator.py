@@ -0,0 +1,160 @@
+#!./venv/bin/python3
+import argparse
+import random
+import socket
+import time
+
+from flowd_decoder import FIELD_DEFINITIONS, HEADER
+
+# fields flowd stores for every flow, in header bit order (see flowd_decoder.FIELD_DEFINITIONS)
+FIELD_INDEX = {name: idx for idx, (name, _, _) in enumerate(FIELD_DEFINITIONS)}
+FIELD_PACKERS = {name: packer for name, _, packer in FIELD_DEFINITIONS}
+FLOWD_VERSION = 2
+NETFLOW_VERSION = 9
+# uptime of the exporting agent, flow times are stored relative to it
+SYS_UPTIME_MS = 10_000_000
+AGENT_ADDR = socket.inet_pton(socket.AF_INET, '127.0.0.1')
+GATEWAY_ADDR = socket.inet_pton(socket.AF_INET, '0.0.0.0')
+# server ports of the generated conversations
+SERVICE_PORTS = [(6, 443), (6, 80), (17, 53), (6, 22), (17, 123), (6, 993), (17, 443)]
+
+
+def _data_fields(v6: bool) -> int:
+    names = ['recv_time', 'proto_flags_tos', 'agent_addr4', 'gateway_addr4', 'srcdst_port', 'packets', 'octets',
+             'if_indices', 'agent_info', 'flow_times', 'as_info', 'flow_engine_info']
+    names += ['src_addr6', 'dst_addr6'] if v6 else ['src_addr4', 'dst_addr4']
+    data_fields = 0
+    for name in names:
+        data_fields |= 1 << FIELD_INDEX[name]
+    return data_fields
+
+
+class FlowKey:
+    """
+    Fields of a generated conversation that stay the same from flow to flow
+    """
+    __slots__ = ('v6', 'data_fields', 'if_in', 'if_out', 'src_addr', 'dst_addr', 'src_port', 'dst_port',
+                 'protocol')
+
+    def __init__(self, rnd: random.Random, v6: bool, interfaces: int):
+        self.v6 = v6
+        self.data_fields = _data_fields(v6)
+        self.if_in = rnd.randint(1, interfaces)
+        self.if_out = rnd.randint(1, interfaces)
+        if v6:
+            self.src_addr = socket.inet_pton(socket.AF_INET6, '2001:db8:%x::%x' % (rnd.randint(0, 0xff),
+                                                                                  rnd.randint(1, 0xffff)))
+            self.dst_addr = socket.inet_pton(socket.AF_INET6, '2a00:%x::%x' % (rnd.randint(0, 0xffff),
+                                                                              rnd.randint(1, 0xffff)))
+        else:
+            self.src_addr = socket.inet_pton(socket.AF_INET, '10.%d.%d.%d' % (rnd.randint(0, 255),
+                                                                              rnd.randint(0, 255),
+                                                                              rnd.randint(1, 254)))
+            self.dst_addr = rnd.getrandbits(32).to_bytes(4, 'big')
+        self.protocol, self.dst_port = rnd.choice(SERVICE_PORTS)
+        self.src_port = rnd.randint(1024, 65535)
+
+
+class FlowGenerator:
+    """
+    Generator of synthetic flowd log records, reproducible for a given seed.
+    Flows are drawn from a fixed set of conversations (cardinality), with a share of IPv6 conversations and
+    Pareto distributed (heavy-tail) octet counts.
+    """
+
+    def __init__(self, cardinality: int = 10000, ipv6_ratio: float = 0.2, pareto_alpha: float = 1.2,
+                 min_octets: int = 64, interfaces: int = 4, seed: int = 0):
+        """
+        :param cardinality: number of distinct conversations (connection keys)
+        :param ipv6_ratio: share of IPv6 conversations (0..1)
+        :param pareto_alpha: shape of the octet distribution, lower values give a heavier tail
+        :param min_octets: smallest flow size (scale of the octet distribution)
+        :param interfaces: number of interface indices used
+        :param seed: random seed
+        """
+        self.random = random.Random(seed)
+        self.pareto_alpha = pareto_alpha
+        self.min_octets = min_octets
+        self.keys = [FlowKey(self.random, self.random.random() < ipv6_ratio, interfaces)
+                     for _ in range(cardinality)]
+
+    def record(self, key: FlowKey, recv_time: float) -> bytes:
+        """
+        Encode one flow of a conversation
+        :param key: conversation
+        :param recv_time: time the flow was received by flowd (epoch)
+        :return: bytes (header and payload)
+        """
+        octets = min(int(self.min_octets * self.random.paretovariate(self.pareto_alpha)), 1 << 40)
+        packets = max(1, octets // 1000)
+        flow_finish = SYS_UPTIME_MS - self.random.randint(0, 2000)
+        flow_start = flow_finish - min(octets // 100, 60000)
+        recv_sec = int(recv_time)
+        values = {
+            'recv_time': (recv_sec, int(recv_time % 1 * 1000000)),
+            'proto_flags_tos': (0, key.protocol, 0x1b if key.protocol == 6 else 0, 0),
+            'agent_addr4': AGENT_ADDR,
+            'src_addr4': key.src_addr, 'dst_addr4': key.dst_addr,
+            'src_addr6': key.src_addr, 'dst_addr6': key.dst_addr,
+            'gateway_addr4': GATEWAY_ADDR,
+            'srcdst_port': (key.src_port, key.dst_port),
+            'packets': (packets,),
+            'octets': (octets,),
+            'if_indices': (key.if_in, key.if_out),
+            'agent_info': (SYS_UPTIME_MS, recv_sec, 0, NETFLOW_VERSION, 0),
+            'flow_times': (flow_start, flow_finish),
+            'as_info': (0, 0, 24, 24, 0),
+            'flow_engine_info': (0, 0, 0, 0),
+        }
+        chunks = []
+        for name, _, packer in FIELD_DEFINITIONS:
+            if key.data_fields & (1 << FIELD_INDEX[name]):
+                chunks.append(values[name] if packer is None else packer.pack(*values[name]))
+        payload = b''.join(chunks)
+        return HEADER.pack(FLOWD_VERSION, len(payload) // 4, 0, key.data_fields) + payload
+
+    def records(self, count: int, start_time: float, end_time: float):
+        """
+        Generate flows received between start_time and end_time, in order of arrival
+        :param count: number of flows
+        :param start_time: first receive time (epoch)
+        :param end_time: last receive time (epoch)
+        :return: iterator bytes
+        """
+        step = (end_time - start_time) / count if count else 0
+        for idx in range(count):
+            yield self.record(self.random.choice(self.keys), start_time + idx * step)
+
+    def write(self, filename: str, count: int, start_time: float, end_time: float, append: bool = True) -> int:
+        """
+        Write flows to a flowd log
+        :param filename: log file
+        :param count: number of flows
+        :param start_time: first receive time (epoch)
+        :param end_time: last receive time (epoch)
+        :param append: append to the log (like flowd does) instead of replacing it
+        :return: number of bytes written
+        """
+        data = b''.join(self.records(count, start_time, end_time))
+        with open(filename, 'ab' if append else 'wb') as f:
+            f.write(data)
+        return len(data)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic flowd log')
+    parser.add_argument('log', help='flowd log file to write')
+    parser.add_argument('--rate', help='flows per second', type=int, default=1000)
+    parser.add_argument('--duration', help='seconds of traffic, ending now', type=int, default=60)
+    parser.add_argument('--cardinality', help='distinct conversations', type=int, default=10000)
+    parser.add_argument('--ipv6-ratio', help='share of IPv6 conversations', type=float, default=0.2)
+    parser.add_argument('--pareto-alpha', help='octets distribution shape (heavy tail)', type=float, default=1.2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--append', help='append to an existing log', action='store_true')
+    cmd_args = parser.parse_args()
+
+    now = time.time()
+    generator = FlowGenerator(cmd_args.cardinality, cmd_args.ipv6_ratio, cmd_args.pareto_alpha, seed=cmd_args.seed)
+    size = generator.write(cmd_args.log, cmd_args.rate * cmd_args.duration, now - cmd_args.duration, now,
+                           cmd_args.append)
+    print(f"Wrote {cmd_args.rate * cmd_args.duration} flows ({size} bytes) to {cmd_args.log}")
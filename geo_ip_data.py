@@ -1,75 +1,504 @@
-from geoip2fast import GeoIP2Fast
-from ipaddress import IPv4Address, IPv6Address
+from bisect import bisect_right
+from collections import OrderedDict
+from utils import getenv
+from ipaddress import IPv4Address, IPv6Address, ip_network
+from metrics import geoip_cache_hit_ratio, geoip_cache_size, registry
+import json
+import mmap
+import os
+import socket
+import struct
+import sys
+import threading
 from typing import Union
 
-geoip = GeoIP2Fast()
 
+GEOIP_CACHE_SIZE = 65536
+# prebuilt lookup index (see GeoIPIndex.build), memory mapped so the processes using it share one copy.
+# Without it every process loads the GeoIP2Fast database (on its first lookup). GEOIP_INDEX_FILE setting
+DEFAULT_GEOIP_INDEX_FILE = "/var/db/netmon_geoip.idx"
 
-def get_country(ip: Union[IPv4Address, IPv6Address, str]) -> str:
+# private, shared (CGNAT), loopback, link-local, multicast and reserved ranges, override with a comma separated
+# LOCAL_NETWORKS setting
+DEFAULT_LOCAL_NETWORKS = [
+    '0.0.0.0/8', '10.0.0.0/8', '100.64.0.0/10', '127.0.0.0/8', '169.254.0.0/16', '172.16.0.0/12',
+    '192.0.0.0/24', '192.168.0.0/16', '198.18.0.0/15', '224.0.0.0/4', '240.0.0.0/4',
+    '::/128', '::1/128', 'fc00::/7', 'fe80::/10', 'ff00::/8',
+]
+
+LOCAL = {'country': "Local", 'asn': "Local", 'city': "Local"}
+UNKNOWN = {'country': "Unknown", 'asn': "Unknown", 'city': "Unknown"}
+
+
+def _value(res) -> str:
+    if res is None or res in ["", "--"]:
+        return "Unknown"
+    return res
+
+
+def _ip_to_int(ip: str):
     """
-    Get the country of an IP address
+    :return: (ip version, address as int) or None for an invalid address
+    """
+    try:
+        if ':' in ip:
+            return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), 'big')
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+    except OSError:
+        return None
+
+
+class NetworkClassifier:
+    """
+    Matches addresses against a list of networks, compiled into sorted, merged integer ranges per ip version
+    that are searched with bisect (or numpy.searchsorted for batches).
+    """
+
+    def __init__(self, networks: list[str]):
+        ranges = {4: [], 6: []}
+        for network in networks:
+            network = ip_network(network, strict=False)
+            ranges[network.version].append((int(network.network_address), int(network.broadcast_address)))
+        self.starts: dict[int, list[int]] = {}
+        self.ends: dict[int, list[int]] = {}
+        for version, version_ranges in ranges.items():
+            starts, ends = [], []
+            for start, end in sorted(version_ranges):
+                if ends and start <= ends[-1] + 1:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            self.starts[version] = starts
+            self.ends[version] = ends
+
+    def contains_int(self, version: int, ip_int: int) -> bool:
+        idx = bisect_right(self.starts[version], ip_int) - 1
+        return idx >= 0 and ip_int <= self.ends[version][idx]
+
+    def contains(self, ip: str) -> bool:
+        """
+        :param ip: IP address
+        :return: True when the address is in one of the networks
+        """
+        version_ip = _ip_to_int(ip)
+        return version_ip is not None and self.contains_int(*version_ip)
+
+    def classify(self, ips: list[str]) -> list[bool]:
+        """
+        Batch version of contains
+        :param ips: IP addresses
+        :return: list[bool]
+        """
+        return [self.contains(ip) for ip in ips]
+
+    def classify_array(self, family, hi, lo):
+        """
+        Vectorized batch classification of integer addresses (see flow_columns.COLUMNS for the representation)
+        :param family: ip version per address (4 or 6)
+        :param hi: upper 64 bits of the address (0 for IPv4)
+        :param lo: lower 64 bits of the address (the IPv4 address)
+        :return: numpy bool array
+        """
+        import numpy as np
+        family = np.asarray(family)
+        hi = np.asarray(hi, dtype=np.uint64)
+        lo = np.asarray(lo, dtype=np.uint64)
+        result = np.zeros(len(family), dtype=bool)
+
+        is_v4 = family == 4
+        if self.starts[4]:
+            starts = np.array(self.starts[4], dtype=np.uint64)
+            ends = np.array(self.ends[4], dtype=np.uint64)
+            idx = np.searchsorted(starts, lo, side='right') - 1
+            result |= is_v4 & (idx >= 0) & (lo <= ends[np.maximum(idx, 0)])
+
+        # 128 bit addresses don't fit a numpy integer, compare (hi, lo) pairs per range (there are only a few)
+        is_v6 = family == 6
+        mask = (1 << 64) - 1
+        for start, end in zip(self.starts[6], self.ends[6]):
+            start_hi, start_lo = np.uint64(start >> 64), np.uint64(start & mask)
+            end_hi, end_lo = np.uint64(end >> 64), np.uint64(end & mask)
+            after_start = (hi > start_hi) | ((hi == start_hi) & (lo >= start_lo))
+            before_end = (hi < end_hi) | ((hi == end_hi) & (lo <= end_lo))
+            result |= is_v6 & after_start & before_end
+        return result
+
+
+# built on first use (see get_local_networks)
+_local_networks = None
+_local_networks_lock = threading.Lock()
+
+
+def get_local_networks() -> NetworkClassifier:
+    """
+    :return: NetworkClassifier of the LOCAL_NETWORKS setting (DEFAULT_LOCAL_NETWORKS when not set)
+    """
+    global _local_networks
+    if _local_networks is None:
+        with _local_networks_lock:
+            if _local_networks is None:
+                networks = [n.strip() for n in getenv("LOCAL_NETWORKS", "").split(',') if n.strip()]
+                _local_networks = NetworkClassifier(networks or DEFAULT_LOCAL_NETWORKS)
+    return _local_networks
+
+
+def is_local(ip: Union[IPv4Address, IPv6Address, str]) -> bool:
+    """
+    Check whether an IP address belongs to a private, reserved or otherwise local network (see
+    get_local_networks)
     :param ip: IP address
-    :return: str
+    :return: bool
     """
     if not isinstance(ip, str):
         ip = str(ip)
+    return get_local_networks().contains(ip)
+
+
+class _IndexKeys:
+    # the range starts of an index table as a sequence of big endian bytes, for bisect
+    def __init__(self, buf, offset: int, count: int, record_size: int, width: int):
+        self.buf = buf
+        self.offset = offset
+        self.count = count
+        self.record_size = record_size
+        self.width = width
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx: int) -> bytes:
+        start = self.offset + idx * self.record_size
+        return self.buf[start:start + self.width]
+
+
+class GeoIPIndex:
+    """
+    Read-only GeoIP lookup index in a flat file, used through a memory map: the operating system shares its
+    pages between all processes that map it, and opening it costs no parsing or loading.
+    Layout: header, JSON list of [country, asn, city] values, then per ip version a table of fixed size
+    records (first address, last address, value id) sorted by first address. Addresses are big endian, so
+    their bytes compare like the numbers and the tables are searched with bisect on the mapped bytes.
+    """
+    MAGIC = b'NMGEOIX1'
+    # magic, IPv4 records, IPv6 records, length of the values JSON
+    HEADER = struct.Struct('>8sIII')
+    RECORDS = {4: struct.Struct('>4s4sI'), 6: struct.Struct('>16s16sI')}
+
+    def __init__(self, filename: str):
+        with open(filename, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, v4_count, v6_count, values_size = self.HEADER.unpack_from(self._mmap, 0)
+        if magic != self.MAGIC:
+            raise ValueError(f"{filename} is not a GeoIP index")
+        offset = self.HEADER.size
+        self.values = [dict(zip(('country', 'asn', 'city'), value))
+                       for value in json.loads(self._mmap[offset:offset + values_size])]
+        offset += values_size
+        self._tables = {}
+        for version, count in ((4, v4_count), (6, v6_count)):
+            record = self.RECORDS[version]
+            self._tables[version] = (_IndexKeys(self._mmap, offset, count, record.size, 4 if version == 4 else 16),
+                                     offset, record)
+            offset += count * record.size
+
+    def lookup(self, version: int, ip_int: int):
+        """
+        :param version: ip version
+        :param ip_int: address as int
+        :return: dict with the keys country, asn, city or None when the address isn't in the index
+        """
+        keys, offset, record = self._tables[version]
+        key = ip_int.to_bytes(keys.width, 'big')
+        idx = bisect_right(keys, key) - 1
+        if idx < 0:
+            return None
+        _, last, value_id = record.unpack_from(self._mmap, offset + idx * record.size)
+        return self.values[value_id] if key <= last else None
+
+    @classmethod
+    def build(cls, filename: str) -> int:
+        """
+        Write an index of the GeoIP2Fast database (which has to be rebuilt when the database is updated):
+        the address space is split at every network boundary of the database and every part gets the result of
+        a lookup of its first address, adjacent parts with the same result are merged.
+        :param filename: index file to write (replaced atomically)
+        :return: number of ranges
+        """
+        import geoip2fast.geoip2fast as database
+        geoip = get_geoip()
+        networks = [(database.mainListFirstIP, database.mainListNetlength)]
+        if geoip.asn:
+            networks.append((database.mainListFirstIPASN, database.mainListNetlengthASN))
+        boundaries = set()
+        for first_ips, netlengths in networks:
+            for first_chunk, netlength_chunk in zip(first_ips, netlengths):
+                for first_ip, netlength in zip(first_chunk, netlength_chunk):
+                    bits = 32 if first_ip <= 0xffffffff else 128
+                    boundaries.add(first_ip)
+                    boundaries.add(first_ip + (1 << (bits - netlength)))
+
+        values = {}
+        ranges = {4: [], 6: []}
+        boundaries = sorted(boundaries)
+        for first_ip, next_ip in zip(boundaries, boundaries[1:]):
+            version = 4 if first_ip <= 0xffffffff else 6
+            if version == 4 and next_ip > 0x100000000:
+                next_ip = 0x100000000
+            address = socket.inet_ntop(socket.AF_INET if version == 4 else socket.AF_INET6,
+                                       first_ip.to_bytes(4 if version == 4 else 16, 'big'))
+            data, cidrs = _geoip2fast_lookup(geoip, address)
+            if not cidrs[0]:
+                # not in the database
+                continue
+            value = (data['country'], data['asn'], data['city'])
+            value_id = values.setdefault(value, len(values))
+            version_ranges = ranges[version]
+            if version_ranges and version_ranges[-1][1] == first_ip - 1 and version_ranges[-1][2] == value_id:
+                version_ranges[-1][1] = next_ip - 1
+            else:
+                version_ranges.append([first_ip, next_ip - 1, value_id])
+
+        values_json = json.dumps(list(values)).encode()
+        tmp_file = filename + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, len(ranges[4]), len(ranges[6]), len(values_json)))
+            f.write(values_json)
+            for version in (4, 6):
+                width = 4 if version == 4 else 16
+                record = cls.RECORDS[version]
+                f.write(b''.join(record.pack(first.to_bytes(width, 'big'), last.to_bytes(width, 'big'), value_id)
+                                 for first, last, value_id in ranges[version]))
+        os.replace(tmp_file, filename)
+        return len(ranges[4]) + len(ranges[6])
+
+
+# loaded on first use (see get_geoip, get_geoip_index)
+_geoip = None
+_geoip_index = None
+_geoip_lock = threading.Lock()
+
+
+def get_geoip():
+    """
+    :return: GeoIP2Fast instance, the database is loaded on the first call
+    """
+    global _geoip
+    if _geoip is None:
+        with _geoip_lock:
+            if _geoip is None:
+                from geoip2fast import GeoIP2Fast
+                _geoip = GeoIP2Fast()
+    return _geoip
+
+
+def get_geoip_index():
+    """
+    :return: GeoIPIndex of the GEOIP_INDEX_FILE setting or None when there is none (checked once)
+    """
+    global _geoip_index
+    if _geoip_index is None:
+        with _geoip_lock:
+            if _geoip_index is None:
+                index_file = getenv("GEOIP_INDEX_FILE", DEFAULT_GEOIP_INDEX_FILE)
+                try:
+                    _geoip_index = GeoIPIndex(index_file) if os.path.isfile(index_file) else False
+                except (OSError, ValueError) as e:
+                    print(f"------ Error: GeoIP index {index_file} can't be used: {e}", file=sys.stderr)
+                    _geoip_index = False
+    return _geoip_index or None
 
-    if ip.startswith("192.168.") or ip.startswith("10.") or ip.startswith("172.16."):
-        return "Local"
 
+def _geoip2fast_lookup(geoip, ip: str):
+    """
+    :return: data dict and the networks (country, asn) GeoIP2Fast returned for it
+    """
     try:
-        res = geoip.lookup(ip).country_code
-        if res is None or res in ["", "--"]:
-            return "Unknown"
-        return res
-    except Exception as e:
-        return "Unknown"
+        res = geoip.lookup(ip)
+        city = getattr(res, 'city', None)
+        data = {
+            'country': _value(res.country_code),
+            'asn': _value(res.asn_name),
+            'city': _value(getattr(city, 'name', None)),
+        }
+        return data, [res.cidr, res.asn_cidr]
+    except Exception:
+        return UNKNOWN, ['', '']
 
 
-def get_asn(ip: Union[IPv4Address, IPv6Address, str]) -> str:
+class GeoIPCache:
     """
-    Get the ASN of an IP address
+    LRU cache for GeoIP lookups, keyed by IP address and by the network prefix GeoIP2Fast returned for it,
+    so other addresses in an already looked up range are served without a new lookup.
+    """
+
+    def __init__(self, max_size: int = GEOIP_CACHE_SIZE):
+        self.max_size = max_size
+        # ip -> data and (version, prefix length, network) -> data
+        self._entries: OrderedDict = OrderedDict()
+        # prefix lengths seen per ip version, longest first
+        self._prefix_lengths: dict[int, list[int]] = {4: [], 6: []}
+        self.hits = 0
+        self.prefix_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _put(self, key, data: dict):
+        self._entries[key] = data
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _get_prefix(self, version: int, ip_int: int):
+        bits = 32 if version == 4 else 128
+        for prefix_length in self._prefix_lengths[version]:
+            key = (version, prefix_length, ip_int >> (bits - prefix_length))
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                return data
+        return None
+
+    def _put_prefix(self, version: int, ip_int: int, cidrs: list[str], data: dict):
+        # the data is valid for the most specific of the returned ranges
+        prefix_lengths = [int(cidr.split('/')[1]) for cidr in cidrs if '/' in cidr]
+        if not prefix_lengths:
+            return
+        prefix_length = max(prefix_lengths)
+        bits = 32 if version == 4 else 128
+        if prefix_length not in self._prefix_lengths[version]:
+            self._prefix_lengths[version].append(prefix_length)
+            self._prefix_lengths[version].sort(reverse=True)
+        self._put((version, prefix_length, ip_int >> (bits - prefix_length)), data)
+
+    def lookup(self, ip: str) -> dict:
+        """
+        Get country, ASN and city of an IP address with a single (cached) lookup
+        :param ip: IP address
+        :return: dict with the keys country, asn, city
+        """
+        data = self._entries.get(ip)
+        if data is not None:
+            self._entries.move_to_end(ip)
+            self.hits += 1
+            return data
+
+        version_ip = _ip_to_int(ip)
+        if version_ip is None:
+            return UNKNOWN
+        version, ip_int = version_ip
+        data = self._get_prefix(version, ip_int)
+        if data is not None:
+            self.prefix_hits += 1
+            self._put(ip, data)
+            return data
+
+        self.misses += 1
+        index = get_geoip_index()
+        if index is not None:
+            # index ranges aren't prefixes, only the address is cached
+            data = index.lookup(version, ip_int) or UNKNOWN
+            cidrs = []
+        else:
+            data, cidrs = _geoip2fast_lookup(get_geoip(), ip)
+        self._put(ip, data)
+        self._put_prefix(version, ip_int, cidrs, data)
+        return data
+
+    def dump(self) -> dict:
+        """
+        :return: cache content, see load
+        """
+        return {
+            'entries': list(self._entries.items()),
+            'prefix_lengths': self._prefix_lengths,
+        }
+
+    def load(self, state: dict):
+        """
+        Restore the content returned by dump
+        :param state: cache content
+        """
+        for key, data in state['entries']:
+            self._put(key, data)
+        for version, prefix_lengths in state['prefix_lengths'].items():
+            self._prefix_lengths[version] = sorted(set(self._prefix_lengths[version]) | set(prefix_lengths),
+                                                   reverse=True)
+
+    def get_stats(self) -> dict:
+        lookups = self.hits + self.prefix_hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'prefix_hits': self.prefix_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': (self.hits + self.prefix_hits) / lookups if lookups else 0.0,
+        }
+
+
+geoip_cache = GeoIPCache()
+
+
+def _collect_cache_stats():
+    stats = geoip_cache.get_stats()
+    geoip_cache_hit_ratio.set(stats['hit_ratio'])
+    geoip_cache_size.set(stats['size'])
+
+
+registry.add_collector(_collect_cache_stats)
+
+
+def lookup(ip: Union[IPv4Address, IPv6Address, str]) -> dict:
+    """
+    Get country, ASN and city of an IP address
     :param ip: IP address
-    :return: str
+    :return: dict with the keys country, asn, city
     """
     if not isinstance(ip, str):
         ip = str(ip)
 
-    if ip.startswith("192.168.") or ip.startswith("10.") or ip.startswith("172.16."):
-        return "Local"
+    if get_local_networks().contains(ip):
+        return LOCAL
 
-    try:
-        res = geoip.lookup(ip).asn_name
-        if res is None or res in ["", "--"]:
-            return "Unknown"
-        return res
-    except Exception as e:
-        return "Unknown"
+    return geoip_cache.lookup(ip)
 
 
-def get_city(ip: Union[IPv4Address, IPv6Address, str]) -> str:
+def get_country(ip: Union[IPv4Address, IPv6Address, str]) -> str:
     """
-    Get the city of an IP address
+    Get the country of an IP address
     :param ip: IP address
     :return: str
     """
-    if not isinstance(ip, str):
-        ip = str(ip)
+    return lookup(ip)['country']
 
-    if ip.startswith("192.168.") or ip.startswith("10.") or ip.startswith("172.16."):
-        return "Local"
 
-    try:
-        res = geoip.lookup(ip).city.name
-        if res is None or res in ["", "--"]:
-            return "Unknown"
-        return res
-    except Exception as e:
-        return "Unknown"
+def get_asn(ip: Union[IPv4Address, IPv6Address, str]) -> str:
+    """
+    Get the ASN of an IP address
+    :param ip: IP address
+    :return: str
+    """
+    return lookup(ip)['asn']
+
+
+def get_city(ip: Union[IPv4Address, IPv6Address, str]) -> str:
+    """
+    Get the city of an IP address
+    :param ip: IP address
+    :return: str
+    """
+    return lookup(ip)['city']
 
 
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['--build-index']:
+        index_file = sys.argv[2] if len(sys.argv) > 2 else getenv("GEOIP_INDEX_FILE", DEFAULT_GEOIP_INDEX_FILE)
+        print(f"Wrote {GeoIPIndex.build(index_file)} ranges to {index_file}")
+        sys.exit(0)
     myip = "149.200.255.112"
     print(get_country(myip))
     print(get_asn(myip))
-    print(get_city(myip))
\ No newline at end of file
+    print(get_city(myip))
+    print(geoip_cache.get_stats())
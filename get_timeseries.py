@@ -1,14 +1,56 @@
-import sys
-sys.path.append('/usr/local/opnsense/scripts/netflow/')
-
 import os
-import time
 import calendar
+import time
 import ujson
-from lib import load_config
-import lib.aggregates
 
 from network_enums import Provider
+from netflow_db import get_aggregator, get_configuration
+from query_cache import get_query_cache
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+NETFLOW_CONFIG_FILE = '/usr/local/etc/netflow.conf'
+
+
+def _configured_dimension_keys() -> list[str]:
+    # dimension keys of the interfaces in the running configuration, to render empty results
+    keys = []
+    if os.path.isfile(NETFLOW_CONFIG_FILE):
+        tmp = open(NETFLOW_CONFIG_FILE).read()
+        if tmp.find('netflow_interfaces="') > -1:
+            for intf in tmp.split('netflow_interfaces="')[-1].split('"')[0].split():
+                keys.append('%s,in' % intf)
+                keys.append('%s,out' % intf)
+    return keys
+
+
+def _matrix(rows: int, columns: int, row_indices: list[int], column_indices: list[int], values: list):
+    # timeslices x dimensions matrix, filled in at the given positions
+    if np is not None:
+        matrix = np.zeros((rows, columns), dtype=np.int64)
+        matrix[row_indices, column_indices] = values
+        return matrix
+    matrix = [[0] * columns for _ in range(rows)]
+    for row, column, value in zip(row_indices, column_indices, values):
+        matrix[row][column] = value
+    return matrix
+
+
+def _query_buckets(agg_class: type, start_time: int, end_time: int, fields: list[str], resolution: int) -> dict:
+    # {bucket start: {dimension key: (octets, packets)}} of the aggregator's timeserie data
+    buckets = {}
+    obj = agg_class(resolution, database_dir=get_configuration().database_dir)
+    for record in obj.get_timeserie_data(start_time, end_time, fields):
+        record_key = ','.join('' if record.get(key_field) is None else str(record[key_field])
+                              for key_field in fields)
+        bucket = calendar.timegm(record['start_time'].timetuple())
+        if bucket not in buckets:
+            buckets[bucket] = {}
+        buckets[bucket][record_key] = (record['octets'], record['packets'])
+    return buckets
 
 
 def get_timeseries(
@@ -16,7 +58,8 @@ def get_timeseries(
         start_time: int,
         end_time: int,
         key_fields: str,
-        resolution: int
+        resolution: int,
+        dense: bool = False
         ) -> dict:
     """
     Get timeseries data from a provider for a given timeframe
@@ -25,6 +68,9 @@ def get_timeseries(
     :param end_time: End time of the timeframe (epoch)
     :param key_fields: Fields to group by (comma separated)
     :param resolution: Resolution of the data (seconds)
+    :param dense: return the dense matrices instead of the per timeslice dicts:
+                  {'timestamps': [...], 'keys': [...], 'octets': matrix, 'packets': matrix, 'resolution': int}
+                  with one row per timestamp and one column per dimension key (numpy arrays when available)
     :return: dict
 
     NOTE: This function was ported from the original get_timeseries function in opnsense repo.
@@ -34,57 +80,86 @@ def get_timeseries(
     - FlowSourceAddrTotals: 'mtime,last_seen,if,src_addr,direction,octets,packets'
     - FlowSourceAddrDetails: 'mtime,last_seen,if,direction,src_addr,dst_addr,service_port,protocol,octets,packets'
 
+    Timeslices are aligned on the resolution, from the one containing start_time up to end_time. Completed
+    timeslices are kept in the query cache, only the newer ones are queried again (see query_cache).
     """
-    configuration = load_config()
-    timeseries = {}
+    fields = key_fields.split(',')
+    first_slice = start_time - start_time % resolution
+
+    # (bucket start, {dimension key: (octets, packets)}), completed buckets come from the query cache
+    buckets = []
+    agg_class = get_aggregator(provider)
+    if agg_class is not None:
+        query_cache = get_query_cache()
+        query_key = ('timeseries', agg_class.__name__, resolution, key_fields)
+        query_start = start_time
+        if query_cache.enabled:
+            # the aggregators correct start_time for the resolution, the timeslice containing start_time is
+            # returned as a whole and cached like the others
+            cached, query_start = query_cache.cached_until(query_key, first_slice, end_time, resolution)
+            buckets.extend(cached)
+        if query_start < end_time:
+            queried = _query_buckets(agg_class, query_start, end_time, fields, resolution)
+            if query_cache.enabled:
+                now = time.time()
+                bucket = query_start
+                while bucket < end_time and query_cache.is_complete(bucket, resolution, now):
+                    query_cache.put(query_key, bucket, queried.get(bucket, {}))
+                    bucket += resolution
+            buckets.extend(sorted(queried.items()))
 
-    dimension_keys = []
-    for agg_class in lib.aggregates.get_aggregators():
-        if provider == agg_class.__name__:
-            obj = agg_class(resolution, database_dir=configuration.database_dir)
-            for record in obj.get_timeserie_data(start_time, end_time,
-                                                 key_fields.split(',')):
-                record_key = []
-                for key_field in key_fields.split(','):
-                    if key_field in record and record[key_field] is not None:
-                        record_key.append(record[key_field])
-                    else:
-                        record_key.append('')
-                record_key = ','.join(record_key)
-                start_time_stamp = calendar.timegm(record['start_time'].timetuple())
-                if start_time_stamp not in timeseries:
-                    timeseries[start_time_stamp] = dict()
-                timeseries[start_time_stamp][record_key] = {'octets': record['octets'],
-                                                            'packets': record['packets'],
-                                                            'resolution': resolution}
-                if record_key not in dimension_keys:
-                    dimension_keys.append(record_key)
+    # dimension key -> column, in order of appearance
+    dimension_index: dict[str, int] = {}
+    row_indices = []
+    column_indices = []
+    octets = []
+    packets = []
+    for bucket, rows in buckets:
+        row = (bucket - first_slice) // resolution
+        for record_key, (record_octets, record_packets) in rows.items():
+            column = dimension_index.get(record_key)
+            if column is None:
+                column = dimension_index[record_key] = len(dimension_index)
+            if row < 0:
+                continue
+            row_indices.append(row)
+            column_indices.append(column)
+            octets.append(record_octets)
+            packets.append(record_packets)
 
     # When there's no data found, collect keys from the running configuration to render empty results
-    if len(dimension_keys) == 0 and os.path.isfile('/usr/local/etc/netflow.conf'):
-        tmp = open('/usr/local/etc/netflow.conf').read()
-        if tmp.find('netflow_interfaces="') > -1:
-            for intf in tmp.split('netflow_interfaces="')[-1].split('"')[0].split():
-                dimension_keys.append('%s,in' % intf)
-                dimension_keys.append('%s,out' % intf)
+    if len(dimension_index) == 0:
+        for key in _configured_dimension_keys():
+            dimension_index.setdefault(key, len(dimension_index))
 
     # make sure all timeslices for every dimension key exist (resample collected data)
-    start_time = start_time
-    while start_time < time.time():
-        if start_time not in timeseries:
-            timeseries[start_time] = dict()
-        for dimension_key in dimension_keys:
-            if dimension_key not in timeseries[start_time]:
-                timeseries[start_time][dimension_key] = {
-                    'octets': 0,
-                    'packets': 0,
-                    'resolution': resolution
-                }
-        start_time += resolution
+    slice_count = max(-(-(end_time - first_slice) // resolution), max(row_indices, default=-1) + 1, 0)
+    timestamps = [first_slice + row * resolution for row in range(slice_count)]
+    keys = list(dimension_index)
+    octets = _matrix(slice_count, len(keys), row_indices, column_indices, octets)
+    packets = _matrix(slice_count, len(keys), row_indices, column_indices, packets)
 
+    if dense:
+        return {
+            'timestamps': timestamps,
+            'keys': keys,
+            'octets': octets,
+            'packets': packets,
+            'resolution': resolution,
+        }
+
+    if np is not None:
+        octets = octets.tolist()
+        packets = packets.tolist()
+    timeseries = {}
+    for timestamp, slice_octets, slice_packets in zip(timestamps, octets, packets):
+        timeseries[timestamp] = {
+            key: {'octets': key_octets, 'packets': key_packets, 'resolution': resolution}
+            for key, key_octets, key_packets in zip(keys, slice_octets, slice_packets)
+        }
     return timeseries
 
 
 if __name__ == '__main__':
-    result = get_timeseries('FlowInterfaceTotals', 1713171600, 1713182206, 'if,direction', 30)
-    print(ujson.dumps(result, indent=4))
\ No newline at end of file
+    result = get_timeseries(Provider.FlowInterfaceTotals, 1713171600, 1713182206, 'if,direction', 30)
+    print(ujson.dumps(result, indent=4))
@@ -1,16 +1,159 @@
-import sys
-from typing import Literal
-
-sys.path.append('/usr/local/opnsense/scripts/netflow/')
-
+import heapq
 import time
-import lib.aggregates
-from lib import load_config
+from typing import Iterator, Literal
 
 from network_enums import Provider
+from netflow_db import format_timestamp, get_aggregator, get_database, select_resolution
+from query_cache import get_query_cache
 from utils import log_on_verbose
 
-# define enum for providers
+
+def _filter_sql(agg_class: type, filter_string: str, query_params: dict) -> str:
+    # "and" clauses of the data filters (e.g. 'if=1,direction=in'), unknown fields are ignored
+    filter_sql = ''
+    if filter_string:
+        for index, data_filter in enumerate(filter_string.split(',')):
+            field = data_filter.split('=')[0].strip()
+            if field in agg_class.agg_fields and data_filter.find('=') > -1:
+                filter_sql += f' and "{field}" = :filter{index}'
+                query_params[f'filter{index}'] = '='.join(data_filter.split('=')[1:])
+    return filter_sql
+
+
+def _query_bucket_totals(agg_class: type, resolution: int, select_fields: list[str], filter_string: str,
+                         start_time: int, end_time: int) -> dict:
+    # {bucket start: {group: (octets, packets, last_seen)}}
+    query_params = {
+        'start_time': format_timestamp(start_time),
+        'end_time': format_timestamp(end_time),
+    }
+    filter_sql = _filter_sql(agg_class, filter_string, query_params)
+    columns = ','.join(f'"{field}"' for field in select_fields)
+    sql_select = f"select cast(strftime('%s', mtime) as integer) as bucket, {columns}, " \
+                 f"sum(octets), sum(packets), max(last_seen) " \
+                 f"from timeserie " \
+                 f"where mtime >= :start_time and mtime < :end_time{filter_sql} " \
+                 f"group by mtime, {columns}"
+    buckets = {}
+    database = get_database(agg_class, resolution)
+    if database is None:
+        return buckets
+    cursor = database.execute(sql_select, query_params)
+    try:
+        for record in cursor:
+            if record[0] not in buckets:
+                buckets[record[0]] = {}
+            buckets[record[0]][record[1:-3]] = record[-3:]
+    finally:
+        cursor.close()
+    return buckets
+
+
+def _cached_top_usage(agg_class: type, resolution: int, select_fields: list[str], start_time: int, end_time: int,
+                      value_field: str, filter_string: str, max_hits: int) -> list[dict]:
+    """
+    Top usage from per bucket totals, completed buckets come from the query cache so a sliding window only
+    queries its newest buckets. Gives the same result as the query of iter_top_usage.
+    """
+    first_bucket = start_time // resolution * resolution
+    query_key = ('top', agg_class.__name__, resolution, tuple(select_fields), filter_string)
+    query_cache = get_query_cache()
+    buckets, query_start = query_cache.cached_until(query_key, first_bucket, end_time, resolution)
+    if query_start < end_time:
+        queried = _query_bucket_totals(agg_class, resolution, select_fields, filter_string, query_start, end_time)
+        now = time.time()
+        bucket = query_start
+        while bucket < end_time and query_cache.is_complete(bucket, resolution, now):
+            query_cache.put(query_key, bucket, queried.get(bucket, {}))
+            bucket += resolution
+        buckets.extend(sorted(queried.items()))
+
+    # group -> [octets, packets, last_seen]
+    totals = {}
+    for _, groups in buckets:
+        for group, (octets, packets, last_seen) in groups.items():
+            total = totals.get(group)
+            if total is None:
+                totals[group] = [octets, packets, last_seen]
+                continue
+            total[0] += octets
+            total[1] += packets
+            if last_seen is not None and (total[2] is None or last_seen > total[2]):
+                total[2] = last_seen
+
+    value_index = {'octets': 0, 'packets': 1}.get(value_field)
+    top = heapq.nlargest(
+        max_hits,
+        ((group, total) for group, total in totals.items()
+         if total[2] is not None and start_time <= total[2] <= end_time),
+        key=lambda item: item[1][value_index] if value_index is not None else 0
+    )
+    result = []
+    for group, total in top:
+        record = dict(zip(select_fields, group))
+        record['total'] = total[value_index] if value_index is not None else 0
+        record['last_seen'] = total[2]
+        result.append(record)
+    return result
+
+
+def iter_top_usage(
+        provider: Provider,
+        start_time: int,
+        end_time: int,
+        key_fields: str,
+        value_field: str,
+        filter_string: str,
+        max_hits: int) -> Iterator[dict]:
+    """
+    Stream the top data of a provider for a given timeframe. Filtering on the timeframe (mtime and
+    last_seen), ordering and max_hits are done by SQLite, rows are read from the cursor one by one.
+    See get_top_usage for the parameters.
+    :return: iterator of dicts with the key fields, total and last_seen
+    """
+    agg_class = get_aggregator(provider)
+    if agg_class is None:
+        return
+    resolution = select_resolution(agg_class, start_time)
+    select_fields = [field for field in key_fields.split(',') if field in agg_class.agg_fields]
+    if not select_fields:
+        return
+    if value_field == 'octets':
+        value_sql = 'sum(octets)'
+    elif value_field == 'packets':
+        value_sql = 'sum(packets)'
+    else:
+        value_sql = '0'
+
+    # the aggregators correct start_time for the resolution
+    query_params = {
+        'start_time': format_timestamp(start_time // resolution * resolution),
+        'end_time': format_timestamp(end_time),
+        'first_seen': start_time,
+        'last_seen': end_time,
+        'max_hits': max_hits,
+    }
+    filter_sql = _filter_sql(agg_class, filter_string, query_params)
+
+    columns = ','.join(f'"{field}"' for field in select_fields)
+    sql_select = f'select {columns}, {value_sql} as total, max(last_seen) as last_seen ' \
+                 f'from timeserie ' \
+                 f'where mtime >= :start_time and mtime < :end_time{filter_sql} ' \
+                 f'group by {columns} ' \
+                 f'having max(last_seen) between :first_seen and :last_seen ' \
+                 f'order by total desc ' \
+                 f'limit :max_hits'
+    database = get_database(agg_class, resolution)
+    if database is None:
+        # no data collected yet
+        return
+    cursor = database.execute(sql_select, query_params)
+    try:
+        field_names = [description[0] for description in cursor.description]
+        for record in cursor:
+            yield dict(zip(field_names, record))
+    finally:
+        cursor.close()
 
 
 def get_top_usage(
@@ -32,53 +175,27 @@ def get_top_usage(
     :param max_hits: Maximum number of hits to return
     :return: list[dict]
 
-    NOTE: This function was ported from the original get_top_usage function in opnsense repo.
+    NOTE: This function was ported from the original get_top_usage function in opnsense repo, the query of the
+          aggregator's get_top_data is run directly (see iter_top_usage), with the last_seen filter and max_hits
+          applied by SQLite instead of fetching up to 100000 rows and filtering them here.
+          When the query cache is enabled the totals are summed from cached per bucket totals instead,
+          only the buckets that may still change are queried (see query_cache).
     NOTE: The possible values for the key_fields parameters are dependent on the provider:
     - FlowDstPortTotals: 'mtime,last_seen,if,protocol,dst_port,octets,packets'
     - FlowInterfaceTotals: 'mtime,last_seen,if,direction,octets,packets'
     - FlowSourceAddrTotals: 'mtime,last_seen,if,src_addr,direction,octets,packets'
     - FlowSourceAddrDetails: 'mtime,last_seen,if,direction,src_addr,dst_addr,service_port,protocol,octets,packets'
     """
-    MAX_HITS = 100000  # to get all results then filter out the ones outside the timeframe
-    result = {}
-    configuration = load_config()
-    for agg_class in lib.aggregates.get_aggregators():
-        if provider.value == agg_class.__name__:
-            # provider may specify multiple resolutions, we need to find the one most likely to serve the
-            # beginning of our timeframe
-            resolutions = sorted(agg_class.resolutions())
-            history_per_resolution = agg_class.history_per_resolution()
-
-            selected_resolution = resolutions[-1]
-            for resolution in resolutions:
-                if (resolution in history_per_resolution and time.time() - history_per_resolution[resolution] <= start_time) or \
-                        resolutions[-1] == resolution:
-                    selected_resolution = resolution
-                    break
-            obj = agg_class(selected_resolution, database_dir=configuration.database_dir)
-            res = obj.get_top_data(
-                start_time=start_time,
-                end_time=end_time,
-                fields=key_fields.split(','),
-                value_field=value_field,
-                data_filters=filter_string,
-                max_hits=MAX_HITS
-            )
-            # filter out results with last_seen outside the timeframe
-            result = []
-            for r in res:
-                # 'last_seen' could be int, str, None, not found
-                last_seen = r.get('last_seen', -1)
-                if isinstance(last_seen, str):
-                    if not last_seen.isnumeric():
-                        continue
-                    last_seen = int(last_seen)
-
-                if start_time <= last_seen <= end_time:
-                    result.append(r)
-                if len(result) >= max_hits:
-                    break
-    return result
+    if get_query_cache().enabled:
+        agg_class = get_aggregator(provider)
+        if agg_class is None:
+            return []
+        select_fields = [field for field in key_fields.split(',') if field in agg_class.agg_fields]
+        if not select_fields:
+            return []
+        return _cached_top_usage(agg_class, select_resolution(agg_class, start_time), select_fields, start_time,
+                                 end_time, value_field, filter_string, max_hits)
+    return list(iter_top_usage(provider, start_time, end_time, key_fields, value_field, filter_string, max_hits))
 
 
 def get_flow_source_addr_details_all_fields(duration_in_seconds, max_hits,
@@ -0,0 +1,155 @@
+import heapq
+from typing import Literal
+
+from connection import Connection
+
+OTHER = 'other'
+
+# number of counters kept per reported connection, the overestimation of every counter is bounded by
+# total / (max_hits * SPACE_SAVING_FACTOR)
+SPACE_SAVING_FACTOR = 4
+
+
+def other_connection(first_seen: float, last_seen: float, octets: int, packets: int) -> Connection:
+    """
+    Create the "other" bucket: a single connection that carries the traffic outside the top-K
+    :return: Connection
+    """
+    return Connection(
+        first_seen=first_seen,
+        last_seen=last_seen,
+        interface_in=OTHER,
+        interface_out=OTHER,
+        src_ip=OTHER,
+        dst_ip=OTHER,
+        src_port=0,
+        dst_port=0,
+        transport_protocol=-1,
+        octets=octets,
+        packets=packets
+    )
+
+
+class SpaceSaving:
+    """
+    Space-Saving heavy-hitter summary over connections, memory is bounded by max_hits * SPACE_SAVING_FACTOR.
+
+    Every monitored connection keeps an error: the count of the evicted connection it replaced. Its true
+    weight lies between connection.<value> and connection.<value> + error (error is stored on the
+    connection as octets_error / packets_error).
+    Traffic of evicted connections, and of monitored connections outside the top max_hits, is reported in
+    the "other" bucket.
+    """
+
+    def __init__(self, max_hits: int, value: Literal["octets", "packets"] = "octets"):
+        self.max_hits = max_hits
+        self.capacity = max_hits * SPACE_SAVING_FACTOR
+        self.value = value
+        self.connections: dict[bytes, Connection] = {}
+        self.errors: dict[bytes, int] = {}
+        # lazy min-heap of (estimated count, connection id), entries are refreshed when popped
+        self._heap: list[tuple[int, bytes]] = []
+        self.total_octets = 0
+        self.total_packets = 0
+        self.first_seen = None
+        self.last_seen = None
+
+    def _estimate(self, conn_id: bytes) -> int:
+        return getattr(self.connections[conn_id], self.value) + self.errors[conn_id]
+
+    def _min_counter(self) -> tuple[int, bytes]:
+        # refresh the top of the lazy heap until it holds an up to date estimate
+        while True:
+            count, min_id = self._heap[0]
+            estimate = self._estimate(min_id)
+            if estimate == count:
+                return count, min_id
+            heapq.heapreplace(self._heap, (estimate, min_id))
+
+    def floor(self) -> int:
+        """
+        Upper bound of the count of a connection that isn't monitored
+        :return: smallest estimated count when every counter is in use, otherwise 0
+        """
+        if len(self.connections) < self.capacity:
+            return 0
+        return self._min_counter()[0]
+
+    @classmethod
+    def combine(cls, summaries: list['SpaceSaving'], connections: dict[bytes, Connection], max_hits: int,
+                value: Literal["octets", "packets"] = "octets") -> 'SpaceSaving':
+        """
+        Combine the summaries of consecutive parts of the flows (mergeable Space-Saving): the errors of a
+        connection add up, a summary that doesn't monitor it contributes its floor()
+        :param summaries: summaries of the parts, with the same max_hits and value
+        :param connections: the monitored connections of all summaries merged by id (see flow_shards.merge_shards)
+        :param max_hits: number of connections to report
+        :param value: field connections are ranked on
+        :return: SpaceSaving, only to be used for top()
+        """
+        combined = cls(max_hits, value)
+        combined.connections = connections
+        combined.errors = dict.fromkeys(connections, 0)
+        for summary in summaries:
+            floor = summary.floor()
+            for conn_id in connections:
+                combined.errors[conn_id] += summary.errors.get(conn_id, floor)
+            combined.total_octets += summary.total_octets
+            combined.total_packets += summary.total_packets
+            if summary.first_seen is not None:
+                if combined.first_seen is None or summary.first_seen < combined.first_seen:
+                    combined.first_seen = summary.first_seen
+                if combined.last_seen is None or summary.last_seen > combined.last_seen:
+                    combined.last_seen = summary.last_seen
+        return combined
+
+    def add(self, connection: Connection):
+        """
+        Account a new flow
+        :param connection: connection built from a single flow record
+        """
+        self.total_octets += connection.octets
+        self.total_packets += connection.packets
+        if self.first_seen is None or connection.first_seen < self.first_seen:
+            self.first_seen = connection.first_seen
+        if self.last_seen is None or connection.last_seen > self.last_seen:
+            self.last_seen = connection.last_seen
+
+        conn_id = connection.get_id()
+        if conn_id in self.connections:
+            self.connections[conn_id].merge(connection)
+            return
+
+        error = 0
+        if len(self.connections) >= self.capacity:
+            # evict the connection with the smallest estimated count, it's replaced by the new one
+            count, min_id = self._min_counter()
+            heapq.heappop(self._heap)
+            del self.connections[min_id]
+            del self.errors[min_id]
+            error = count
+
+        self.connections[conn_id] = connection
+        self.errors[conn_id] = error
+        heapq.heappush(self._heap, (self._estimate(conn_id), conn_id))
+
+    def top(self) -> list[Connection]:
+        """
+        Get the top max_hits connections (by estimated count), followed by the "other" bucket when there's
+        traffic outside of them
+        :return: list
+        """
+        top_ids = heapq.nlargest(self.max_hits, self.connections, key=self._estimate)
+        result = []
+        octets = 0
+        packets = 0
+        for conn_id in top_ids:
+            connection = self.connections[conn_id]
+            setattr(connection, self.value + '_error', self.errors[conn_id])
+            octets += connection.octets
+            packets += connection.packets
+            result.append(connection)
+        if octets < self.total_octets or packets < self.total_packets:
+            result.append(other_connection(self.first_seen, self.last_seen,
+                                           self.total_octets - octets, self.total_packets - packets))
+        return result
@@ -0,0 +1,55 @@
+#!./venv/bin/python3
+import argparse
+import os
+import subprocess
+import sys
+
+# cumulative import time budget per module (milliseconds, as reported by python -X importtime)
+IMPORT_BUDGETS = {
+    'flowd_decoder': 25,
+    'flow2json': 35,
+    'connection': 120,
+    'flow_shards': 130,
+    'metrics': 70,
+    'syslog_sender': 100,
+    'query_cache': 80,
+    'main': 320,
+}
+
+
+def measure_import(module: str, runs: int = 3) -> float:
+    """
+    Measure the cumulative import time of a module in a new interpreter
+    :param module: module name
+    :param runs: number of measurements, the fastest one is reported
+    :return: milliseconds
+    """
+    timings = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True)
+        for line in reversed(result.stderr.splitlines()):
+            # "import time: self [us] | cumulative | imported package", nested imports are indented
+            fields = line.split('|')
+            if len(fields) == 3 and fields[2].rstrip() == f' {module}':
+                timings.append(int(fields[1]) / 1000)
+                break
+    return min(timings)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the import time of the modules against their budget')
+    parser.add_argument('modules', nargs='*', help='modules to check (default: all with a budget)')
+    parser.add_argument('--runs', help='measurements per module', type=int, default=3)
+    cmd_args = parser.parse_args()
+
+    over_budget = []
+    for module in cmd_args.modules or IMPORT_BUDGETS:
+        elapsed = measure_import(module, cmd_args.runs)
+        budget = IMPORT_BUDGETS.get(module)
+        status = '' if budget is None else ('ok' if elapsed <= budget else 'OVER BUDGET')
+        print(f"{module:<16} {elapsed:>8.1f} ms  budget {budget if budget is not None else '-':>5} ms  {status}")
+        if budget is not None and elapsed > budget:
+            over_budget.append(module)
+    sys.exit(1 if over_budget else 0)
@@ -1,21 +1,85 @@
 #!./venv/bin/python3
+import atexit
+import signal
 import sys
+import threading
 import time
 
+import metrics
+from pipeline import Pipeline
 from status_db import StatusDB
 from syslog_sender import send_syslog_json_message
-from dotenv import load_dotenv
-import os
+from utils import getenv
 
-load_dotenv()
+REFRESH_INTERVAL = int(getenv("REFRESH_INTERVAL"))
+# full: emit every connection each refresh, delta: only new, changed and closed connections
+EMIT_MODE = getenv("EMIT_MODE", "full")
+# in delta mode, emit a full snapshot every KEYFRAME_INTERVAL seconds (0 to disable)
+KEYFRAME_INTERVAL = int(getenv("KEYFRAME_INTERVAL", "0"))
+# 1: run parsing, state updates, enrichment and emission as concurrent stages (see pipeline.Pipeline)
+PIPELINE = getenv("PIPELINE", "0") == "1"
 
-REFRESH_INTERVAL = int(os.getenv("REFRESH_INTERVAL"))
+last_keyframe_time = int(time.time())
+
+# set on SIGTERM, the refresh loop exits at its next iteration boundary
+stop_requested = threading.Event()
+
+
+def emit_connections(db: StatusDB) -> int:
+    """
+    Send the connections to syslog (only the changed ones in delta mode, except for keyframes)
+    :param db: connection state
+    :return: number of emitted connections
+    """
+    global last_keyframe_time
+    start = time.perf_counter()
+    changed_only = EMIT_MODE == "delta"
+    if changed_only and KEYFRAME_INTERVAL > 0 and time.time() - last_keyframe_time >= KEYFRAME_INTERVAL:
+        changed_only = False
+        last_keyframe_time = int(time.time())
+    connections = db.get_connections(changed_only)
+    for conn in connections['active_connections']:
+        conn['status'] = 'active'
+        send_syslog_json_message(conn)
+    for conn in connections['idle_connections']:
+        conn['status'] = 'idle'
+        send_syslog_json_message(conn)
+    for conn in connections['closed_connections']:
+        conn['status'] = 'closed'
+        send_syslog_json_message(conn)
+    metrics.stage_duration.observe(time.perf_counter() - start, 'emit')
+    return sum(len(conns) for conns in connections.values())
 
 
 def main():
     db = StatusDB()
+    # SIGUSR1 / SIGUSR2 toggle a cProfile / tracemalloc capture
+    metrics.profile_toggle.install()
+    pipeline = Pipeline(db, REFRESH_INTERVAL, emit_connections) if PIPELINE else None
+
+    def request_stop(signum, frame):
+        # the service is stopped with SIGTERM. Exiting right here could interrupt a refresh halfway and the
+        # final snapshot would hold half-applied tables, so main() returns after the current refresh and the
+        # atexit handlers (final snapshot, syslog flush) run then
+        stop_requested.set()
+        if pipeline is not None:
+            pipeline.stop()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    server = metrics.start_server()
+    if server is not None:
+        host, port = server.server_address[:2]
+        print(f"Metrics served on http://{host}:{port}/metrics", file=sys.stderr)
+    if db.SNAPSHOT_INTERVAL > 0:
+        if db.load_snapshot():
+            print(f"Restored state from {db.SNAPSHOT_FILE}", file=sys.stderr)
+        atexit.register(db.save_snapshot)
+    if pipeline is not None:
+        pipeline.run()
+        return
+
     last_start_time = int(time.time())
-    while True:
+    while not stop_requested.is_set():
         try:
             db.update_connections()
         except Exception as e:
@@ -24,23 +88,16 @@ def main():
         print(f"Active connections: {status['active_connections']}", file=sys.stderr)
         print(f"Idle connections: {status['idle_connections']}", file=sys.stderr)
         print(f"Closed connections: {status['closed_connections']}", file=sys.stderr)
-        connections = db.get_connections()
-        for conn in connections['active_connections']:
-            conn['status'] = 'active'
-            send_syslog_json_message(conn)
-        for conn in connections['idle_connections']:
-            conn['status'] = 'idle'
-            send_syslog_json_message(conn)
-        for conn in connections['closed_connections']:
-            conn['status'] = 'closed'
-            send_syslog_json_message(conn)
-        while True:
+        print(f"Enrichment backlog: {status['enrich_backlog']} "
+              f"(oldest {status['enrich_backlog_age']:.0f}s)", file=sys.stderr)
+        emit_connections(db)
+        while not stop_requested.is_set():
             time_remaining = REFRESH_INTERVAL - (int(time.time()) - last_start_time)
             if time_remaining <= 0:
                 last_start_time = int(time.time())
                 break
             print(f"Next update in {time_remaining} seconds        ", file=sys.stderr, end='\r')
-            time.sleep(0.95)
+            stop_requested.wait(0.95)
 
 
 if __name__ == '__main__':
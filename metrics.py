@@ -0,0 +1,324 @@
+import bisect
+import os
+import resource
+import signal
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable
+
+from utils import getenv
+
+
+# settings (read on first use): /metrics is served on METRICS_HOST:METRICS_PORT (0 to disable), cProfile
+# (SIGUSR1) and tracemalloc (SIGUSR2) captures are written to PROFILE_DIR
+DEFAULT_METRICS_HOST = "127.0.0.1"
+DEFAULT_METRICS_PORT = 0
+DEFAULT_PROFILE_DIR = "/tmp"
+
+OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(label_names: tuple, label_values: tuple, extra: str = '') -> str:
+    labels = [f'{name}="{value}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    Metric family, with one value per combination of label values
+    """
+    type = 'unknown'
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        """
+        :return: iterator (name suffix, label values, extra label, value)
+        """
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in values:
+            yield '', label_values, '', value
+
+    def expose(self) -> list[str]:
+        lines = [f'# TYPE {self.name} {self.type}', f'# HELP {self.name} {self.documentation}']
+        for suffix, label_values, extra, value in self.samples():
+            lines.append(f'{self.name}{suffix}{_format_labels(self.label_names, label_values, extra)} '
+                         f'{_format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = ()):
+        super().__init__(name, documentation, label_names)
+        if not self.label_names:
+            self._values[()] = 0
+
+    def inc(self, amount: float = 1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        for _, label_values, extra, value in super().samples():
+            yield '_total', label_values, extra, value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value: float, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, label_names: tuple = (), buckets: tuple = DURATION_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *label_values):
+        with self._lock:
+            state = self._values.get(label_values)
+            if state is None:
+                # per bucket counts (not cumulative), sum, count
+                state = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, *label_values):
+        """
+        Observe the duration of a with block
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def samples(self):
+        with self._lock:
+            values = [(label_values, (list(state[0]), state[1], state[2]))
+                      for label_values, state in self._values.items()]
+        for label_values, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                yield '_bucket', label_values, f'le="{_format_value(float(bound))}"', cumulative
+            yield '_sum', label_values, '', total
+            yield '_count', label_values, '', count
+
+
+class Registry:
+    """
+    Collection of metrics, exposed in the OpenMetrics text format. Collectors are called on every exposition
+    to update gauges of values that are kept elsewhere (cache statistics, queue depth, memory).
+    """
+
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+        self._collectors: list[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric_class, name: str, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = metric_class(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name: str, documentation: str, label_names: tuple = ()) -> Counter:
+        return self._register(Counter, name, documentation, label_names)
+
+    def gauge(self, name: str, documentation: str, label_names: tuple = ()) -> Gauge:
+        return self._register(Gauge, name, documentation, label_names)
+
+    def histogram(self, name: str, documentation: str, label_names: tuple = (),
+                  buckets: tuple = DURATION_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, documentation, label_names, buckets)
+
+    def add_collector(self, collector: Callable[[], None]):
+        self._collectors.append(collector)
+
+    def expose(self) -> str:
+        """
+        :return: all metrics in the OpenMetrics text format
+        """
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                print(f"------ Error: metrics collector failed: {e}", file=sys.stderr)
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.expose())
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+stage_duration = registry.histogram('netmon_stage_duration_seconds', 'Duration of a refresh stage', ('stage',))
+flows_parsed = registry.counter('netmon_flows_parsed', 'Flow records read from the flowd log within the timeframe '
+                                                       '(not counted by the worker processes of FLOW_WORKERS)')
+log_bytes_read = registry.counter('netmon_log_bytes_read', 'Bytes read from the flowd log')
+connections_aggregated = registry.counter('netmon_connections_aggregated', 'Connections reported by aggregation')
+connection_merges = registry.counter('netmon_connection_merges', 'Connections merged into a tracked connection')
+connections_new = registry.counter('netmon_connections_new', 'New connections tracked')
+connections_enriched = registry.counter('netmon_connections_enriched', 'Connections enriched')
+syslog_messages = registry.counter('netmon_syslog_messages', 'Syslog messages queued')
+connections_tracked = registry.gauge('netmon_connections', 'Tracked connections', ('state',))
+enrich_backlog = registry.gauge('netmon_enrich_backlog', 'Connections waiting for enrichment')
+geoip_cache_hit_ratio = registry.gauge('netmon_geoip_cache_hit_ratio', 'GeoIP cache hit ratio')
+geoip_cache_size = registry.gauge('netmon_geoip_cache_entries', 'GeoIP cache entries')
+syslog_queue_depth = registry.gauge('netmon_syslog_queue_depth', 'Syslog messages waiting to be written')
+syslog_dropped = registry.gauge('netmon_syslog_dropped', 'Syslog messages dropped (queue full or write error)')
+resident_memory = registry.gauge('netmon_resident_memory_bytes', 'Resident memory of the process')
+max_resident_memory = registry.gauge('netmon_max_resident_memory_bytes', 'Peak resident memory of the process')
+
+
+def _collect_memory():
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes, except on macOS
+    maxrss = maxrss if sys.platform == 'darwin' else maxrss * 1024
+    max_resident_memory.set(maxrss)
+    try:
+        with open('/proc/self/statm') as f:
+            resident_memory.set(int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE'))
+    except OSError:
+        # no procfs (FreeBSD), the peak is all there is
+        resident_memory.set(maxrss)
+
+
+registry.add_collector(_collect_memory)
+
+
+def start_server(host: str = None, port: int = None):
+    """
+    Serve /metrics on a background thread
+    :param host: address to listen on, METRICS_HOST when not given
+    :param port: port to listen on, METRICS_PORT when not given
+    :return: the server (http.server.ThreadingHTTPServer, shutdown() to stop it) or None when the port is 0
+    """
+    if host is None:
+        host = getenv("METRICS_HOST", DEFAULT_METRICS_HOST)
+    if port is None:
+        port = int(getenv("METRICS_PORT", str(DEFAULT_METRICS_PORT)))
+    if port <= 0:
+        return None
+    # imported here, http.server is slow to import and only needed when the endpoint is enabled
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.expose().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', OPENMETRICS_CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
+
+
+class ProfileToggle:
+    """
+    Runtime capture switches: the first signal starts a capture, the next one stops it and writes the result
+    to PROFILE_DIR.
+    - cProfile (SIGUSR1) profiles the main thread (the refresh loop, or the state and emit stages of the
+      pipeline), written as a pstats file plus a summary on stderr
+    - tracemalloc (SIGUSR2) traces allocations of all threads, the top allocation sites are written as text
+    """
+
+    def __init__(self, directory: str = None):
+        # PROFILE_DIR when not given
+        self.directory = directory
+        self._profile = None
+
+    def _filename(self, kind: str, extension: str) -> str:
+        directory = self.directory or getenv("PROFILE_DIR", DEFAULT_PROFILE_DIR)
+        return os.path.join(directory, f"netmon-{kind}-{os.getpid()}-{int(time.time())}.{extension}")
+
+    def toggle_profile(self, signum=None, frame=None):
+        import cProfile
+        import io
+        import pstats
+        if self._profile is None:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+            print("cProfile capture started", file=sys.stderr)
+            return
+        self._profile.disable()
+        filename = self._filename('profile', 'pstats')
+        self._profile.dump_stats(filename)
+        summary = io.StringIO()
+        pstats.Stats(self._profile, stream=summary).strip_dirs().sort_stats(pstats.SortKey.CUMULATIVE) \
+            .print_stats(30)
+        self._profile = None
+        print(summary.getvalue(), file=sys.stderr)
+        print(f"cProfile capture written to {filename}", file=sys.stderr)
+
+    def toggle_tracemalloc(self, signum=None, frame=None):
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+            print("tracemalloc capture started", file=sys.stderr)
+            return
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        filename = self._filename('tracemalloc', 'txt')
+        with open(filename, 'w') as f:
+            f.write(f"traced memory: {current} bytes, peak {peak} bytes\n")
+            for stat in snapshot.statistics('lineno')[:50]:
+                f.write(f"{stat}\n")
+        print(f"tracemalloc capture written to {filename}", file=sys.stderr)
+
+    def install(self):
+        """
+        Install the signal handlers (main thread only)
+        """
+        signal.signal(signal.SIGUSR1, self.toggle_profile)
+        signal.signal(signal.SIGUSR2, self.toggle_tracemalloc)
+
+
+profile_toggle = ProfileToggle()
+
+
+if __name__ == '__main__':
+    with stage_duration.time('example'):
+        time.sleep(0.01)
+    flows_parsed.inc(42)
+    print(registry.expose())
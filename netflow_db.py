@@ -0,0 +1,95 @@
+import sys
+sys.path.append('/usr/local/opnsense/scripts/netflow/')
+
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+from lib import load_config
+import lib.aggregates
+
+from network_enums import Provider
+
+_configuration = None
+_aggregators: dict[str, type] = {}
+# sqlite connections are bound to the thread that opened them
+_connections = threading.local()
+
+
+def get_configuration():
+    """
+    Get the netflow configuration, loaded once
+    :return: configuration (see lib.load_config)
+    """
+    global _configuration
+    if _configuration is None:
+        _configuration = load_config()
+    return _configuration
+
+
+def get_aggregator(provider) -> type:
+    """
+    Get the aggregator class of a provider from a registry built on first use
+    :param provider: Provider or its name
+    :return: aggregator class or None when unknown
+    """
+    if not _aggregators:
+        for agg_class in lib.aggregates.get_aggregators():
+            _aggregators[agg_class.__name__] = agg_class
+    return _aggregators.get(provider.value if isinstance(provider, Provider) else provider)
+
+
+def select_resolution(agg_class: type, start_time: int) -> int:
+    """
+    Find the resolution most likely to serve the beginning of the timeframe, a provider keeps less history
+    for its finer resolutions
+    :param agg_class: aggregator class
+    :param start_time: start of the timeframe (epoch)
+    :return: int
+    """
+    resolutions = sorted(agg_class.resolutions())
+    history_per_resolution = agg_class.history_per_resolution()
+    for resolution in resolutions:
+        if resolution in history_per_resolution and time.time() - history_per_resolution[resolution] <= start_time:
+            return resolution
+    return resolutions[-1]
+
+
+def get_database(agg_class: type, resolution: int):
+    """
+    Get a read-only connection to the database of an aggregator, kept open for the next calls (per thread).
+    The connection is reopened when the file was replaced (a reset of the netflow data removes the databases).
+    :param agg_class: aggregator class
+    :param resolution: resolution (seconds)
+    :return: sqlite3.Connection or None when the aggregator didn't create its database (yet)
+    """
+    filename = os.path.join(get_configuration().database_dir, agg_class.target_filename % resolution)
+    connections = getattr(_connections, 'databases', None)
+    if connections is None:
+        connections = _connections.databases = {}
+    try:
+        inode = os.stat(filename).st_ino
+    except FileNotFoundError:
+        inode = None
+    # filename -> (inode, connection)
+    cached = connections.get(filename)
+    if cached is not None and cached[0] != inode:
+        cached[1].close()
+        del connections[filename]
+        cached = None
+    if inode is None:
+        return None
+    if cached is None:
+        cached = connections[filename] = (inode, sqlite3.connect(f"file:{filename}?mode=ro", uri=True, timeout=60))
+    return cached[1]
+
+
+def format_timestamp(timestamp: int) -> str:
+    """
+    Format an epoch the way the aggregators store mtime (UTC datetime)
+    :param timestamp: epoch
+    :return: str
+    """
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
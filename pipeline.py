@@ -0,0 +1,142 @@
+import math
+import queue
+import sys
+import threading
+import time
+from typing import Callable
+
+from status_db import StatusDB
+
+PIPELINE_QUEUE_SIZE = 2
+
+
+class StageStats:
+    """
+    Throughput counters of one pipeline stage
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.runs = 0
+        self.items = 0
+        self.busy_time = 0.0
+
+    def record(self, items: int, elapsed: float):
+        self.runs += 1
+        self.items += items
+        self.busy_time += elapsed
+
+    def as_dict(self) -> dict:
+        return {
+            'runs': self.runs,
+            'items': self.items,
+            'busy_time': self.busy_time,
+            'items_per_sec': self.items / self.busy_time if self.busy_time > 0 else 0.0,
+        }
+
+
+class Pipeline:
+    """
+    Runs the refresh as concurrent stages connected by bounded queues:
+    - ingest (thread): reads and aggregates the new flows on a fixed, drift corrected cadence
+    - state (caller's thread): merges them into StatusDB and emits the connections
+    - enrich (thread): drains the StatusDB enrichment backlog
+    - emit: the syslog writer thread (see syslog_sender)
+    A slow stage only delays the stages after it, ingestion keeps its cadence as long as the queue to the
+    state stage has room.
+    """
+
+    def __init__(self, db: StatusDB, interval: int, emit: Callable[[StatusDB], int],
+                 queue_size: int = PIPELINE_QUEUE_SIZE):
+        """
+        :param db: connection state
+        :param interval: refresh interval (seconds)
+        :param emit: function emitting the connections of db, returns the number of emitted connections
+        :param queue_size: number of refreshes that may wait between ingest and state
+        """
+        self.db = db
+        self.interval = interval
+        self.emit = emit
+        self._batches = queue.Queue(maxsize=queue_size)
+        self._enrich_wanted = threading.Event()
+        self._stop = threading.Event()
+        self.missed_ticks = 0
+        self.stats = {name: StageStats(name) for name in ('ingest', 'state', 'enrich', 'emit')}
+
+    def _ingest(self):
+        next_run = time.monotonic()
+        while not self._stop.is_set():
+            start = time.monotonic()
+            try:
+                batch, log_position = self.db.fetch_connections()
+            except Exception as e:
+                # the log position isn't moved (see flow2conn.get_last_connections), the segment is read again
+                # on the next tick. The state stage still runs the expiry.
+                print(f"------ Error: {e}", file=sys.stderr)
+                batch, log_position = [], None
+            self.stats['ingest'].record(len(batch), time.monotonic() - start)
+            self._batches.put((batch, log_position))
+
+            # schedule on a fixed grid, skip the ticks that were missed instead of drifting
+            next_run += self.interval
+            now = time.monotonic()
+            if now > next_run:
+                missed = math.ceil((now - next_run) / self.interval)
+                self.missed_ticks += missed
+                next_run += missed * self.interval
+            self._stop.wait(next_run - now)
+
+    def _enrich(self):
+        while not self._stop.is_set():
+            self._enrich_wanted.wait()
+            self._enrich_wanted.clear()
+            start = time.monotonic()
+            try:
+                count = self.db.drain_enrich_backlog()
+            except Exception as e:
+                # keep the thread alive, the backlog is drained again after the next refresh
+                print(f"------ Error: {e}", file=sys.stderr)
+                count = 0
+            self.stats['enrich'].record(count, time.monotonic() - start)
+
+    def print_status(self):
+        status = self.db.get_db_status()
+        print(f"Active connections: {status['active_connections']}", file=sys.stderr)
+        print(f"Idle connections: {status['idle_connections']}", file=sys.stderr)
+        print(f"Closed connections: {status['closed_connections']}", file=sys.stderr)
+        print(f"Enrichment backlog: {status['enrich_backlog']} "
+              f"(oldest {status['enrich_backlog_age']:.0f}s)", file=sys.stderr)
+        for name, stats in self.stats.items():
+            stats = stats.as_dict()
+            print(f"Stage {name}: {stats['items']} items in {stats['busy_time']:.2f}s "
+                  f"({stats['items_per_sec']:.0f}/s)", file=sys.stderr)
+        if self.missed_ticks:
+            print(f"Missed refreshes: {self.missed_ticks}", file=sys.stderr)
+
+    def run(self):
+        threading.Thread(target=self._ingest, name='pipeline-ingest', daemon=True).start()
+        threading.Thread(target=self._enrich, name='pipeline-enrich', daemon=True).start()
+        while not self._stop.is_set():
+            try:
+                batch, log_position = self._batches.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                self._refresh(batch, log_position)
+            except Exception as e:
+                print(f"------ Error: {e}", file=sys.stderr)
+
+    def _refresh(self, batch: list, log_position: tuple[int, int]):
+        start = time.monotonic()
+        self.db.apply_connections(batch, log_position)
+        self.stats['state'].record(len(batch), time.monotonic() - start)
+        self._enrich_wanted.set()
+
+        start = time.monotonic()
+        count = self.emit(self.db)
+        self.stats['emit'].record(count, time.monotonic() - start)
+        self.print_status()
+
+    def stop(self):
+        self._stop.set()
+        self._enrich_wanted.set()
@@ -0,0 +1,130 @@
+import threading
+import time
+from collections import OrderedDict
+
+from utils import getenv
+
+# settings (read by get_query_cache, QUERY_CACHE_SIZE and QUERY_CACHE_SETTLE override the defaults below)
+# maximum number of cached rows (dimension keys / groups, summed over all cached buckets), 0 to disable
+QUERY_CACHE_SIZE = 200000
+# seconds after its end during which a bucket may still be updated by the aggregator. The aggregator spreads a
+# flow over the buckets from its start, and a long-lived flow is only exported after the NetFlow active timeout
+# (1800 seconds), plus the time the aggregator takes to process the flowd log (300 seconds of margin)
+QUERY_CACHE_SETTLE = 1800 + 300
+
+
+class BucketCache:
+    """
+    LRU cache of query results per time bucket. Only completed buckets, which the aggregator no longer
+    updates (settle seconds after their end, see QUERY_CACHE_SETTLE), are stored, so entries never need
+    invalidation: a query over a sliding window is served from the cache except for the newest buckets.
+    The size is bounded by the number of rows over all cached buckets.
+    """
+
+    def __init__(self, max_size: int = QUERY_CACHE_SIZE, settle: int = QUERY_CACHE_SETTLE):
+        self.max_size = max_size
+        self.settle = settle
+        # (query key, bucket start) -> rows of the bucket
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def is_complete(self, bucket: int, resolution: int, now: float = None) -> bool:
+        """
+        :param bucket: bucket start (epoch)
+        :param resolution: bucket size (seconds)
+        :param now: current time
+        :return: True when the bucket won't change anymore
+        """
+        return bucket + resolution + self.settle <= (now if now is not None else time.time())
+
+    def get(self, query_key: tuple, bucket: int):
+        """
+        :return: cached rows of the bucket or None
+        """
+        with self._lock:
+            rows = self._entries.get((query_key, bucket))
+            if rows is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((query_key, bucket))
+            self.hits += 1
+            return rows
+
+    def put(self, query_key: tuple, bucket: int, rows):
+        """
+        Store the rows of a completed bucket
+        :param query_key: provider, resolution, fields and filter of the query
+        :param bucket: bucket start (epoch)
+        :param rows: rows of the bucket (sized container)
+        """
+        with self._lock:
+            if (query_key, bucket) in self._entries:
+                return
+            self._entries[(query_key, bucket)] = rows
+            # empty buckets count as one row as well
+            self.size += len(rows) or 1
+            while self.size > self.max_size and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted) or 1
+                self.evictions += 1
+
+    def cached_until(self, query_key: tuple, first_bucket: int, end_time: int, resolution: int) -> tuple[list, int]:
+        """
+        Get the cached buckets from first_bucket on, up to the first one that isn't cached
+        :param query_key: provider, resolution, fields and filter of the query
+        :param first_bucket: first bucket of the query
+        :param end_time: end of the query (exclusive)
+        :param resolution: bucket size (seconds)
+        :return: list of (bucket, rows) and the start of the first bucket that needs to be queried
+        """
+        buckets = []
+        bucket = first_bucket
+        while bucket < end_time:
+            rows = self.get(query_key, bucket)
+            if rows is None:
+                break
+            buckets.append((bucket, rows))
+            bucket += resolution
+        return buckets, bucket
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def get_stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'buckets': len(self._entries),
+            'size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
+
+
+# created on first use (see get_query_cache)
+_query_cache = None
+_query_cache_lock = threading.Lock()
+
+
+def get_query_cache() -> BucketCache:
+    """
+    :return: the BucketCache shared by the queries of this process, created on the first call
+    """
+    global _query_cache
+    if _query_cache is None:
+        with _query_cache_lock:
+            if _query_cache is None:
+                _query_cache = BucketCache(int(getenv("QUERY_CACHE_SIZE", str(QUERY_CACHE_SIZE))),
+                                           int(getenv("QUERY_CACHE_SETTLE", str(QUERY_CACHE_SETTLE))))
+    return _query_cache
@@ -0,0 +1,252 @@
+import ipaddress
+import socket
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from utils import getenv
+
+# settings (read by get_reverse_dns): RESOLVE_DOMAINS=1 enables the resolver, DNS_WORKERS, DNS_TIMEOUT,
+# DNS_POSITIVE_TTL and DNS_NEGATIVE_TTL override the defaults below
+DNS_WORKERS = 8
+DNS_TIMEOUT = 2.0
+DNS_POSITIVE_TTL = 3600
+DNS_NEGATIVE_TTL = 300
+DNS_CACHE_SIZE = 65536
+DNS_MAX_PENDING = 10000
+
+
+def gethostbyaddr(ip_address: str) -> str:
+    return socket.gethostbyaddr(ip_address)[0]
+
+
+def unknown_domain(ip_address: str) -> str:
+    return ip_address + " (Unknown)"
+
+
+def is_ip_address(address: str) -> bool:
+    try:
+        ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return True
+
+
+class _Lookup:
+    # a submitted lookup: deadline (None until a worker starts it), callbacks waiting for the answer and
+    # callbacks already answered as unknown on timeout, which still get a late answer
+    __slots__ = ('deadline', 'waiting', 'timed_out')
+
+    def __init__(self, callback: Callable[[str], None]):
+        self.deadline = None
+        self.waiting = [callback]
+        self.timed_out = []
+
+
+class ReverseDNSResolver:
+    """
+    Non-blocking reverse DNS lookups on a thread pool.
+
+    Results are cached with a positive and a negative TTL, concurrent requests for the same address share one
+    lookup, and a lookup that doesn't finish within the timeout (counted from the moment a worker starts it) is
+    answered as unknown, followed by the real answer when it arrives late. A lookup occupies one of max_pending
+    slots from submission until its worker returns, so a stalled resolver can't grow the executor queue.
+    The blocking resolve function can be replaced (e.g. by a stub resolver) through resolve_fn.
+    """
+
+    def __init__(self,
+                 max_workers: int = DNS_WORKERS,
+                 timeout: float = DNS_TIMEOUT,
+                 positive_ttl: int = DNS_POSITIVE_TTL,
+                 negative_ttl: int = DNS_NEGATIVE_TTL,
+                 max_size: int = DNS_CACHE_SIZE,
+                 max_pending: int = DNS_MAX_PENDING,
+                 resolve_fn: Callable[[str], str] = gethostbyaddr):
+        self.timeout = timeout
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.max_pending = max_pending
+        self.resolve_fn = resolve_fn
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='reverse-dns')
+        self._lock = threading.Lock()
+        # ip -> (domain, expires at)
+        self._cache: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        # ip -> submitted lookup, until its worker returns
+        self._inflight: dict[str, _Lookup] = {}
+        self.hits = 0
+        self.misses = 0
+        self.timeouts = 0
+        self.dropped = 0
+
+    def get(self, ip_address: str):
+        """
+        Get a cached domain name without scheduling a lookup
+        :param ip_address: IP address
+        :return: str or None when not cached (or expired)
+        """
+        with self._lock:
+            return self._get(ip_address)
+
+    def _get(self, ip_address: str):
+        entry = self._cache.get(ip_address)
+        if entry is None:
+            return None
+        if entry[1] < time.time():
+            del self._cache[ip_address]
+            return None
+        return entry[0]
+
+    def _put(self, ip_address: str, domain: str, ttl: int):
+        self._cache[ip_address] = (domain, time.time() + ttl)
+        self._cache.move_to_end(ip_address)
+        if len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    def resolve(self, ip_address: str, callback: Callable[[str], None]):
+        """
+        Resolve an IP address, callback is called with the domain name (or "<ip> (Unknown)") either right away
+        when cached, or from a worker thread once the lookup finishes. Lookups that are taking too long are
+        answered as unknown by expire(), which the caller runs periodically (once per refresh), and once more
+        when the answer arrives late. Anything that isn't an IP address (like the "other" bucket of the
+        heavy-hitter summary) is ignored.
+        :param ip_address: IP address
+        :param callback: function receiving the domain name
+        """
+        timed_out = False
+        with self._lock:
+            domain = self._get(ip_address)
+            if domain is None:
+                self.misses += 1
+                lookup = self._inflight.get(ip_address)
+                if lookup is not None:
+                    timed_out = bool(lookup.timed_out)
+                    (lookup.timed_out if timed_out else lookup.waiting).append(callback)
+                elif not is_ip_address(ip_address):
+                    return
+                elif len(self._inflight) >= self.max_pending:
+                    self.dropped += 1
+                    return
+                else:
+                    self._inflight[ip_address] = _Lookup(callback)
+            else:
+                self.hits += 1
+        if domain is not None:
+            callback(domain)
+            return
+        if timed_out:
+            callback(unknown_domain(ip_address))
+            return
+        if lookup is None:
+            future = self._executor.submit(self._lookup, ip_address)
+            future.add_done_callback(lambda f: self._done(ip_address, f))
+
+    def _lookup(self, ip_address: str) -> str:
+        with self._lock:
+            self._inflight[ip_address].deadline = time.time() + self.timeout
+        return self.resolve_fn(ip_address)
+
+    def _done(self, ip_address: str, future):
+        try:
+            domain = future.result()
+            ttl = self.positive_ttl
+        except Exception:
+            domain = unknown_domain(ip_address)
+            ttl = self.negative_ttl
+        with self._lock:
+            self._put(ip_address, domain, ttl)
+            lookup = self._inflight.pop(ip_address)
+        callbacks = lookup.waiting
+        if ttl == self.positive_ttl:
+            # answered as unknown on timeout, the late answer replaces it
+            callbacks = callbacks + lookup.timed_out
+        for callback in callbacks:
+            callback(domain)
+
+    def expire(self):
+        """
+        Answer lookups that are running for longer than the timeout as unknown. They keep their slot until the
+        worker returns, the callbacks get the answer if it still arrives.
+        """
+        now = time.time()
+        expired = []
+        with self._lock:
+            for ip_address, lookup in self._inflight.items():
+                if lookup.deadline is not None and lookup.deadline < now and lookup.waiting:
+                    if not lookup.timed_out:
+                        self.timeouts += 1
+                    expired.append((ip_address, lookup.waiting))
+                    lookup.timed_out.extend(lookup.waiting)
+                    lookup.waiting = []
+        for ip_address, callbacks in expired:
+            for callback in callbacks:
+                callback(unknown_domain(ip_address))
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                'size': len(self._cache),
+                'inflight': len(self._inflight),
+                'hits': self.hits,
+                'misses': self.misses,
+                'timeouts': self.timeouts,
+                'dropped': self.dropped,
+            }
+
+    def dump_cache(self) -> list[tuple[str, tuple[str, float]]]:
+        """
+        :return: cached entries, (ip, (domain, expires at)) in LRU order
+        """
+        with self._lock:
+            return list(self._cache.items())
+
+    def load_cache(self, entries: list[tuple[str, tuple[str, float]]]):
+        """
+        Restore entries returned by dump_cache, expired entries are skipped
+        :param entries: cached entries
+        """
+        now = time.time()
+        with self._lock:
+            for ip_address, (domain, expires) in entries:
+                if expires >= now:
+                    self._put(ip_address, domain, expires - now)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+# created on first use (see get_reverse_dns), False when RESOLVE_DOMAINS is off
+_reverse_dns = None
+_reverse_dns_lock = threading.Lock()
+
+
+def get_reverse_dns():
+    """
+    :return: the shared ReverseDNSResolver, or None when RESOLVE_DOMAINS is off (settings are read on the first
+             call)
+    """
+    global _reverse_dns
+    if _reverse_dns is None:
+        with _reverse_dns_lock:
+            if _reverse_dns is None:
+                if getenv("RESOLVE_DOMAINS", "0") == "1":
+                    _reverse_dns = ReverseDNSResolver(
+                        max_workers=int(getenv("DNS_WORKERS", str(DNS_WORKERS))),
+                        timeout=float(getenv("DNS_TIMEOUT", str(DNS_TIMEOUT))),
+                        positive_ttl=int(getenv("DNS_POSITIVE_TTL", str(DNS_POSITIVE_TTL))),
+                        negative_ttl=int(getenv("DNS_NEGATIVE_TTL", str(DNS_NEGATIVE_TTL))),
+                    )
+                else:
+                    _reverse_dns = False
+    return _reverse_dns or None
+
+
+if __name__ == '__main__':
+    resolver = ReverseDNSResolver()
+    resolver.resolve("8.8.8.8", print)
+    resolver.resolve("8.8.8.8", print)
+    time.sleep(resolver.timeout + 0.1)
+    resolver.expire()
+    print(resolver.get_stats())
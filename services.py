@@ -0,0 +1,114 @@
+import os
+import threading
+
+from utils import getenv
+
+from network_enums import Protocol
+
+SERVICES_FILE = '/etc/services'
+# SERVICES_OVERRIDE_FILE (default /usr/local/etc/netmon/services): same format as /etc/services, entries take
+# precedence over the system ones
+DEFAULT_SERVICES_OVERRIDE_FILE = '/usr/local/etc/netmon/services'
+
+PORT_COUNT = 65536
+
+
+def parse_services(filename: str) -> list[tuple[str, int, str]]:
+    """
+    Parse a services(5) file
+    :param filename: file to parse
+    :return: list of (name, port, protocol name)
+    """
+    entries = []
+    if not os.path.isfile(filename):
+        return entries
+    with open(filename) as f:
+        for line in f:
+            fields = line.split('#', 1)[0].split()
+            if len(fields) < 2 or '/' not in fields[1]:
+                continue
+            port, protocol = fields[1].split('/', 1)
+            if not port.isdigit() or int(port) >= PORT_COUNT:
+                continue
+            entries.append((fields[0], int(port), protocol.lower()))
+    return entries
+
+
+class ServiceTable:
+    """
+    Service names per protocol in arrays indexed by port, loaded once from services files
+    (replaces a socket.getservbyport call, which reads /etc/services, per lookup)
+    """
+
+    def __init__(self, filenames: list[str]):
+        self.tables: dict[Protocol, list] = {}
+        for filename in filenames:
+            seen = set()
+            for name, port, protocol_name in parse_services(filename):
+                try:
+                    protocol = Protocol[protocol_name]
+                except KeyError:
+                    continue
+                if protocol not in self.tables:
+                    self.tables[protocol] = [None] * PORT_COUNT
+                table = self.tables[protocol]
+                # within one file the first entry wins (like getservbyport), later files override earlier ones
+                if table[port] is None or (protocol, port) not in seen:
+                    table[port] = name
+                    seen.add((protocol, port))
+        self._arrays = {}
+
+    def get(self, port: int, protocol: Protocol):
+        """
+        :return: service name or None when unknown
+        """
+        table = self.tables.get(protocol)
+        if table is None or not 0 <= port < PORT_COUNT:
+            return None
+        return table[port]
+
+    def get_app_protocol(self, src_port: int, dst_port: int, protocol: Protocol) -> str:
+        """
+        Get the application protocol of a flow, by destination port or, for server to client flows, by the
+        well-known source port
+        :param src_port: source port number
+        :param dst_port: destination port number
+        :param protocol: Protocol
+        :return: str
+        """
+        name = self.get(dst_port, protocol)
+        if name is None:
+            name = self.get(src_port, protocol)
+        if name is None:
+            return f"{dst_port} (Unknown)"
+        return name
+
+    def lookup_array(self, ports, protocol: Protocol):
+        """
+        Vectorized lookup of service names
+        :param ports: numpy array of port numbers
+        :param protocol: Protocol of all ports
+        :return: numpy object array, None where unknown
+        """
+        import numpy as np
+        if protocol not in self._arrays:
+            self._arrays[protocol] = np.array(self.tables.get(protocol, [None] * PORT_COUNT), dtype=object)
+        return self._arrays[protocol][np.asarray(ports) % PORT_COUNT]
+
+
+# loaded on first use (see get_services)
+_services = None
+_services_lock = threading.Lock()
+
+
+def get_services() -> ServiceTable:
+    """
+    :return: ServiceTable of SERVICES_FILE and SERVICES_OVERRIDE_FILE, loaded on the first call
+    """
+    global _services
+    if _services is None:
+        with _services_lock:
+            if _services is None:
+                _services = ServiceTable([SERVICES_FILE,
+                                          getenv("SERVICES_OVERRIDE_FILE", DEFAULT_SERVICES_OVERRIDE_FILE)])
+    return _services
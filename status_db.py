@@ -1,26 +1,61 @@
+import heapq
 import json
+import os
+import pickle
+import sys
+import threading
 import time
 
+import flow2conn
 from connection import Connection
 from flow2conn import get_last_connections
-from dotenv import load_dotenv
-import os
+from geo_ip_data import geoip_cache
+from metrics import (connection_merges, connections_new, connections_tracked, enrich_backlog, registry,
+                     stage_duration)
+from reverse_dns import get_reverse_dns
+from utils import getenv
 
-load_dotenv()
+SNAPSHOT_MAGIC = b'NMSNAP'
+SNAPSHOT_VERSION = 2
 
 
 class StatusDB:
-    # store active connections key: id: int, value: Connection
-    active_connections: dict[int, Connection] = {}
-    idle_connections: dict[int, Connection] = {}
-    closed_connections: dict[int, Connection] = {}
+    # store active connections key: id: bytes (see connection.connection_key), value: Connection
+    active_connections: dict[bytes, Connection] = {}
+    idle_connections: dict[bytes, Connection] = {}
+    closed_connections: dict[bytes, Connection] = {}
+
+    REFRESH_INTERVAL = int(getenv("REFRESH_INTERVAL"))
+    CONNECTION_TIMEOUT_DURATION = int(getenv("CONNECTION_TIMEOUT_DURATION"))
+    MAX_ACTIVE_CONNECTIONS = int(getenv("MAX_ACTIVE_CONNECTIONS"))
+    ENRICH_BATCH_LIMIT = int(getenv("ENRICH_BATCH_LIMIT"))
+    # seconds per refresh that may be spent enriching queued connections
+    ENRICH_TIME_BUDGET = float(getenv("ENRICH_TIME_BUDGET", "5"))
+    # when set (octets/packets) only the top MAX_ACTIVE_CONNECTIONS connections per refresh are tracked,
+    # the rest is reported in an "other" bucket. Flow by flow and with FLOW_WORKERS a heavy-hitter summary
+    # bounds memory by MAX_ACTIVE_CONNECTIONS, the columnar (numpy) aggregation ranks exactly over all flows
+    TOP_CONNECTIONS_BY = getenv("TOP_CONNECTIONS_BY")
+    # connection tables, enrichment caches and log position are written to SNAPSHOT_FILE every
+    # SNAPSHOT_INTERVAL seconds (0 to disable) and restored on start
+    SNAPSHOT_FILE = getenv("SNAPSHOT_FILE", "/var/db/netmon_status.snapshot")
+    SNAPSHOT_INTERVAL = int(getenv("SNAPSHOT_INTERVAL", "0"))
+
+    # heap of (last_seen, id) of idle connections, may hold stale entries of connections that became active again
+    idle_expiry: list[tuple[float, bytes]] = []
+
+    # connections waiting for enrichment, heap of (-octets, id) so the biggest connections go first
+    enrich_backlog: list[tuple[int, bytes]] = []
+    # id -> time queued, in queue order (so the first entry is the oldest)
+    enrich_queued_at: dict[bytes, float] = {}
 
-    REFRESH_INTERVAL = int(os.getenv("REFRESH_INTERVAL"))
-    CONNECTION_TIMEOUT_DURATION = int(os.getenv("CONNECTION_TIMEOUT_DURATION"))
-    MAX_ACTIVE_CONNECTIONS = int(os.getenv("MAX_ACTIVE_CONNECTIONS"))
-    ENRICH_BATCH_LIMIT = int(os.getenv("ENRICH_BATCH_LIMIT"))
+    # guards the connection tables when the refresh stages run on separate threads (see pipeline)
+    lock = threading.RLock()
+
+    # flowd log position (inode, offset) up to which the flows are merged into the tables
+    log_position: tuple[int, int] = None
 
     _last_update = 0
+    _last_snapshot = 0
 
     def __init__(self):
         pass
@@ -30,53 +65,289 @@ class StatusDB:
         if time.time() - cls._last_update < cls.REFRESH_INTERVAL * 0.9:
             raise ValueError("Connections were updated too recently. Please wait a for a while before updating again.")
         cls._last_update = time.time()
-        new_connections = get_last_connections(cls.REFRESH_INTERVAL, cls.MAX_ACTIVE_CONNECTIONS)
-        active_connections = {}
-        enrich_count = 0
+        with stage_duration.time('refresh'):
+            cls.apply_connections(*cls.fetch_connections())
+            cls.drain_enrich_backlog()
+
+    @classmethod
+    def fetch_connections(cls) -> tuple[list[Connection], tuple[int, int]]:
+        """
+        Get the connections seen in the flowd log since the last refresh
+        :return: list of connections and the log position (inode, offset) after them
+        """
+        if cls.TOP_CONNECTIONS_BY:
+            connections = get_last_connections(cls.REFRESH_INTERVAL, cls.MAX_ACTIVE_CONNECTIONS,
+                                               cls.TOP_CONNECTIONS_BY)
+        else:
+            connections = get_last_connections(cls.REFRESH_INTERVAL)
+        return connections, (flow2conn.flow_tail.inode, flow2conn.flow_tail.offset)
+
+    @classmethod
+    def apply_connections(cls, new_connections: list[Connection], log_position: tuple[int, int] = None):
+        """
+        Merge the connections of one refresh into the connection tables, queue new ones for enrichment,
+        close timed out idle connections and demote active connections that weren't seen
+        :param new_connections: connections seen since the last refresh
+        :param log_position: log position after new_connections (see fetch_connections)
+        """
+        with cls.lock, stage_duration.time('update'):
+            cls._apply_connections(new_connections)
+            if log_position is not None:
+                cls.log_position = log_position
+            if cls.SNAPSHOT_INTERVAL > 0 and time.time() - cls._last_snapshot >= cls.SNAPSHOT_INTERVAL:
+                try:
+                    cls.save_snapshot()
+                except OSError as e:
+                    print(f"------ Error: snapshot failed: {e}", file=sys.stderr)
+
+    @classmethod
+    def _apply_connections(cls, new_connections: list[Connection]):
+        now = time.time()
+        seen = set()
+        merges = 0
         # update active connections
         for conn in new_connections:
-            if conn.get_id() in cls.active_connections:
-                cls.active_connections[conn.get_id()].merge(conn)
-                active_connections[conn.get_id()] = cls.active_connections.pop(conn.get_id())
-            elif conn.get_id() in cls.idle_connections:
-                cls.idle_connections[conn.get_id()].merge(conn)
-                active_connections[conn.get_id()] = cls.idle_connections.pop(conn.get_id())
+            conn_id = conn.get_id()
+            seen.add(conn_id)
+            if conn_id in cls.active_connections:
+                cls.active_connections[conn_id].merge(conn)
+                merges += 1
+            elif conn_id in cls.idle_connections:
+                cls.idle_connections[conn_id].merge(conn)
+                cls.active_connections[conn_id] = cls.idle_connections.pop(conn_id)
+                merges += 1
+            elif flow2conn.BIFLOW and cls._merge_reply(conn, seen):
+                merges += 1
             else:
-                if enrich_count < cls.ENRICH_BATCH_LIMIT:
-                    enrich_count += 1
-                    conn.enrich()
-                active_connections[conn.get_id()] = conn
+                cls.enrich_queued_at[conn_id] = now
+                heapq.heappush(cls.enrich_backlog, (-conn.octets, conn_id))
+                cls.active_connections[conn_id] = conn
+        connection_merges.inc(merges)
+        connections_new.inc(len(new_connections) - merges)
+
+        reverse_dns = get_reverse_dns()
+        if reverse_dns is not None:
+            # give up on reverse lookups that are taking too long
+            reverse_dns.expire()
+
+        # close idle connections that timed out
+        cls.expire_idle_connections(now)
+
+        # active connections that weren't seen in this refresh become idle
+        for conn_id in [conn_id for conn_id in cls.active_connections if conn_id not in seen]:
+            conn = cls.active_connections.pop(conn_id)
+            conn.dirty = True
+            cls.idle_connections[conn_id] = conn
+            heapq.heappush(cls.idle_expiry, (conn.last_seen, conn_id))
+
+    @classmethod
+    def _merge_reply(cls, conn: Connection, seen: set) -> bool:
+        """
+        Merge a connection into the tracked conversation in the opposite direction, if there is one
+        (the ports didn't tell the client and server apart, the side seen first is the client)
+        :return: True when merged
+        """
+        reverse_id = conn.reverse_id()
+        if reverse_id in cls.active_connections:
+            cls.active_connections[reverse_id].merge_reply(conn)
+        elif reverse_id in cls.idle_connections:
+            cls.idle_connections[reverse_id].merge_reply(conn)
+            cls.active_connections[reverse_id] = cls.idle_connections.pop(reverse_id)
+        else:
+            return False
+        seen.add(reverse_id)
+        return True
+
+    @classmethod
+    def expire_idle_connections(cls, now: float):
+        """
+        Move idle connections that weren't seen for CONNECTION_TIMEOUT_DURATION to the closed connections.
+        Only the expired entries of the expiry heap are visited.
+        :param now: current time
+        """
+        deadline = now - cls.CONNECTION_TIMEOUT_DURATION
+        while cls.idle_expiry and cls.idle_expiry[0][0] < deadline:
+            last_seen, conn_id = heapq.heappop(cls.idle_expiry)
+            conn = cls.idle_connections.get(conn_id)
+            if conn is None or conn.last_seen != last_seen:
+                # stale entry, the connection became active again in the meantime
+                continue
+            conn.finished = True
+            cls.closed_connections[conn_id] = cls.idle_connections.pop(conn_id)
+            cls.enrich_queued_at.pop(conn_id, None)
+
+        # drop stale entries when they start to dominate the heap
+        if len(cls.idle_expiry) > 2 * len(cls.idle_connections) + 1024:
+            cls.idle_expiry = [(conn.last_seen, conn_id) for conn_id, conn in cls.idle_connections.items()]
+            heapq.heapify(cls.idle_expiry)
+        # same for the enrichment queue, closed connections leave their entries behind
+        if len(cls.enrich_backlog) > 2 * len(cls.enrich_queued_at) + 1024:
+            cls._rebuild_enrich_backlog()
+
+    @classmethod
+    def _rebuild_enrich_backlog(cls):
+        backlog = []
+        queued_at = {}
+        for conn_id, queued in cls.enrich_queued_at.items():
+            conn = cls.active_connections.get(conn_id) or cls.idle_connections.get(conn_id)
+            if conn is not None and not conn.is_enriched:
+                backlog.append((-conn.octets, conn_id))
+                queued_at[conn_id] = queued
+        heapq.heapify(backlog)
+        cls.enrich_backlog = backlog
+        cls.enrich_queued_at = queued_at
+
+    @classmethod
+    def drain_enrich_backlog(cls):
+        """
+        Enrich queued connections, biggest first, until ENRICH_BATCH_LIMIT connections are enriched or
+        ENRICH_TIME_BUDGET is spent. The remainder stays queued for the next refresh.
+        :return: number of enriched connections
+        """
+        start = time.perf_counter()
+        deadline = time.time() + cls.ENRICH_TIME_BUDGET
+        enrich_count = 0
+        while cls.enrich_backlog and enrich_count < cls.ENRICH_BATCH_LIMIT and time.time() < deadline:
+            with cls.lock:
+                if not cls.enrich_backlog:
+                    break
+                _, conn_id = heapq.heappop(cls.enrich_backlog)
+                cls.enrich_queued_at.pop(conn_id, None)
+                conn = cls.active_connections.get(conn_id) or cls.idle_connections.get(conn_id)
+                if conn is None or conn.is_enriched:
+                    # closed in the meantime
+                    continue
+                conn.enrich()
+            enrich_count += 1
+        stage_duration.observe(time.perf_counter() - start, 'enrich')
+        return enrich_count
 
-        # update idle connections
-        for conn in list(cls.idle_connections.values()):
-            if time.time() - conn.last_seen > cls.CONNECTION_TIMEOUT_DURATION:
-                conn.finished = True
-                cls.closed_connections[conn.get_id()] = cls.idle_connections.pop(conn.get_id())
+    @classmethod
+    def save_snapshot(cls, filename: str = None):
+        """
+        Atomically write the connection tables, the enrichment queue, the GeoIP and reverse DNS caches and
+        the log position to a binary snapshot (pickle, written to a temporary file which replaces the old
+        snapshot)
+        :param filename: snapshot file (default SNAPSHOT_FILE)
+        """
+        filename = filename or cls.SNAPSHOT_FILE
+        reverse_dns = get_reverse_dns()
+        with cls.lock:
+            state = {
+                'time': time.time(),
+                'active_connections': cls.active_connections,
+                'idle_connections': cls.idle_connections,
+                'closed_connections': cls.closed_connections,
+                'idle_expiry': cls.idle_expiry,
+                'enrich_backlog': cls.enrich_backlog,
+                'enrich_queued_at': cls.enrich_queued_at,
+                'log_position': cls.log_position,
+                'geoip_cache': geoip_cache.dump(),
+                'reverse_dns_cache': reverse_dns.dump_cache() if reverse_dns is not None else [],
+            }
+            tmp_file = filename + '.tmp'
+            with open(tmp_file, 'wb') as f:
+                f.write(SNAPSHOT_MAGIC + bytes([SNAPSHOT_VERSION]))
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, filename)
+            cls._last_snapshot = time.time()
+
+    @classmethod
+    def load_snapshot(cls, filename: str = None) -> bool:
+        """
+        Restore the state written by save_snapshot. The flowd log is read again from the snapshot's log
+        position, so flows merged after the snapshot was taken are not lost: once there is a log position every
+        unread record is aggregated, however long the restart took (see flow2conn.read_connections).
+        :param filename: snapshot file (default SNAPSHOT_FILE)
+        :return: True when a snapshot was restored
+        """
+        filename = filename or cls.SNAPSHOT_FILE
+        if not os.path.isfile(filename):
+            return False
+        try:
+            with open(filename, 'rb') as f:
+                if f.read(len(SNAPSHOT_MAGIC) + 1) != SNAPSHOT_MAGIC + bytes([SNAPSHOT_VERSION]):
+                    print(f"------ Error: {filename} is not a supported snapshot", file=sys.stderr)
+                    return False
+                state = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError) as e:
+            print(f"------ Error: snapshot could not be loaded: {e}", file=sys.stderr)
+            return False
 
-        # all remaining connections are idle
-        cls.idle_connections.update(cls.active_connections)
-        cls.active_connections = active_connections
+        with cls.lock:
+            cls.active_connections = state['active_connections']
+            cls.idle_connections = state['idle_connections']
+            cls.closed_connections = state['closed_connections']
+            cls.idle_expiry = state['idle_expiry']
+            cls.enrich_backlog = state['enrich_backlog']
+            cls.enrich_queued_at = state['enrich_queued_at']
+            cls.log_position = state['log_position']
+            geoip_cache.load(state['geoip_cache'])
+            reverse_dns = get_reverse_dns()
+            if reverse_dns is not None:
+                reverse_dns.load_cache(state['reverse_dns_cache'])
+            if cls.log_position is not None:
+                flow_tail = flow2conn.flow_tail
+                flow_tail.inode, flow_tail.offset = cls.log_position
+                flow_tail.save_checkpoint()
+            cls._last_snapshot = time.time()
+        return True
 
     @classmethod
     def get_db_status(cls):
+        with cls.lock:
+            return cls._get_db_status()
+
+    @classmethod
+    def _get_db_status(cls):
         return {
             "active_connections": len(cls.active_connections),
             "idle_connections": len(cls.idle_connections),
-            "closed_connections": len(cls.closed_connections)
+            "closed_connections": len(cls.closed_connections),
+            "enrich_backlog": len(cls.enrich_queued_at),
+            "enrich_backlog_age": time.time() - next(iter(cls.enrich_queued_at.values()))
+            if cls.enrich_queued_at else 0,
         }
 
+    @staticmethod
+    def _as_dicts(connections: dict[bytes, Connection], changed_only: bool) -> list[dict]:
+        result = []
+        for conn in connections.values():
+            if conn.dirty or not changed_only:
+                # cleared first: a domain set by a resolver thread while serializing marks it dirty again
+                conn.dirty = False
+                result.append(conn.as_dict())
+        return result
+
     @classmethod
-    def get_connections(cls):
-        result = {
-            "active_connections": [conn.as_dict() for conn in cls.active_connections.values()],
-            "idle_connections": [conn.as_dict() for conn in cls.idle_connections.values()],
-            "closed_connections": [conn.as_dict() for conn in cls.closed_connections.values()]
-        }
+    def get_connections(cls, changed_only: bool = False):
+        """
+        Get the connections per state, closed connections are only returned once
+        :param changed_only: only return active and idle connections that are new or changed (merged, enriched,
+                             became idle) since they were last returned
+        :return: dict
+        """
+        with cls.lock:
+            result = {
+                "active_connections": cls._as_dicts(cls.active_connections, changed_only),
+                "idle_connections": cls._as_dicts(cls.idle_connections, changed_only),
+                "closed_connections": [conn.as_dict() for conn in cls.closed_connections.values()]
+            }
 
-        cls.closed_connections.clear()
+            cls.closed_connections.clear()
         return result
 
 
+def _collect_status():
+    status = StatusDB.get_db_status()
+    for state in ('active', 'idle', 'closed'):
+        connections_tracked.set(status[f'{state}_connections'], state)
+    enrich_backlog.set(status['enrich_backlog'])
+
+
+registry.add_collector(_collect_status)
+
+
 if __name__ == '__main__':
     db = StatusDB()
     for _ in range(100):
@@ -1,7 +1,14 @@
+import atexit
 import json
-import logging.handlers
 import os
+import queue
 import socket
+import threading
+import time
+
+from utils import getenv
+from metrics import registry, syslog_dropped, syslog_messages, syslog_queue_depth
+
 
 hostname = socket.gethostname()
 program_name = 'netmon'
@@ -9,25 +16,231 @@ program_name = 'netmon'
 # Set the process id
 process_id = os.getpid()
 
-# Configure logging
-logger = logging.getLogger('my_logger')
-logger.setLevel(logging.INFO)
+# settings (read by get_sender, the SYSLOG_* variables override the defaults below)
+# file, udp or tcp
+SYSLOG_PROTOCOL = "file"
+SYSLOG_FILE = "/var/ossec/logs/opnsense_syslog.log"
+SYSLOG_HOST = "127.0.0.1"
+SYSLOG_PORT = 514
+# rfc3164 or rfc5424 (the file output keeps the RFC 3164 layout without priority)
+SYSLOG_FORMAT = "rfc3164"
+SYSLOG_QUEUE_SIZE = 100000
+SYSLOG_BATCH_SIZE = 1000
+# drop: discard messages when the queue is full, block: wait for the writer
+SYSLOG_OVERFLOW = "block"
+# longer UDP messages are truncated (65507: the largest IPv4 UDP payload)
+SYSLOG_UDP_MAX_SIZE = 65507
+
+# facility user, severity informational
+SYSLOG_PRIORITY = 1 * 8 + 6
+
+
+def format_message(timestamp: float, message: str, syslog_format: str, with_priority: bool = True) -> str:
+    """
+    Format a syslog line
+    :param timestamp: message time (epoch)
+    :param message: message body
+    :param syslog_format: rfc3164 or rfc5424
+    :param with_priority: prefix the <PRI> part (not used for file output)
+    :return: str
+    """
+    priority = f"<{SYSLOG_PRIORITY}>" if with_priority else ""
+    if syslog_format == "rfc5424":
+        stamp = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(timestamp)) + \
+            f".{int(timestamp % 1 * 1000000):06d}" + time.strftime('%z', time.localtime(timestamp))
+        stamp = stamp[:-2] + ':' + stamp[-2:]
+        return f"{priority}1 {stamp} {hostname} {program_name} {process_id} - - {message}"
+    stamp = time.strftime('%b %d %H:%M:%S', time.localtime(timestamp))
+    return f"{priority}{stamp} {hostname} {program_name}[{process_id}]: {message}"
+
+
+class FileSink:
+    def __init__(self, filename: str, syslog_format: str):
+        self.syslog_format = syslog_format
+        self._file = open(filename, 'a')
+
+    def write(self, batch: list[tuple[float, str]]) -> int:
+        self._file.write(''.join(format_message(t, m, self.syslog_format, False) + '\n' for t, m in batch))
+        self._file.flush()
+        return len(batch)
+
+
+class UDPSink:
+    """
+    Syslog over UDP, one datagram per message. Messages longer than max_size are truncated (RFC 5426 allows
+    it), a message that can't be sent is dropped without affecting the rest of the batch.
+    """
+
+    def __init__(self, host: str, port: int, syslog_format: str, max_size: int = SYSLOG_UDP_MAX_SIZE):
+        self.syslog_format = syslog_format
+        self.address = (host, port)
+        self.max_size = max_size
+        self.truncated = 0
+        self._socket = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_DGRAM)
+
+    def write(self, batch: list[tuple[float, str]]) -> int:
+        sent = 0
+        for t, m in batch:
+            data = format_message(t, m, self.syslog_format).encode()
+            if len(data) > self.max_size:
+                data = data[:self.max_size]
+                self.truncated += 1
+            try:
+                self._socket.sendto(data, self.address)
+            except OSError:
+                continue
+            sent += 1
+        return sent
+
+
+class TCPSink:
+    """
+    Syslog over TCP with newline framing (RFC 6587 non-transparent framing), reconnects on the next batch
+    after a failure.
+    """
+
+    def __init__(self, host: str, port: int, syslog_format: str):
+        self.syslog_format = syslog_format
+        self.address = (host, port)
+        self._socket = None
+
+    def write(self, batch: list[tuple[float, str]]) -> int:
+        if self._socket is None:
+            self._socket = socket.create_connection(self.address, timeout=10)
+        data = ''.join(format_message(t, m, self.syslog_format) + '\n' for t, m in batch).encode()
+        try:
+            self._socket.sendall(data)
+        except OSError:
+            self._socket.close()
+            self._socket = None
+            raise
+        return len(batch)
+
+
+class SyslogSender:
+    """
+    Bounded message queue drained by a writer thread, which serializes and writes messages in batches so the
+    caller never waits on JSON encoding or I/O (unless the queue is full and the overflow policy is block).
+    """
+
+    def __init__(self, sink, queue_size: int = SYSLOG_QUEUE_SIZE, batch_size: int = SYSLOG_BATCH_SIZE,
+                 overflow: str = SYSLOG_OVERFLOW):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.overflow = overflow
+        self._queue = queue.Queue(maxsize=queue_size)
+        # the counters are updated by the callers (enqueued, dropped on overflow) and the writer thread
+        self._stats_lock = threading.Lock()
+        self.enqueued = 0
+        self.sent = 0
+        self.dropped = 0
+        self.errors = 0
+        self.batches = 0
+        self._thread = threading.Thread(target=self._run, name='syslog-writer', daemon=True)
+        self._thread.start()
+
+    def send(self, content: dict):
+        item = (time.time(), content)
+        if self.overflow == "drop":
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                with self._stats_lock:
+                    self.dropped += 1
+                return
+        else:
+            self._queue.put(item)
+        with self._stats_lock:
+            self.enqueued += 1
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            while len(items) < self.batch_size:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            batch = [(timestamp, json.dumps(content)) for timestamp, content in items]
+            errors = 0
+            try:
+                # sinks return the number of messages written, the rest of the batch is dropped
+                sent = self.sink.write(batch)
+            except Exception:
+                errors = 1
+                sent = 0
+            with self._stats_lock:
+                self.batches += 1 - errors
+                self.errors += errors
+                self.sent += sent
+                self.dropped += len(batch) - sent
+            for _ in items:
+                self._queue.task_done()
+
+    def flush(self):
+        """
+        Wait until every queued message was written
+        """
+        self._queue.join()
 
-# Create a file handler
-log_file = '/var/ossec/logs/opnsense_syslog.log'
-handler = logging.FileHandler(log_file)
+    def get_stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                'queue_depth': self._queue.qsize(),
+                'enqueued': self.enqueued,
+                'sent': self.sent,
+                'dropped': self.dropped,
+                'errors': self.errors,
+                'batches': self.batches,
+                'truncated': getattr(self.sink, 'truncated', 0),
+            }
 
-# Customize the syslog message format to RFC 3164
-formatter = logging.Formatter(
-    f'%(asctime)s {hostname} {program_name}[{process_id}]: %(message)s', datefmt='%b %d %H:%M:%S', style='%'
-)
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+
+def create_sink():
+    protocol = getenv("SYSLOG_PROTOCOL", SYSLOG_PROTOCOL)
+    syslog_format = getenv("SYSLOG_FORMAT", SYSLOG_FORMAT)
+    host = getenv("SYSLOG_HOST", SYSLOG_HOST)
+    port = int(getenv("SYSLOG_PORT", str(SYSLOG_PORT)))
+    if protocol == "udp":
+        return UDPSink(host, port, syslog_format, int(getenv("SYSLOG_UDP_MAX_SIZE", str(SYSLOG_UDP_MAX_SIZE))))
+    if protocol == "tcp":
+        return TCPSink(host, port, syslog_format)
+    return FileSink(getenv("SYSLOG_FILE", SYSLOG_FILE), syslog_format)
+
+
+# created on the first message, so importing this module doesn't open the sink or start the writer thread
+sender: SyslogSender = None
+_sender_lock = threading.Lock()
+
+
+def get_sender() -> SyslogSender:
+    global sender
+    if sender is None:
+        with _sender_lock:
+            if sender is None:
+                new_sender = SyslogSender(create_sink(),
+                                          queue_size=int(getenv("SYSLOG_QUEUE_SIZE", str(SYSLOG_QUEUE_SIZE))),
+                                          batch_size=int(getenv("SYSLOG_BATCH_SIZE", str(SYSLOG_BATCH_SIZE))),
+                                          overflow=getenv("SYSLOG_OVERFLOW", SYSLOG_OVERFLOW))
+                atexit.register(new_sender.flush)
+                sender = new_sender
+    return sender
+
+
+def _collect_sender_stats():
+    if sender is None:
+        return
+    stats = sender.get_stats()
+    syslog_queue_depth.set(stats['queue_depth'])
+    syslog_dropped.set(stats['dropped'])
+
+
+registry.add_collector(_collect_sender_stats)
 
 
 def send_syslog_json_message(content: dict):
     """
-    Send a syslog message in JSON format
+    Send a syslog message in JSON format (queued, written by the syslog writer thread)
     :param content: dict
     """
     message = {
@@ -38,11 +251,13 @@ def send_syslog_json_message(content: dict):
 
     # message.update(content)
 
-    logger.info(json.dumps(message))
+    get_sender().send(message)
+    syslog_messages.inc()
 
 
 if __name__ == '__main__':
     send_syslog_json_message({
         "message": "This is a test message",
     })
-
+    get_sender().flush()
+    print(get_sender().get_stats())
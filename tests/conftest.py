@@ -0,0 +1,15 @@
+import pytest
+
+from status_db import StatusDB
+
+
+@pytest.fixture
+def empty_db():
+    tables = ('active_connections', 'idle_connections', 'closed_connections', 'idle_expiry', 'enrich_backlog',
+              'enrich_queued_at')
+    saved = {name: getattr(StatusDB, name) for name in tables}
+    for name in tables:
+        setattr(StatusDB, name, type(saved[name])())
+    yield StatusDB
+    for name, value in saved.items():
+        setattr(StatusDB, name, value)
@@ -0,0 +1,17 @@
+from connection import Connection, KEY_HEADER, connection_key, pack_ip
+from network_enums import Protocol
+
+
+def test_connection_key_every_protocol():
+    keys = set()
+    for protocol in Protocol:
+        key = connection_key('em0', 'em1', pack_ip('10.0.0.1'), pack_ip('2001:db8::1'), 1234, 443, protocol)
+        assert KEY_HEADER.unpack_from(key)[2] == protocol.value & 0xff
+        keys.add(key)
+    assert len(keys) == len(Protocol)
+
+
+def test_apply_connections_high_protocol_number(empty_db):
+    connection = Connection(0, 1, 'em0', 'em1', 'fe80::1', 'fe80::2', 0, 0, Protocol.ipv6_mobility.value, 100, 1)
+    empty_db.apply_connections([connection])
+    assert empty_db.active_connections == {connection.get_id(): connection}
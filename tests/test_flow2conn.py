@@ -0,0 +1,122 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import flow2conn
+from flow_shards import ShardedAggregator
+from flow_tail import FlowLogTail
+from flowd_decoder import FLOW_OCTETS, FLOW_RECV_SEC
+from flowd_generator import FlowGenerator
+
+
+@pytest.fixture(params=['flows', 'columns', 'sharded'])
+def aggregation(request, monkeypatch):
+    # every aggregation path of read_connections
+    if request.param == 'flows':
+        monkeypatch.setattr(flow2conn, 'aggregate_connections', None)
+    if request.param == 'sharded':
+        with ThreadPoolExecutor(2) as executor:
+            monkeypatch.setattr(flow2conn, 'sharded_aggregator', ShardedAggregator(2, executor))
+            yield request.param
+    else:
+        monkeypatch.setattr(flow2conn, 'sharded_aggregator', None)
+        yield request.param
+
+
+def write_flows(log_file: str, count: int, age: tuple[int, int], seed: int = 1):
+    now = time.time()
+    FlowGenerator(200, seed=seed).write(log_file, count, now - age[1], now - age[0])
+
+
+def total_octets(log_file: str, since: float = 0) -> int:
+    return sum(flow[FLOW_OCTETS] for flow in FlowLogTail(log_file).read_new() if flow[FLOW_RECV_SEC] >= since)
+
+
+def use_tail(monkeypatch, tmp_path, log_file: str) -> FlowLogTail:
+    flow_tail = FlowLogTail(log_file, str(tmp_path / 'checkpoint.json'))
+    monkeypatch.setattr(flow2conn, 'flow_tail', flow_tail)
+    return flow_tail
+
+
+@pytest.mark.parametrize('max_hits', [None, 10])
+def test_unread_flows_older_than_window_are_kept(tmp_path, monkeypatch, aggregation, max_hits):
+    log_file = str(tmp_path / 'flowd.log')
+    open(log_file, 'wb').close()
+    flow_tail = use_tail(monkeypatch, tmp_path, log_file)
+    # the log position of a previous refresh, then the next refresh comes late
+    assert flow2conn.read_connections(60, max_hits) == []
+    write_flows(log_file, 1000, (65, 70))
+
+    connections = flow2conn.read_connections(60, max_hits)
+    assert sum(c.octets for c in connections) == total_octets(log_file)
+    assert flow_tail.offset == os.path.getsize(log_file)
+
+
+def test_first_read_without_checkpoint_skips_old_flows(tmp_path, monkeypatch, aggregation):
+    log_file = str(tmp_path / 'flowd.log')
+    write_flows(log_file, 1000, (65, 70))
+    write_flows(log_file, 100, (0, 5), seed=2)
+    use_tail(monkeypatch, tmp_path, log_file)
+
+    start = int(time.time()) - 60
+    connections = flow2conn.read_connections(60)
+    assert 0 < sum(c.octets for c in connections) == total_octets(log_file, start) < total_octets(log_file)
+    assert flow2conn.read_connections(60) == []
+
+
+def test_rotated_remainder_is_read_after_restart(tmp_path, monkeypatch, aggregation):
+    log_file = str(tmp_path / 'flowd.log')
+    write_flows(log_file, 100, (0, 5))
+    use_tail(monkeypatch, tmp_path, log_file)
+    flow2conn.read_connections(60)
+    read_octets = total_octets(log_file)
+    # appended before the rotation and not read yet, old by the time the restarted daemon gets to them
+    write_flows(log_file, 500, (65, 70), seed=2)
+    os.rename(log_file, log_file + '.000001')
+    write_flows(log_file, 300, (0, 5), seed=3)
+
+    restarted = use_tail(monkeypatch, tmp_path, log_file)
+    connections = flow2conn.read_connections(60)
+    assert sum(c.octets for c in connections) == \
+        total_octets(log_file + '.000001') - read_octets + total_octets(log_file)
+    assert restarted.offset == os.path.getsize(log_file)
+
+
+def test_failed_refresh_keeps_log_position(tmp_path, monkeypatch):
+    log_file = str(tmp_path / 'flowd.log')
+    open(log_file, 'wb').close()
+    flow_tail = use_tail(monkeypatch, tmp_path, log_file)
+    flow2conn.get_last_connections(60)
+    write_flows(log_file, 100, (0, 5))
+
+    def failing_aggregate(*args, **kwargs):
+        raise MemoryError()
+
+    with monkeypatch.context() as patch:
+        patch.setattr(flow2conn, 'sharded_aggregator', None)
+        patch.setattr(flow2conn, 'aggregate_connections', failing_aggregate)
+        with pytest.raises(MemoryError):
+            flow2conn.get_last_connections(60)
+    assert flow_tail.offset == 0
+    # the checkpoint was moved back as well, a restart reads the segment again
+    assert use_tail(monkeypatch, tmp_path, log_file).offset == 0
+    connections = flow2conn.get_last_connections(60)
+    assert sum(c.octets for c in connections) == total_octets(log_file)
+
+
+def test_debug_main_leaves_daemon_checkpoint_alone(tmp_path, monkeypatch):
+    log_file = str(tmp_path / 'flowd.log')
+    write_flows(log_file, 100, (0, 5))
+    checkpoint_file = tmp_path / 'checkpoint.json'
+    daemon_tail = use_tail(monkeypatch, tmp_path, log_file)
+    daemon_tail.save_checkpoint()
+    checkpoint = checkpoint_file.read_text()
+    monkeypatch.setattr(flow2conn, 'FLOWD_LOG_FILE', log_file)
+    monkeypatch.setattr(flow2conn.Connection, 'enrich', lambda self: None)
+
+    flow2conn.main()
+    assert flow2conn.flow_tail is not daemon_tail
+    assert checkpoint_file.read_text() == checkpoint
+    assert FlowLogTail(log_file, str(checkpoint_file)).offset == 0
@@ -0,0 +1,55 @@
+from ipaddress import ip_address
+
+import pytest
+
+from flow_tail import FlowLogTail
+from flowd_decoder import FlowdDecoder, map_file
+from flowd_generator import FIELD_INDEX, FlowGenerator
+
+pytest.importorskip('numpy')
+from flow_columns import decode_columns  # noqa: E402
+
+
+def address(family: int, hi: int, lo: int) -> str:
+    return str(ip_address(int(lo) if family == 4 else (int(hi) << 64) | int(lo)))
+
+
+def test_decode_columns_mixed_layouts(tmp_path):
+    log_file = str(tmp_path / 'flowd.log')
+    # IPv4 and IPv6 conversations, some without flow times or interfaces: six field masks interleaved in the log
+    generator = FlowGenerator(500, ipv6_ratio=0.4, seed=1)
+    for key in generator.keys[::3]:
+        key.data_fields &= ~(1 << FIELD_INDEX['flow_times'])
+    for key in generator.keys[1::3]:
+        key.data_fields &= ~(1 << FIELD_INDEX['if_indices'] | 1 << FIELD_INDEX['as_info'])
+    size = generator.write(log_file, 5000, 1_700_000_000, 1_700_000_600)
+    # a record still being written
+    with open(log_file, 'ab') as f:
+        f.write(next(generator.records(1, 0, 1))[:20])
+
+    expected = list(FlowLogTail(log_file).read_new())
+    decoder = FlowdDecoder()
+    mm = map_file(log_file)
+    with memoryview(mm) as mv:
+        batches = list(decode_columns(decoder, mv, 0, len(mv)))
+    # the columns are copies, the log can be unmapped
+    mm.close()
+
+    assert len(batches) == 1
+    columns = batches[0]
+    assert decoder.offset == size
+    flows = [(
+        int(columns['recv_sec'][i]),
+        float(columns['flow_start'][i]),
+        float(columns['flow_end'][i]),
+        decoder.interface_name(int(columns['if_in'][i])),
+        decoder.interface_name(int(columns['if_out'][i])),
+        address(columns['family'][i], columns['src_hi'][i], columns['src_lo'][i]),
+        address(columns['family'][i], columns['dst_hi'][i], columns['dst_lo'][i]),
+        int(columns['src_port'][i]),
+        int(columns['dst_port'][i]),
+        int(columns['protocol'][i]),
+        int(columns['octets'][i]),
+        int(columns['packets'][i]),
+    ) for i in range(len(columns['recv_sec']))]
+    assert flows == expected
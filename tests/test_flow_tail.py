@@ -0,0 +1,82 @@
+import os
+
+from flow_tail import FlowLogTail
+from flowd_decoder import FLOW_RECV_SEC
+from flowd_generator import FlowGenerator
+
+generator = FlowGenerator(50, seed=1)
+
+
+def write_flows(log_file: str, first: int, count: int, append: bool = True) -> int:
+    # one flow per second from first, so a flow is identified by its receive time
+    return generator.write(log_file, count, first, first + count, append)
+
+
+def received(flow_tail: FlowLogTail) -> list[int]:
+    return [flow[FLOW_RECV_SEC] for flow in flow_tail.read_new()]
+
+
+def test_resume_from_checkpoint(tmp_path):
+    log_file, checkpoint_file = str(tmp_path / 'flowd.log'), str(tmp_path / 'checkpoint.json')
+    size = write_flows(log_file, 0, 10)
+    assert received(FlowLogTail(log_file, checkpoint_file)) == list(range(10))
+    write_flows(log_file, 10, 5)
+
+    flow_tail = FlowLogTail(log_file, checkpoint_file)
+    assert (flow_tail.inode, flow_tail.offset) == (os.stat(log_file).st_ino, size)
+    assert received(flow_tail) == list(range(10, 15))
+    assert received(flow_tail) == []
+
+
+def test_partial_record_is_read_once_complete(tmp_path):
+    log_file = str(tmp_path / 'flowd.log')
+    write_flows(log_file, 0, 3)
+    record = b''.join(generator.records(1, 3, 4))
+    with open(log_file, 'ab') as f:
+        f.write(record[:len(record) // 2])
+    flow_tail = FlowLogTail(log_file)
+    assert received(flow_tail) == [0, 1, 2]
+    with open(log_file, 'ab') as f:
+        f.write(record[len(record) // 2:])
+    assert received(flow_tail) == [3]
+
+
+def test_rotation_reads_remainder_of_rotated_log(tmp_path):
+    log_file, checkpoint_file = str(tmp_path / 'flowd.log'), str(tmp_path / 'checkpoint.json')
+    write_flows(log_file, 0, 10)
+    assert received(FlowLogTail(log_file, checkpoint_file)) == list(range(10))
+    # written after the last read, then the log is rotated
+    write_flows(log_file, 10, 5)
+    os.rename(log_file, log_file + '.000001')
+    write_flows(log_file, 15, 5)
+
+    flow_tail = FlowLogTail(log_file, checkpoint_file)
+    assert received(flow_tail) == list(range(10, 20))
+    assert (flow_tail.inode, flow_tail.offset) == (os.stat(log_file).st_ino, os.path.getsize(log_file))
+
+
+def test_rotation_without_rotated_log(tmp_path):
+    log_file = str(tmp_path / 'flowd.log')
+    write_flows(log_file, 0, 10)
+    flow_tail = FlowLogTail(log_file)
+    received(flow_tail)
+    # rotated log already removed, the new log is read from its start
+    os.remove(log_file)
+    write_flows(log_file, 10, 5)
+    assert received(flow_tail) == list(range(10, 15))
+
+
+def test_truncation_starts_over(tmp_path):
+    log_file = str(tmp_path / 'flowd.log')
+    write_flows(log_file, 0, 10)
+    flow_tail = FlowLogTail(log_file)
+    received(flow_tail)
+    write_flows(log_file, 10, 3, append=False)
+    assert os.stat(log_file).st_ino == flow_tail.inode
+    assert received(flow_tail) == [10, 11, 12]
+
+
+def test_missing_log(tmp_path):
+    flow_tail = FlowLogTail(str(tmp_path / 'flowd.log'))
+    assert received(flow_tail) == []
+    assert (flow_tail.inode, flow_tail.offset) == (None, 0)
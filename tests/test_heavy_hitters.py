@@ -0,0 +1,61 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import flow_shards
+from flow_shards import ShardedAggregator, rank_connections, top_range
+from flow_tail import FlowLogTail
+from flowd_generator import FlowGenerator
+from heavy_hitters import OTHER, SPACE_SAVING_FACTOR
+
+
+@pytest.fixture
+def sharded(monkeypatch):
+    # split even small logs over the workers
+    monkeypatch.setattr(flow_shards, 'MIN_SHARD_SIZE', 0)
+    with ThreadPoolExecutor(4) as executor:
+        yield ShardedAggregator(4, executor)
+
+
+def write_log(path, cardinality: int, flows: int) -> str:
+    now = time.time()
+    FlowGenerator(cardinality, ipv6_ratio=0.2, pareto_alpha=1.1, seed=1).write(str(path), flows, now - 60, now)
+    return str(path)
+
+
+def exact(log_file: str) -> dict:
+    return {c.get_id(): c for c in ShardedAggregator(1).read_new(FlowLogTail(log_file), 0)}
+
+
+def test_top_range_memory_bounded(tmp_path):
+    log_file = write_log(tmp_path / 'flowd.log', 5000, 20000)
+    summary, durations = top_range(log_file, 0, 1 << 30, 0, 10)
+    assert len(summary.connections) == 10 * SPACE_SAVING_FACTOR
+    assert durations.keys() == summary.connections.keys()
+
+
+def test_read_top_matches_exact_ranking_below_capacity(tmp_path, sharded):
+    log_file = write_log(tmp_path / 'flowd.log', 30, 5000)
+    expected = rank_connections(list(exact(log_file).values()), 10)
+    result = sharded.read_top(FlowLogTail(log_file), 0, 10)
+    assert [(c.get_id(), c.octets, c.packets, c.octets_error) for c in result] == \
+           [(c.get_id(), c.octets, c.packets, 0) for c in expected]
+    # the time span of the "other" bucket differs: all flows (SpaceSaving) or only the tail (rank_connections)
+    assert [c.duration for c in result[:-1]] == pytest.approx([c.duration for c in expected[:-1]])
+
+
+def test_read_top_error_bounds(tmp_path, sharded):
+    log_file = write_log(tmp_path / 'flowd.log', 5000, 20000)
+    truth = exact(log_file)
+    total = sum(c.octets for c in truth.values())
+    result = sharded.read_top(FlowLogTail(log_file), 0, 10)
+
+    assert len(result) == 11 and result[-1].interface_in == OTHER
+    assert sum(c.octets for c in result) == total
+    for connection in result[:-1]:
+        true_octets = truth[connection.get_id()].octets
+        assert connection.octets <= true_octets <= connection.octets + connection.octets_error
+    # the heaviest connections are well above the error bound and always reported
+    heaviest = sorted(truth.values(), key=lambda c: c.octets, reverse=True)[:3]
+    assert {c.get_id() for c in heaviest} <= {c.get_id() for c in result}
@@ -0,0 +1,41 @@
+import os
+import pickle
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+from status_db import SNAPSHOT_MAGIC
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.mark.parametrize('pipeline', ['0', '1'])
+def test_sigterm_saves_snapshot(tmp_path, pipeline):
+    snapshot_file = tmp_path / 'netmon.snapshot'
+    env = dict(os.environ, SNAPSHOT_INTERVAL='3600', SNAPSHOT_FILE=str(snapshot_file), PIPELINE=pipeline,
+               SYSLOG_PROTOCOL='file', SYSLOG_FILE=str(tmp_path / 'syslog.log'))
+    # main() on an empty flowd log of its own, without a checkpoint file
+    script = ('import sys, flow2conn, main; from flow_tail import FlowLogTail; '
+              'flow2conn.flow_tail = FlowLogTail(sys.argv[1]); main.main()')
+    (tmp_path / 'flowd.log').touch()
+    process = subprocess.Popen([sys.executable, '-c', script, str(tmp_path / 'flowd.log')], cwd=ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        # the first refresh writes a snapshot, wait for it to pass
+        deadline = time.time() + 30
+        while not snapshot_file.exists() and time.time() < deadline:
+            time.sleep(0.1)
+        assert snapshot_file.exists()
+        stopped_at = time.time()
+        process.send_signal(signal.SIGTERM)
+        assert process.wait(timeout=30) == 0
+    finally:
+        process.kill()
+        process.communicate()
+
+    with open(snapshot_file, 'rb') as f:
+        f.read(len(SNAPSHOT_MAGIC) + 1)
+        assert pickle.load(f)['time'] >= stopped_at
@@ -0,0 +1,66 @@
+import threading
+import time
+
+from pipeline import Pipeline
+
+WAIT = 5
+
+
+class FailingDB:
+    """
+    Stands in for StatusDB, every stage fails on its first call
+    """
+
+    def __init__(self):
+        self.fetches = 0
+        self.applied = []
+        self.drains = 0
+        self.drained = threading.Event()
+
+    def fetch_connections(self):
+        self.fetches += 1
+        if self.fetches == 1:
+            raise OSError('log unreadable')
+        return [self.fetches], (1, self.fetches)
+
+    def apply_connections(self, batch, log_position=None):
+        self.applied.append((batch, log_position))
+        if len(self.applied) == 2:
+            raise ValueError('corrupt state')
+
+    def drain_enrich_backlog(self):
+        self.drains += 1
+        if self.drains == 1:
+            raise RuntimeError('enrich failed')
+        self.drained.set()
+        return 0
+
+    def get_db_status(self):
+        return {'active_connections': 0, 'idle_connections': 0, 'closed_connections': 0, 'enrich_backlog': 0,
+                'enrich_backlog_age': 0}
+
+
+def test_stages_survive_errors(capsys):
+    db = FailingDB()
+    emitted = []
+    pipeline = Pipeline(db, 0.01, lambda db: emitted.append(len(db.applied)) or 0)
+    runner = threading.Thread(target=pipeline.run, daemon=True)
+    runner.start()
+    try:
+        deadline = time.time() + WAIT
+        while (len(emitted) < 3 or not db.drained.is_set()) and time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        pipeline.stop()
+        runner.join(WAIT)
+
+    assert not runner.is_alive()
+    # a failed ingest passes an empty batch without log position, the state stage still runs (expiry)
+    assert db.applied[0] == ([], None)
+    assert db.applied[2] == ([3], (1, 3))
+    # the refresh whose apply failed isn't emitted, the next ones are
+    assert emitted[:2] == [1, 3]
+    assert db.drained.is_set()
+    errors = capsys.readouterr().err
+    for message in ('log unreadable', 'corrupt state', 'enrich failed'):
+        assert f"------ Error: {message}" in errors
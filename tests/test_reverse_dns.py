@@ -0,0 +1,147 @@
+import queue
+import threading
+import time
+
+import pytest
+
+from reverse_dns import ReverseDNSResolver, unknown_domain
+
+WAIT = 2
+
+
+class StubResolver:
+    """
+    Stands in for gethostbyaddr: answers from a table, unknown addresses fail like a missing PTR record.
+    Lookups block while gate is cleared.
+    """
+
+    def __init__(self, names: dict[str, str]):
+        self.names = names
+        self.calls = []
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def __call__(self, ip_address: str) -> str:
+        self.calls.append(ip_address)
+        self.gate.wait(WAIT)
+        if ip_address not in self.names:
+            raise OSError('host not found')
+        return self.names[ip_address]
+
+
+@pytest.fixture
+def stub():
+    return StubResolver({'192.0.2.1': 'one.example', '192.0.2.2': 'two.example'})
+
+
+def make_resolver(stub, **kwargs) -> ReverseDNSResolver:
+    options = dict(max_workers=2, timeout=60, positive_ttl=60, negative_ttl=60, resolve_fn=stub)
+    options.update(kwargs)
+    return ReverseDNSResolver(**options)
+
+
+def resolve(resolver: ReverseDNSResolver, ip_address: str) -> str:
+    answers = queue.Queue()
+    resolver.resolve(ip_address, answers.put)
+    return answers.get(timeout=WAIT)
+
+
+def test_cache(stub):
+    resolver = make_resolver(stub)
+    assert resolve(resolver, '192.0.2.1') == 'one.example'
+    assert resolve(resolver, '192.0.2.1') == 'one.example'
+    assert resolve(resolver, '198.51.100.1') == unknown_domain('198.51.100.1')
+    assert resolve(resolver, '198.51.100.1') == unknown_domain('198.51.100.1')
+    assert stub.calls == ['192.0.2.1', '198.51.100.1']
+    assert resolver.get_stats()['hits'] == 2
+
+
+def test_ttl_expiry(stub):
+    resolver = make_resolver(stub, positive_ttl=0.05, negative_ttl=0.05)
+    resolve(resolver, '192.0.2.1')
+    resolve(resolver, '198.51.100.1')
+    assert resolver.get('192.0.2.1') == 'one.example'
+    time.sleep(0.1)
+    assert resolver.get('192.0.2.1') is None
+    assert resolver.get('198.51.100.1') is None
+    resolve(resolver, '192.0.2.1')
+    assert stub.calls == ['192.0.2.1', '198.51.100.1', '192.0.2.1']
+
+
+def test_inflight_deduplication_and_limit(stub):
+    resolver = make_resolver(stub, max_pending=2)
+    answers = queue.Queue()
+    stub.gate.clear()
+    resolver.resolve('192.0.2.1', answers.put)
+    resolver.resolve('192.0.2.1', answers.put)
+    resolver.resolve('192.0.2.2', answers.put)
+    # over the limit, dropped without an answer
+    resolver.resolve('192.0.2.3', answers.put)
+    assert resolver.get_stats()['inflight'] == 2
+    assert resolver.get_stats()['dropped'] == 1
+    stub.gate.set()
+    assert sorted(answers.get(timeout=WAIT) for _ in range(3)) == ['one.example', 'one.example', 'two.example']
+    assert answers.empty()
+    assert sorted(stub.calls) == ['192.0.2.1', '192.0.2.2']
+    assert resolver.get_stats()['inflight'] == 0
+
+
+def test_timeout_and_late_answer(stub):
+    resolver = make_resolver(stub, timeout=0)
+    answers = queue.Queue()
+    stub.gate.clear()
+    resolver.resolve('192.0.2.1', answers.put)
+    time.sleep(0.01)
+    resolver.expire()
+    assert answers.get(timeout=WAIT) == unknown_domain('192.0.2.1')
+    assert resolver.get_stats()['timeouts'] == 1
+    # joins the timed out lookup: unknown right away, the answer once it arrives
+    resolver.resolve('192.0.2.1', answers.put)
+    assert answers.get(timeout=WAIT) == unknown_domain('192.0.2.1')
+    stub.gate.set()
+    assert [answers.get(timeout=WAIT) for _ in range(2)] == ['one.example', 'one.example']
+    assert resolver.get('192.0.2.1') == 'one.example'
+    assert stub.calls == ['192.0.2.1']
+
+
+def test_timeout_starts_when_lookup_starts():
+    # a burst of lookups queued behind few slow workers: each takes 20 ms, the whole burst 10 times the timeout
+    def slow_resolve(ip_address):
+        time.sleep(0.02)
+        return 'host-' + ip_address
+
+    resolver = ReverseDNSResolver(max_workers=2, timeout=0.1, resolve_fn=slow_resolve)
+    answers = {}
+    addresses = [f'198.51.100.{i}' for i in range(100)]
+    for ip_address in addresses:
+        resolver.resolve(ip_address, lambda domain, ip_address=ip_address: answers.setdefault(ip_address, domain))
+    deadline = time.time() + 10
+    while resolver.get_stats()['inflight'] and time.time() < deadline:
+        resolver.expire()
+        time.sleep(0.01)
+    assert answers == {ip_address: 'host-' + ip_address for ip_address in addresses}
+    assert resolver.get_stats()['timeouts'] == 0
+
+
+def test_timed_out_lookup_keeps_its_slot(stub):
+    resolver = make_resolver(stub, timeout=0, max_pending=1)
+    answers = queue.Queue()
+    stub.gate.clear()
+    resolver.resolve('192.0.2.1', answers.put)
+    time.sleep(0.01)
+    resolver.expire()
+    assert answers.get(timeout=WAIT) == unknown_domain('192.0.2.1')
+    # the worker is still blocked on the first lookup, nothing more is submitted
+    resolver.resolve('192.0.2.2', answers.put)
+    assert resolver.get_stats()['dropped'] == 1
+    stub.gate.set()
+    assert answers.get(timeout=WAIT) == 'one.example'
+    assert stub.calls == ['192.0.2.1']
+
+
+def test_non_ip_address_is_ignored(stub):
+    resolver = make_resolver(stub)
+    answers = queue.Queue()
+    resolver.resolve('other', answers.put)
+    assert resolver.get_stats()['inflight'] == 0
+    assert answers.empty() and stub.calls == []
@@ -0,0 +1,121 @@
+import os
+import time
+
+import pytest
+
+import flow2conn
+import reverse_dns
+import status_db
+from connection import Connection
+from flow_tail import FlowLogTail
+from geo_ip_data import GeoIPCache
+from reverse_dns import ReverseDNSResolver
+
+
+def test_expiry_compacts_enrich_backlog(empty_db):
+    now = 1_000_000
+    # closed before they were enriched: queue entries that drain_enrich_backlog won't reach under overload
+    connections = [Connection(now - 1000, now - 1000, 'em0', 'em1', f'10.0.{i // 256}.{i % 256}', '10.1.0.1',
+                              i, 443, 6, 1, 1) for i in range(5000)]
+    empty_db.apply_connections(connections)
+    empty_db.apply_connections([])
+    assert len(empty_db.idle_connections) == 5000
+    assert len(empty_db.enrich_backlog) == 5000
+
+    survivor = Connection(now, now, 'em0', 'em1', '10.2.0.1', '10.1.0.1', 1, 443, 6, 1, 1)
+    empty_db.apply_connections([survivor])
+    empty_db.expire_idle_connections(now)
+
+    assert len(empty_db.closed_connections) == 5000
+    assert empty_db.enrich_backlog == [(-1, survivor.get_id())]
+    assert list(empty_db.enrich_queued_at) == [survivor.get_id()]
+
+
+def test_enrich_backlog_shrinks_once_stale_entries_dominate(empty_db, monkeypatch):
+    monkeypatch.setattr(empty_db, 'ENRICH_BATCH_LIMIT', 100)
+    now = 1_000_000
+    pending = [Connection(now, now, 'em0', 'em1', '10.3.0.1', '10.1.0.1', i, 443, 6, 1000 + i, 1) for i in range(10)]
+    empty_db.apply_connections(pending)
+
+    def close(count: int, first: int):
+        stale = [Connection(now - 1000, now - 1000, 'em0', 'em1', f'10.0.{i // 256}.{i % 256}', '10.1.0.1', i, 80,
+                            6, 1, 1) for i in range(first, first + count)]
+        empty_db.apply_connections(stale + pending)
+        empty_db.apply_connections(pending)
+        empty_db.expire_idle_connections(now)
+
+    # a few stale entries are left alone
+    close(500, 0)
+    assert len(empty_db.enrich_backlog) == 510
+    # past the threshold only the pending connections are left
+    close(1500, 500)
+    assert len(empty_db.enrich_backlog) == len(empty_db.enrich_queued_at) == 10
+    assert empty_db.drain_enrich_backlog() == 10
+    assert all(connection.is_enriched for connection in pending)
+
+
+def test_domain_set_while_serializing_is_emitted(empty_db, monkeypatch):
+    connection = Connection(0, 1, 'em0', 'em1', '10.0.0.1', '192.0.2.1', 1234, 443, 6, 100, 1)
+    empty_db.apply_connections([connection])
+    connection.is_enriched = True
+    as_dict = Connection.as_dict
+
+    def as_dict_racing_resolver(self):
+        result = as_dict(self)
+        # the reverse DNS callback runs on a resolver thread, without StatusDB.lock
+        self._set_domain('dst_domain', 'one.example')
+        return result
+
+    monkeypatch.setattr(Connection, 'as_dict', as_dict_racing_resolver)
+    assert empty_db.get_connections(changed_only=True)['active_connections'][0]['dst_data'] == {'country': None}
+    monkeypatch.setattr(Connection, 'as_dict', as_dict)
+    assert empty_db.get_connections(changed_only=True)['active_connections'][0]['dst_data'] == \
+           {'country': None, 'domain': 'one.example'}
+
+
+def test_snapshot_round_trip(empty_db, tmp_path, monkeypatch):
+    monkeypatch.setattr(status_db, 'geoip_cache', GeoIPCache())
+    monkeypatch.setattr(reverse_dns, '_reverse_dns', ReverseDNSResolver(max_workers=1))
+    monkeypatch.setattr(empty_db, 'log_position', None)
+    log_file = tmp_path / 'flowd.log'
+    log_file.write_bytes(b'')
+    monkeypatch.setattr(flow2conn, 'flow_tail', FlowLogTail(str(log_file), str(tmp_path / 'checkpoint.json')))
+
+    now = time.time()
+    connections = [Connection(now - 10 * i, now - 10 * i, 'em0', 'em1', f'10.0.0.{i}', '192.0.2.1', 1000 + i, 443,
+                              6, 100 * i, i) for i in range(1, 6)]
+    empty_db.apply_connections(connections, (os.stat(log_file).st_ino, 4096))
+    connections[0].enrich()
+    empty_db.apply_connections(connections[1:3], (os.stat(log_file).st_ino, 8192))
+    status_db.geoip_cache.load({'entries': [('198.51.100.7', {'country': 'NL', 'asn': 'AS1', 'city': 'A'}),
+                                            ((4, 24, 0xc63364), {'country': 'NL', 'asn': 'AS1', 'city': 'A'})],
+                                'prefix_lengths': {4: [24], 6: []}})
+    reverse_dns._reverse_dns.load_cache([('192.0.2.1', ('one.example', now + 600))])
+
+    def state():
+        tables = {name: {conn_id: conn.as_dict() for conn_id, conn in getattr(empty_db, name).items()}
+                  for name in ('active_connections', 'idle_connections', 'closed_connections')}
+        return (tables, list(empty_db.idle_expiry), list(empty_db.enrich_backlog), dict(empty_db.enrich_queued_at),
+                empty_db.log_position, status_db.geoip_cache.dump(),
+                [(ip_address, domain) for ip_address, (domain, _) in reverse_dns._reverse_dns.dump_cache()])
+
+    saved = state()
+    assert saved[0]['idle_connections'] and saved[2]
+    snapshot_file = str(tmp_path / 'netmon.snapshot')
+    empty_db.save_snapshot(snapshot_file)
+
+    # a fresh process: empty tables and caches, the tail ahead of the snapshot
+    for name in ('active_connections', 'idle_connections', 'closed_connections', 'enrich_queued_at'):
+        setattr(empty_db, name, {})
+    empty_db.idle_expiry, empty_db.enrich_backlog, empty_db.log_position = [], [], None
+    monkeypatch.setattr(status_db, 'geoip_cache', GeoIPCache())
+    monkeypatch.setattr(reverse_dns, '_reverse_dns', ReverseDNSResolver(max_workers=1))
+    flow2conn.flow_tail.offset = 1 << 20
+
+    assert empty_db.load_snapshot(snapshot_file)
+    assert state() == saved
+    # the TTL is stored as it was left, not reset
+    assert reverse_dns._reverse_dns.dump_cache()[0][1][1] == pytest.approx(now + 600)
+    assert (flow2conn.flow_tail.inode, flow2conn.flow_tail.offset) == (os.stat(log_file).st_ino, 8192)
+    restarted = FlowLogTail(str(log_file), str(tmp_path / 'checkpoint.json'))
+    assert (restarted.inode, restarted.offset) == (os.stat(log_file).st_ino, 8192)
@@ -0,0 +1,102 @@
+import json
+import socket
+import threading
+
+import pytest
+
+from syslog_sender import SyslogSender, TCPSink, UDPSink
+
+# more than fits in an IPv4 UDP datagram, sendto fails with EMSGSIZE
+OVERSIZED = 70000
+
+
+@pytest.fixture
+def udp_listener():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.settimeout(2)
+    yield listener
+    listener.close()
+
+
+def receive(listener: socket.socket, count: int) -> list[bytes]:
+    return [listener.recv(1 << 17) for _ in range(count)]
+
+
+def test_udp_sink(udp_listener):
+    sink = UDPSink(*udp_listener.getsockname(), 'rfc5424')
+    assert sink.write([(0.0, 'first'), (1.0, 'second')]) == 2
+    messages = receive(udp_listener, 2)
+    assert messages[0].startswith(b'<14>1 ') and messages[0].endswith(b' - - first')
+    assert messages[1].endswith(b' - - second')
+
+
+def test_udp_sink_truncates_oversized_message(udp_listener):
+    sink = UDPSink(*udp_listener.getsockname(), 'rfc3164', max_size=1000)
+    assert sink.write([(0.0, 'a'), (0.0, 'x' * OVERSIZED), (0.0, 'b')]) == 3
+    messages = receive(udp_listener, 3)
+    assert len(messages[1]) == 1000
+    assert messages[2].endswith(b': b')
+    assert sink.truncated == 1
+
+
+def test_udp_sink_failure_drops_only_that_message(udp_listener):
+    sink = UDPSink(*udp_listener.getsockname(), 'rfc3164', max_size=OVERSIZED * 2)
+    sender = SyslogSender(sink)
+    for message in ('a', 'x' * OVERSIZED, 'b'):
+        sender.send({'message': message})
+    sender.flush()
+    assert [json.loads(message.split(b': ', 1)[1])['message'] for message in receive(udp_listener, 2)] == ['a', 'b']
+    stats = sender.get_stats()
+    assert (stats['sent'], stats['dropped'], stats['errors']) == (2, 1, 0)
+
+
+def test_tcp_sink():
+    with socket.create_server(('127.0.0.1', 0)) as server:
+        server.settimeout(2)
+        sender = SyslogSender(TCPSink(*server.getsockname(), 'rfc3164'))
+        for idx in range(100):
+            sender.send({'message': idx})
+        sender.flush()
+        connection, _ = server.accept()
+        with connection, connection.makefile('rb') as stream:
+            lines = [stream.readline() for _ in range(100)]
+    assert [json.loads(line.split(b': ', 1)[1])['message'] for line in lines] == list(range(100))
+    assert sender.get_stats()['sent'] == 100
+
+
+def test_drop_overflow():
+    class BlockedSink:
+        def write(self, batch):
+            raise OSError('unreachable')
+
+    sender = SyslogSender(BlockedSink(), queue_size=10, batch_size=10, overflow='drop')
+    for idx in range(1000):
+        sender.send({'message': idx})
+    sender.flush()
+    stats = sender.get_stats()
+    assert stats['sent'] == 0
+    assert stats['dropped'] == 1000
+
+
+def test_counters_under_concurrent_senders():
+    class HalfSink:
+        def write(self, batch):
+            return len(batch) // 2
+
+    sender = SyslogSender(HalfSink(), queue_size=10, batch_size=3, overflow='drop')
+
+    def send():
+        for idx in range(5000):
+            sender.send({'message': idx})
+
+    threads = [threading.Thread(target=send) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    sender.flush()
+    stats = sender.get_stats()
+    # every message is either written or dropped: on overflow by a sender, or by the writer (half of every batch)
+    assert stats['sent'] + stats['dropped'] == 20000
+    assert stats['sent'] < stats['enqueued'] <= 20000
@@ -1,13 +1,49 @@
 import os
 import sys
 
-from dotenv import load_dotenv
+_env_loaded = False
 
-load_dotenv()
 
-VERBOSE = bool(os.getenv("VERBOSE"))
+def _find_env_file():
+    # nearest .env from this directory up, like python-dotenv's find_dotenv()
+    path = os.path.dirname(os.path.abspath(__file__))
+    while True:
+        env_file = os.path.join(path, '.env')
+        if os.path.isfile(env_file):
+            return env_file
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def load_env():
+    """
+    Load the .env settings into the environment (variables that are set already take precedence).
+    Only the first call reads the file, python-dotenv isn't imported when there is no .env file.
+    """
+    global _env_loaded
+    if _env_loaded:
+        return
+    _env_loaded = True
+    env_file = _find_env_file()
+    if env_file is not None:
+        from dotenv import load_dotenv
+        load_dotenv(env_file)
+
+
+def getenv(name: str, default: str = None) -> str:
+    """
+    os.getenv for settings: .env is loaded on the first call, so modules that read their settings on first use
+    import without python-dotenv
+    :param name: setting
+    :param default: value when not set
+    :return: str
+    """
+    load_env()
+    return os.getenv(name, default)
 
 
 def log_on_verbose(error):
-    if VERBOSE:
+    if getenv("VERBOSE"):
         print(error)  # , flush=True, file=sys.stderr)